@@ -0,0 +1,150 @@
+import sys
+import time
+import argparse
+import multiprocessing
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+import numpy as np
+import pandas as pd
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.benchmarks.synthetic import generate_permits
+from src.pipeline.dictionaries import types_dict
+from src.toolkits.pgcopy import CopyStream, iter_binary, iter_csv
+
+
+def typed_permits(n, seed=0):
+    """
+    Adds DATE, NUMERIC and SMALLINT columns to the synthetic permits so
+    every encoder is exercised.
+    """
+
+    rng = np.random.default_rng(seed)
+    data = generate_permits(n, seed=seed)
+
+    dates = pd.Series(np.datetime64('2013-01-01') + rng.integers(0, 2500, n).astype('timedelta64[D]'))
+    data['status_date'] = dates.dt.date.where(rng.random(n) > 0.01, np.nan)
+    data['valuation'] = [Decimal(value) for value in (rng.lognormal(10, 2, n).round(2)).astype(str)]
+    data['no_of_stories'] = pd.Series(rng.integers(0, 40, n), dtype='Int64').where(rng.random(n) > 0.2, pd.NA)
+    data['work_description'] = np.array(["Interior remodel, no change in use",
+                                         "Install (E) solar panels on roof\nper plans",
+                                         'Re-roof "like for like"', np.nan], dtype=object)[rng.integers(0, 4, n)]
+
+    return data
+
+
+def _memory():
+    """
+    Returns current and peak resident memory of this process in bytes.
+    """
+
+    with open('/proc/self/status') as status:
+        values = dict(line.split(':', 1) for line in status)
+
+    return int(values['VmRSS'].split()[0]) * 1024, int(values['VmHWM'].split()[0]) * 1024
+
+
+def _reset_peak():
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+
+
+def copy_stringio(data, sql_types):
+    """
+    Previous CSV path of Table._copy_from_dataframe: the whole frame as
+    one CSV string.
+    """
+
+    stream = StringIO()
+    data.to_csv(stream, index=False, header=True, sep=',')
+    stream.seek(0)
+
+    return stream, "FORMAT CSV, HEADER TRUE"
+
+
+def copy_csv(data, sql_types):
+    return CopyStream(iter_csv(data)), "FORMAT CSV, HEADER TRUE"
+
+
+def copy_binary(data, sql_types):
+    return CopyStream(iter_binary(data, sql_types)), "FORMAT BINARY"
+
+
+paths = {"csv StringIO": copy_stringio, "csv stream": copy_csv, "binary stream": copy_binary}
+
+
+def _drain(stream, options):
+    """
+    Reads a stream like copy_expert would, without a database.
+    """
+
+    total = 0
+    while True:
+        data = stream.read(1 << 16)
+        if not data:
+            return total
+        total += len(data.encode('utf-8') if isinstance(data, str) else data)
+
+
+def run(path, n, database=False):
+    """
+    Times one copy path and measures its peak memory above the resident
+    set after generating the data. Copies into a temporary table when
+    database is True, otherwise only encodes the stream. Runs in a fresh
+    process so that heap freed by one path is not reused by the next.
+    """
+
+    data = typed_permits(n)
+    sql_types = {name: types_dict[name] for name in data.columns}
+
+    con = None
+    if database:
+        from src.toolkits.postgresql import Database
+        con = Database()._connect()
+
+    _reset_peak()
+    before, _ = _memory()
+    start = time.perf_counter()
+
+    stream, options = paths[path](data, sql_types)
+
+    if con is None:
+        size = _drain(stream, options)
+    else:
+        cur = con.cursor()
+        cur.execute("DROP TABLE IF EXISTS bench_copy; CREATE TEMP TABLE bench_copy ({});".format(
+            ', '.join('{} {}'.format(name, sql_types[name]) for name in data.columns)))
+        cur.copy_expert("COPY bench_copy FROM STDIN WITH ({})".format(options), stream, size=1 << 16)
+        con.commit()
+        size = stream.tell() if isinstance(stream, StringIO) else stream.bytes
+
+    seconds = time.perf_counter() - start
+    _, peak = _memory()
+
+    if con is not None:
+        con.close()
+
+    return size, seconds, peak - before
+
+
+def main(sizes=(10000, 100000, 1000000), database=False):
+
+    print("{:>10}{:>16}{:>10}{:>10}{:>12}{:>14}".format("Rows", "Path", "MB", "MB/s", "Rows/s", "Peak RSS MB"))
+
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for n in sizes:
+            for path in paths:
+                size, seconds, peak = pool.apply(run, (path, n, database))
+                print("{:>10}{:>16}{:>10.1f}{:>10.1f}{:>12.0f}{:>14.1f}".format(n, path, size / 1e6,
+                                                                               size / 1e6 / seconds, n / seconds,
+                                                                               peak / 1e6))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare COPY paths for Table._copy_from_dataframe.")
+    parser.add_argument("--database", action="store_true",
+                        help="Copy into a temporary table instead of only encoding the stream")
+    args = parser.parse_args()
+
+    main(database=args.database)
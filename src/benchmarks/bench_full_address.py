@@ -0,0 +1,57 @@
+import sys
+import time
+from pathlib import Path
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.benchmarks.synthetic import generate_permits
+from src.pipeline.transform_data import create_full_address, address_columns
+from src.toolkits.addresses import address_key
+
+
+def create_full_address_apply(data):
+    """
+    Previous row-wise implementation of create_full_address, kept as the
+    baseline for this benchmark.
+    """
+
+    data['suffix_direction'] = data['suffix_direction'].str[0].fillna('')
+    data['zip_code'] = data['zip_code'].astype(object).fillna(0).replace(0, '')
+    data['address_start'] = data['address_start'].astype(object)
+    data['full_address'] = data[address_columns].fillna('').astype(str).apply(' '.join, axis=1).str.replace('  ', ' ')
+
+    return data
+
+
+def _time(func, data):
+    start = time.perf_counter()
+    result = func(data)
+    return time.perf_counter() - start, result
+
+
+def main(sizes=(10000, 100000, 1000000)):
+
+    # create_full_address also builds address_key, which the row-wise
+    # baseline does not; its share is timed on its own and left out of the
+    # speedup
+    print("{:>10}{:>16}{:>16}{:>16}{:>10}".format("Rows", "apply rows/s", "vector rows/s", "key seconds",
+                                                  "Speedup"))
+
+    for n in sizes:
+        data = generate_permits(n)
+
+        apply_seconds, expected = _time(create_full_address_apply, data.copy())
+        vector_seconds, result = _time(create_full_address, data.copy())
+
+        # Same addresses once the old path's leftover spaces are collapsed
+        expected = expected['full_address'].str.split().str.join(' ')
+        if not expected.equals(result['full_address']):
+            raise AssertionError("Vectorized full_address differs from row-wise output at {} rows.".format(n))
+
+        key_seconds, _ = _time(address_key, result)
+        vector_seconds = max(vector_seconds - key_seconds, 1e-9)
+
+        print("{:>10}{:>16.0f}{:>16.0f}{:>16.3f}{:>9.1f}x".format(n, n / apply_seconds, n / vector_seconds,
+                                                                  key_seconds, apply_seconds / vector_seconds))
+
+
+if __name__ == '__main__':
+    main()
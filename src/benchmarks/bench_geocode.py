@@ -0,0 +1,76 @@
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.toolkits.geospatial import google_geocoder, geocode_many
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    """
+    Answers Google Maps geocoding requests after a simulated network
+    latency. The latitude encodes the house number so that callers can
+    check results come back in input order.
+    """
+
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        address = parse_qs(urlparse(self.path).query).get("address", [""])[0]
+        number = int(address.split()[0])
+        body = json.dumps({"status": "OK", "results": [{
+            "formatted_address": address,
+            "geometry": {"location": {"lat": 34 + number / 1e5, "lng": -118.25}},
+        }]}).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(latency=0.05):
+    """
+    Starts a local geocoding API stand-in on a free port. Returns the
+    server and its "host:port" domain.
+    """
+
+    StandInHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, "127.0.0.1:{}".format(server.server_address[1])
+
+
+def main(n=200, latency=0.05, configs=((1, 1000), (4, 1000), (16, 1000), (16, 50))):
+
+    server, domain = start_stand_in(latency)
+    geocoder = google_geocoder(key="stand-in", agent="benchmark", domain=domain, scheme="http")
+    addresses = ["{} MAIN ST 90012".format(i) for i in range(n)]
+
+    print("{:>8}{:>10}{:>14}".format("Workers", "Rate", "Requests/s"))
+
+    for max_workers, rate in configs:
+        start = time.perf_counter()
+        results = geocode_many(addresses, geocoder, rate=rate, max_workers=max_workers)
+        seconds = time.perf_counter() - start
+
+        if results != [(34 + i / 1e5, -118.25) for i in range(n)]:
+            raise AssertionError("Stand-in results were not returned in order.")
+
+        print("{:>8}{:>10}{:>14.1f}".format(max_workers, rate, n / seconds))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import sys
+import time
+import uuid
+import argparse
+import contextlib
+from io import StringIO
+from pathlib import Path
+import numpy as np
+import pandas as pd
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.toolkits.geospatial import (SpatialIndex, create_spatial_index, query_bbox, query_within, query_nearest,
+                                     haversine)
+
+# Extent of the City of Los Angeles
+south, west, north, east = 33.70, -118.67, 34.34, -118.15
+
+
+def generate_points(n, seed=0):
+    """
+    Generates n permit locations, half spread over the city and half
+    clustered around a few centers, as permits are.
+    """
+
+    rng = np.random.default_rng(seed)
+    spread = n // 2
+    centers = rng.uniform([south, west], [north, east], (50, 2))
+    clustered = centers[rng.integers(0, len(centers), n - spread)] + rng.normal(0, 0.01, (n - spread, 2))
+
+    points = np.vstack([rng.uniform([south, west], [north, east], (spread, 2)), clustered])
+
+    return pd.DataFrame({"id": np.arange(n), "latitude": points[:, 0].round(5), "longitude": points[:, 1].round(5)})
+
+
+def latencies(func, queries):
+    """
+    Returns the median and 95th percentile milliseconds of func over the
+    query points.
+    """
+
+    seconds = []
+    for latitude, longitude in queries:
+        start = time.perf_counter()
+        func(latitude, longitude)
+        seconds.append(time.perf_counter() - start)
+
+    return np.median(seconds) * 1e3, np.percentile(seconds, 95) * 1e3
+
+
+def queries_for(radius=500, k=10, half_width=0.005):
+    return {
+        "within {} m".format(radius): lambda index: lambda lat, lon: index.within(lat, lon, radius),
+        "nearest k={}".format(k): lambda index: lambda lat, lon: index.nearest(lat, lon, k),
+        "bbox".format(): lambda index: lambda lat, lon: index.bbox(lat - half_width, lon - half_width,
+                                                                   lat + half_width, lon + half_width),
+    }
+
+
+def check(index, points, queries, radius=500, k=10):
+    """
+    Compares SpatialIndex results with a full scan.
+    """
+
+    for latitude, longitude in queries:
+        distances = haversine(latitude, longitude, points["latitude"].to_numpy(), points["longitude"].to_numpy())
+
+        if set(index.within(latitude, longitude, radius)["id"]) != set(np.flatnonzero(distances <= radius)):
+            raise AssertionError("within differs from a full scan at {}, {}.".format(latitude, longitude))
+        if not np.allclose(index.nearest(latitude, longitude, k)["distance"], np.sort(distances)[:k]):
+            raise AssertionError("nearest differs from a full scan at {}, {}.".format(latitude, longitude))
+
+
+class ServerSide():
+
+    """
+    Runs the same queries against a scratch table in the local PostgreSQL
+    database, dropped afterwards.
+    """
+
+    def __init__(self, points):
+        from src.toolkits.postgresql import Database, Table
+
+        self.name = "bench_points_{}".format(uuid.uuid4().hex[:8])
+        self.db = Database()
+        self.db.create_table(self.name, {"id": "INTEGER", "latitude": "NUMERIC", "longitude": "NUMERIC"}, "id")
+        self.table = Table(name=self.name, id_col="id")
+        self.table._copy_from_dataframe(points, "id", columns=points.columns.tolist(), tmp_table=self.name)
+        self.db._run_query("ANALYZE {};".format(self.name))
+
+    def index(self):
+        create_spatial_index(self.table)
+        self.db._run_query("ANALYZE {};".format(self.name))
+
+    def within(self, latitude, longitude, radius):
+        return query_within(self.table, latitude, longitude, radius)
+
+    def nearest(self, latitude, longitude, k):
+        return query_nearest(self.table, latitude, longitude, k)
+
+    def bbox(self, south, west, north, east):
+        return query_bbox(self.table, south, west, north, east)
+
+    def close(self):
+        self.db.drop_table(self.name)
+
+
+def main(n=1000000, count=200, seed=0, database=False):
+
+    points = generate_points(n, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    queries = points[["latitude", "longitude"]].to_numpy()[rng.integers(0, n, count)] + rng.normal(0, 0.002, (count, 2))
+
+    start = time.perf_counter()
+    index = SpatialIndex.from_data(points, id_col="id")
+    print("Built index of {} points in {:.2f} s.".format(n, time.perf_counter() - start))
+
+    check(index, points, queries[:20])
+
+    print("{:>14}{:>16}{:>10}{:>10}".format("Backend", "Query", "p50 ms", "p95 ms"))
+
+    backends = [("memory", index)]
+    server = None
+    if database:
+        with contextlib.redirect_stdout(StringIO()):
+            server = ServerSide(points)
+        backends += [("sql, no index", server), ("sql, gist", server)]
+
+    try:
+        for backend, target in backends:
+            if backend == "sql, gist":
+                with contextlib.redirect_stdout(StringIO()):
+                    server.index()
+
+            # Full scans are slow, a few queries are enough
+            sample = queries[:10] if backend == "sql, no index" else queries
+
+            for query, make in queries_for().items():
+                with contextlib.redirect_stdout(StringIO()):
+                    p50, p95 = latencies(make(target), sample)
+                print("{:>14}{:>16}{:>10.2f}{:>10.2f}".format(backend, query, p50, p95))
+    finally:
+        if server is not None:
+            with contextlib.redirect_stdout(StringIO()):
+                server.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time spatial queries over synthetic permit coordinates.")
+    parser.add_argument("--points", type=int, default=1000000, help="Number of points")
+    parser.add_argument("--queries", type=int, default=200, help="Queries timed per query type")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic points")
+    parser.add_argument("--database", action="store_true",
+                        help="Also time the queries in the local PostgreSQL database, without and with the index")
+    args = parser.parse_args()
+
+    main(n=args.points, count=args.queries, seed=args.seed, database=args.database)
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import contextlib
+import subprocess
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+import numpy as np
+import pandas as pd
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.benchmarks.synthetic import generate_table
+from src.pipeline.dictionaries import types_dict
+from src.pipeline.transform_data import create_full_address, split_lat_long
+from src.toolkits.geospatial import geocode_from_address
+
+id_col = "pcis_permit_no"
+
+
+def stub_geocoder(address):
+    """
+    Resolves any address instantly to a point derived from its text, so
+    geocode_from_address is timed without network or API costs.
+    """
+
+    number = sum(map(ord, address))
+    return 34 + number % 1000 / 1e4, -118.3 - number % 997 / 1e4
+
+
+def geocode_stub(data):
+    return geocode_from_address(data, geocoder=stub_geocoder, rate=1e9, max_workers=1)
+
+
+def transformed(data):
+    """
+    Runs the transform stages, as the pipeline does before writing back.
+    """
+
+    return split_lat_long(geocode_stub(create_full_address(data)))
+
+
+#### Benchmarks ####
+# name: (function, input); inputs are built from the generated rows before
+# each repeat and are not timed
+
+in_memory = {
+    "create_full_address": (create_full_address, lambda data: data.copy()),
+    "split_lat_long": (split_lat_long, lambda data: data.copy()),
+    "geocode_from_address": (geocode_stub, lambda data: create_full_address(data.copy())),
+}
+
+
+class DatabaseBenchmarks():
+
+    """
+    Times the Table methods against a scratch table with the columns of
+    types_dict, created in the local PostgreSQL database and dropped
+    afterwards.
+    """
+
+    def __init__(self, data):
+        from src.toolkits.postgresql import Database, Table
+
+        self.data = data
+        self.name = "bench_permits_{}".format(uuid.uuid4().hex[:8])
+        self.db = Database()
+        self.db.create_table(self.name, types_dict, id_col)
+        self.table = Table(name=self.name, id_col=id_col)
+
+    def load(self):
+        """
+        Empties the table and copies the generated rows into it.
+        """
+
+        self.db._run_query("TRUNCATE {};".format(self.name))
+        self.table._copy_from_dataframe(self.data, id_col, columns=self.data.columns.tolist(), tmp_table=self.name)
+
+    def benchmarks(self):
+        from src.toolkits.postgresql import fingerprint
+
+        def copy_input(data):
+            self.db._run_query("TRUNCATE {};".format(self.name))
+            return data
+
+        def update_input(data):
+            self.load()
+            fetched = self.table.fetch_data()
+            return fetched, fingerprint(fetched)
+
+        def update(args):
+            fetched, baseline = args
+            return self.table.update_values(transformed(fetched), id_col=id_col, types_dict=types_dict,
+                                            update_schema=False, baseline=baseline)
+
+        return {
+            "_copy_from_dataframe": (lambda data: self.table._copy_from_dataframe(
+                data, id_col, columns=data.columns.tolist(), tmp_table=self.name), copy_input),
+            "fetch_data": (lambda data: self.table.fetch_data(), lambda data: self.load()),
+            "update_values": (update, update_input),
+        }
+
+    def close(self):
+        self.db.drop_table(self.name)
+
+
+def _quiet(func, *args):
+    """
+    Runs func with its progress messages suppressed.
+    """
+
+    with contextlib.redirect_stdout(StringIO()):
+        return func(*args)
+
+
+def time_benchmark(func, make_input, data, repeat=3):
+    """
+    Returns the seconds taken by func in each of repeat runs, each on a
+    fresh input made from data.
+    """
+
+    seconds = []
+    for _ in range(repeat):
+        argument = _quiet(make_input, data)
+        start = time.perf_counter()
+        _quiet(func, argument)
+        seconds.append(time.perf_counter() - start)
+
+    return seconds
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=str(Path(__file__).resolve().parent)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=(10000, 100000), repeat=3, seed=0, database=False):
+    """
+    Runs every benchmark at each size and returns the results as a
+    dictionary that serializes to JSON: run metadata and, per benchmark and
+    size, the seconds of each repeat, their median and rows/sec.
+    """
+
+    results = []
+
+    for n in sizes:
+        data = generate_table(n, seed=seed)
+        benchmarks = dict(in_memory)
+
+        scratch = None
+        if database:
+            scratch = _quiet(DatabaseBenchmarks, data)
+            benchmarks.update(scratch.benchmarks())
+
+        try:
+            for name, (func, make_input) in benchmarks.items():
+                seconds = time_benchmark(func, make_input, data, repeat=repeat)
+                median = float(np.median(seconds))
+                results.append({"benchmark": name, "rows": n, "seconds": seconds, "median": median,
+                                "rows_per_sec": n / median if median else None})
+                print("{:>24}{:>10}{:>12.3f}{:>14.0f}".format(name, n, median, n / median if median else 0))
+        finally:
+            if scratch is not None:
+                _quiet(scratch.close)
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "seed": seed,
+        "repeat": repeat,
+        "database": database,
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    """
+    Prints the speed of each benchmark in report relative to an earlier
+    report; above 1 is faster.
+    """
+
+    previous = {(result["benchmark"], result["rows"]): result["median"] for result in baseline["results"]}
+
+    print("Compared with {} ({}):".format(baseline.get("commit"), baseline.get("timestamp")))
+    print("{:>24}{:>10}{:>12}{:>12}{:>10}".format("Benchmark", "Rows", "Before s", "After s", "Speedup"))
+
+    for result in report["results"]:
+        key = (result["benchmark"], result["rows"])
+        if key in previous:
+            print("{:>24}{:>10}{:>12.3f}{:>12.3f}{:>9.2f}x".format(result["benchmark"], result["rows"], previous[key],
+                                                                    result["median"], previous[key] / result["median"]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic permits data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000], help="Table sizes to generate")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--database", action="store_true",
+                        help="Also time fetch_data, _copy_from_dataframe and update_values on local PostgreSQL")
+    parser.add_argument("--output", default=None, help="Write results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    print("{:>24}{:>10}{:>12}{:>14}".format("Benchmark", "Rows", "Median s", "Rows/sec"))
+    report = run(sizes=args.rows, repeat=args.repeat, seed=args.seed, database=args.database)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to {}.".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
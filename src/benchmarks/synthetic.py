@@ -0,0 +1,230 @@
+import sys
+from decimal import Decimal
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Set path for modules
+sys.path[0] = str(Path(__file__).resolve().parents[2])
+from src.pipeline.dictionaries import types_dict
+
+# Value pools for synthetic address fields
+street_names = np.array(["MAIN", "BROADWAY", "SUNSET", "WILSHIRE", "VERMONT", "FIGUEROA", "OLYMPIC",
+                         "PICO", "WESTERN", "LA BREA", "FAIRFAX", "HOLLYWOOD", "SANTA MONICA", "VENICE"],
+                        dtype=object)
+street_suffixes = np.array(["ST", "AVE", "BLVD", "DR", "PL", "WAY", None], dtype=object)
+directions = np.array(["N", "S", "E", "W", None], dtype=object)
+suffix_directions = np.array(["North", "South", "East", "West", None, None, None, None], dtype=object)
+
+
+def _choice(rng, values, n, null_rate=0.0):
+    """
+    Draws n values from a pool and blanks out a fraction as None.
+    """
+
+    data = values[rng.integers(0, len(values), n)]
+    if null_rate:
+        data[rng.random(n) < null_rate] = None
+    return data
+
+
+def generate_permits(n, seed=0, missing_coordinates=0.1):
+    """
+    Generates n synthetic permits rows with the address and coordinate
+    columns used by the transform stages, typed like a fetched table.
+
+    Params
+    ------
+    n : int
+        Number of rows
+
+    seed : int
+        Seed for the random generator, results are reproducible
+
+    missing_coordinates : float
+        Fraction of rows with a null latitude_longitude
+    """
+
+    rng = np.random.default_rng(seed)
+
+    latitude = rng.uniform(33.70, 34.34, n).round(5)
+    longitude = rng.uniform(-118.67, -118.15, n).round(5)
+    lat_long = pd.Series(["({}, {})".format(lat, lon) for lat, lon in zip(latitude, longitude)], dtype=object)
+    lat_long[rng.random(n) < missing_coordinates] = np.nan
+
+    address_start = pd.Series(rng.integers(1, 25000, n), dtype="Int64")
+    address_start[rng.random(n) < 0.01] = pd.NA
+
+    zip_code = pd.Series(rng.integers(90001, 91608, n), dtype="Int64")
+    zip_code[rng.random(n) < 0.03] = 0
+    zip_code[rng.random(n) < 0.02] = pd.NA
+
+    data = pd.DataFrame({
+        "pcis_permit_no": ["{:05d}-{:05d}-{:05d}".format(i // 100000, (i * 7919) % 100000, i % 100000)
+                           for i in range(n)],
+        "address_start": address_start,
+        "street_direction": _choice(rng, directions, n),
+        "street_name": _choice(rng, street_names, n, null_rate=0.005),
+        "street_suffix": _choice(rng, street_suffixes, n),
+        "suffix_direction": _choice(rng, suffix_directions, n),
+        "zip_code": zip_code,
+        "latitude_longitude": lat_long,
+    })
+
+    return data.fillna(np.nan)
+
+
+# Skewed value pools for code columns, most frequent first
+code_values = {
+    "status": ["Permit Finaled", "Issued", "CofO Issued", "Permit Expired", "Permit Closed", "Ready to Issue",
+               "Plan Check", "Corrections Issued", "CofO in Progress", "Permit Withdrawn"],
+    "permit_type": ["Bldg-Alter/Repair", "Electrical", "Plumbing", "HVAC", "Bldg-Addition", "Bldg-New",
+                    "Fire Sprinkler", "Bldg-Demolition", "Grading", "Swimming-Pool/Spa", "Elevator",
+                    "Pressure Vessel"],
+    "permit_sub_type": ["1 or 2 Family Dwelling", "Commercial", "Apartment", "Onsite", "Special Equipment",
+                        "Offsite"],
+    "permit_category": ["No Plan Check", "Plan Check"],
+    "event_code": ["Bldg-Alter/Repair", "Electrical", "Plumbing", "HVAC", "Bldg-New"],
+    "initiating_office": ["METRO", "VAN NUYS", "INTERNET", "WEST LA", "SOUTH LA", "SAN PEDRO", "WEST VALLEY",
+                          "HARBOR"],
+    "zone": ["R1-1", "RD1.5-1", "R3-1", "C2-1VL", "RS-1", "R2-1", "[Q]C2-1VL", "M1-1", "C4-2D", "RE11-1",
+             "CM-1", "PF-1XL", "OS-1XL", "LAX"],
+    "contractor_state": ["CA", "NV", "AZ", "TX", "OR", "WA", "NY", "FL"],
+    "contractor_city": ["LOS ANGELES", "GLENDALE", "BURBANK", "PASADENA", "TORRANCE", "LONG BEACH",
+                        "SANTA MONICA", "VAN NUYS", "ANAHEIM", "LAS VEGAS"],
+    "license_type": ["B", "C10", "C20", "C36", "C39", "A", "C16", "C33"],
+    "occupancy": ["R-3", "R-2", "B", "U", "M", "A-2", "S-2", "E", "I-2", "F-1"],
+    "applicant_relationship": ["Contractor", "Owner", "Agent for Contractor", "Architect", "Engineer",
+                               "Agent for Owner", "Owner-Builder"],
+    "floor_area_la_zoning_code_definition": ["0", "1200", "1500", "2000", "2400", "3000"],
+    "floor_area_la_building_code_definition": ["0", "1200", "1500", "2000", "2400", "3000"],
+    "existing_code": ["1", "2", "3", "12", "14", "21"],
+    "address_fraction_start": ["1/2", "1/4", "3/4"],
+    "address_fraction_end": ["1/2", "1/4", "3/4"],
+}
+
+first_names = np.array(["JOSE", "MARIA", "DAVID", "JOHN", "MICHAEL", "JENNIFER", "LINDA", "ROBERT", "JAMES",
+                        "ANA", "CARLOS", "SUSAN", "KEVIN", "GRACE", "HYUN"], dtype=object)
+last_names = np.array(["GARCIA", "SMITH", "LOPEZ", "KIM", "NGUYEN", "JOHNSON", "MARTINEZ", "LEE", "BROWN",
+                       "HERNANDEZ", "COHEN", "PATEL", "DAVIS", "WONG", "RAMIREZ"], dtype=object)
+business_words = np.array(["PACIFIC", "GOLDEN STATE", "WESTSIDE", "ALLIED", "PREMIER", "SUNRISE", "METRO",
+                           "VALLEY", "COASTAL", "ACE"], dtype=object)
+business_kinds = np.array(["CONSTRUCTION INC", "ELECTRIC", "PLUMBING CO", "SOLAR LLC", "ROOFING", "BUILDERS",
+                           "HEATING & AIR", "DEVELOPMENT CORP"], dtype=object)
+work_verbs = np.array(["Install", "Replace", "Remodel", "Repair", "Add", "Demolish", "Convert", "Upgrade"],
+                      dtype=object)
+work_objects = np.array(["(E) kitchen and bathroom", "roof mounted solar PV system", "200 amp main panel",
+                         "water heater", "HVAC unit and ducts", "2-story addition to (E) SFD",
+                         "fire sprinkler heads per NFPA 13", "retaining wall, \"like for like\"",
+                         "ADU over garage\nper plans", "windows, same size and location"], dtype=object)
+
+
+def _skewed(rng, values, n, null_rate=0.0, exponent=1.2):
+    """
+    Draws n values with Zipf-like frequencies, the first value being the
+    most frequent, as in the code columns of the real data.
+    """
+
+    weights = 1 / np.arange(1, len(values) + 1) ** exponent
+    data = np.array(values, dtype=object)[rng.choice(len(values), n, p=weights / weights.sum())]
+    if null_rate:
+        data[rng.random(n) < null_rate] = None
+    return data
+
+
+def _integers(rng, low, high, n, null_rate=0.0):
+    values = pd.Series(rng.integers(low, high, n), dtype="Int64")
+    values[rng.random(n) < null_rate] = pd.NA
+    return values
+
+
+def _dates(rng, start, days, n, null_rate=0.0):
+    """
+    Dates as datetime.date objects, as fetched from a DATE column.
+    """
+
+    values = pd.Series(np.datetime64(start) + rng.integers(0, days, n).astype('timedelta64[D]')).dt.date
+    return values.where(rng.random(n) >= null_rate, np.nan)
+
+
+def _names(rng, first, second, n, null_rate=0.0, sep=' '):
+    values = first[rng.integers(0, len(first), n)] + sep + second[rng.integers(0, len(second), n)]
+    if null_rate:
+        values[rng.random(n) < null_rate] = None
+    return values
+
+
+def generate_table(n, seed=0, missing_coordinates=0.1):
+    """
+    Generates n synthetic permits rows with every raw column in
+    types_dict, typed like a fetched table: nullable Int64 integers,
+    datetime.date dates, Decimal valuations and strings. Code columns such
+    as status and permit_type follow skewed frequencies; address and
+    coordinate columns come from generate_permits.
+
+    Params
+    ------
+    n : int
+        Number of rows
+
+    seed : int
+        Seed for the random generator, results are reproducible
+
+    missing_coordinates : float
+        Fraction of rows with a null latitude_longitude
+    """
+
+    rng = np.random.default_rng(seed + 1)
+    address = generate_permits(n, seed=seed, missing_coordinates=missing_coordinates)
+
+    columns = {
+        "assessor_book": _integers(rng, 2000, 8000, n, 0.01),
+        "assessor_page": _integers(rng, 1, 999, n, 0.01),
+        "assessor_parcel": _integers(rng, 1, 999, n).astype(str).str.zfill(3).to_numpy(dtype=object),
+        "tract": _names(rng, np.array(["TR", "PM", "RANCHO"], dtype=object),
+                        rng.integers(1, 80000, 200).astype(str).astype(object), n, 0.05),
+        "block": _choice(rng, np.array([str(i) for i in range(1, 40)] + [None] * 20, dtype=object), n),
+        "lot": _choice(rng, np.array([str(i) for i in range(1, 200)] + ["FR 1", "FR 2"], dtype=object), n, 0.02),
+        "reference_no_old_permit_no": _choice(rng, np.array(["LA{:06d}".format(i) for i in range(5000)],
+                                                            dtype=object), n, 0.7),
+        "status_date": _dates(rng, "2013-01-01", 2900, n),
+        "project_number": _integers(rng, 1, 5, n, 0.3),
+        "issue_date": _dates(rng, "2013-01-01", 2900, n, 0.05),
+        "address_end": address["address_start"],
+        "unit_range_start": _choice(rng, np.array(["1", "2", "101", "A", "B"], dtype=object), n, 0.9),
+        "unit_range_end": _choice(rng, np.array(["4", "12", "210", "D"], dtype=object), n, 0.95),
+        "work_description": _names(rng, work_verbs, work_objects, n, 0.01),
+        "valuation": [Decimal(value) if value != 'nan' else np.nan
+                      for value in np.where(rng.random(n) < 0.05, np.nan, rng.lognormal(9, 1.8, n).round(2))
+                      .astype(str)],
+        "no_of_residential_dwelling_units": _integers(rng, 0, 20, n, 0.6),
+        "no_of_accessory_dwelling_units": _integers(rng, 0, 3, n, 0.9),
+        "no_of_stories": _integers(rng, 1, 40, n, 0.6),
+        "contractors_business_name": _names(rng, business_words, business_kinds, n, 0.3),
+        "contractor_address": _names(rng, rng.integers(1, 20000, 500).astype(str).astype(object),
+                                     street_names + " ST", n, 0.3),
+        "license_no": _integers(rng, 100000, 1100000, n, 0.3),
+        "principal_first_name": _choice(rng, first_names, n, 0.5),
+        "principal_middle_name": _choice(rng, np.array(["A", "J", "M", "L"], dtype=object), n, 0.9),
+        "principal_last_name": _choice(rng, last_names, n, 0.5),
+        "license_expiration_date": _dates(rng, "2018-01-01", 2500, n, 0.3),
+        "applicant_first_name": _choice(rng, first_names, n, 0.1),
+        "applicant_last_name": _choice(rng, last_names, n, 0.1),
+        "applicant_business_name": _names(rng, business_words, business_kinds, n, 0.6),
+        "applicant_address_1": _names(rng, rng.integers(1, 20000, 500).astype(str).astype(object),
+                                      street_names + " AVE", n, 0.2),
+        "applicant_address_2": _choice(rng, np.array(["STE 100", "UNIT 2", "#5"], dtype=object), n, 0.9),
+        "applicant_address_3": _choice(rng, np.array(["LOS ANGELES, CA", "GLENDALE, CA"], dtype=object), n, 0.2),
+        "census_tract": _choice(rng, np.array(["{:.2f}".format(t) for t in rng.uniform(1000, 9900, 800)],
+                                              dtype=object), n, 0.01),
+        "council_district": _integers(rng, 1, 16, n, 0.01),
+        "proposed_code": _integers(rng, 1, 50, n, 0.8),
+    }
+
+    for column, values in code_values.items():
+        columns[column] = _skewed(rng, values, n, null_rate=0.05)
+
+    data = pd.DataFrame({column: address[column] if column in address.columns else columns[column]
+                         for column in types_dict if column in address.columns or column in columns})
+
+    return data.fillna(np.nan)
@@ -59,8 +59,145 @@ types_dict = {'assessor_book': 'SMALLINT',
              'proposed_code': 'SMALLINT',
              'longitude': 'NUMERIC',
              'full_address': 'VARCHAR(100)',
+             'address_key': 'VARCHAR(100)',
+             'coordinate_flags': 'VARCHAR(50)',
              'latitude': 'NUMERIC'}
 
 # Map of character replacements
 replace_map = {' ': '_', '-': '_', '#': 'No', '/': '_', 
                '.': '', '(': '', ')': '', "'": ''}
+
+
+#### Address normalization ####
+# Abbreviations from USPS Publication 28. Keys are folded values (upper
+# case, no periods or spaces); standard abbreviations map to themselves.
+
+# Street suffixes, Appendix C1
+street_suffix_map = {'ALLEE': 'ALY', 'ALLEY': 'ALY', 'ALLY': 'ALY', 'ALY': 'ALY',
+                     'ANEX': 'ANX', 'ANNEX': 'ANX', 'ANNX': 'ANX', 'ANX': 'ANX',
+                     'ARC': 'ARC', 'ARCADE': 'ARC',
+                     'AV': 'AVE', 'AVE': 'AVE', 'AVEN': 'AVE', 'AVENU': 'AVE', 'AVENUE': 'AVE', 'AVN': 'AVE',
+                     'AVNUE': 'AVE',
+                     'BEND': 'BND', 'BND': 'BND',
+                     'BLF': 'BLF', 'BLUF': 'BLF', 'BLUFF': 'BLF',
+                     'BLVD': 'BLVD', 'BOUL': 'BLVD', 'BOULEVARD': 'BLVD', 'BOULV': 'BLVD', 'BLV': 'BLVD',
+                     'BR': 'BR', 'BRNCH': 'BR', 'BRANCH': 'BR',
+                     'BRG': 'BRG', 'BRDGE': 'BRG', 'BRIDGE': 'BRG',
+                     'BYP': 'BYP', 'BYPA': 'BYP', 'BYPAS': 'BYP', 'BYPASS': 'BYP', 'BYPS': 'BYP',
+                     'CANYN': 'CYN', 'CANYON': 'CYN', 'CNYN': 'CYN', 'CYN': 'CYN',
+                     'CEN': 'CTR', 'CENT': 'CTR', 'CENTER': 'CTR', 'CENTR': 'CTR', 'CENTRE': 'CTR',
+                     'CNTER': 'CTR', 'CNTR': 'CTR', 'CTR': 'CTR',
+                     'CIR': 'CIR', 'CIRC': 'CIR', 'CIRCL': 'CIR', 'CIRCLE': 'CIR', 'CRCL': 'CIR', 'CRCLE': 'CIR',
+                     'CLF': 'CLF', 'CLIFF': 'CLF', 'CLFS': 'CLFS', 'CLIFFS': 'CLFS',
+                     'COMMON': 'CMN', 'CMN': 'CMN',
+                     'COR': 'COR', 'CORNER': 'COR',
+                     'COURT': 'CT', 'CT': 'CT', 'COURTS': 'CTS', 'CTS': 'CTS',
+                     'COVE': 'CV', 'CV': 'CV',
+                     'CREEK': 'CRK', 'CRK': 'CRK',
+                     'CRESCENT': 'CRES', 'CRES': 'CRES', 'CRSENT': 'CRES', 'CRSNT': 'CRES',
+                     'CREST': 'CRST', 'CRST': 'CRST',
+                     'CROSSING': 'XING', 'CRSSNG': 'XING', 'XING': 'XING',
+                     'DALE': 'DL', 'DL': 'DL',
+                     'DR': 'DR', 'DRIV': 'DR', 'DRIVE': 'DR', 'DRV': 'DR', 'DRIVES': 'DRS', 'DRS': 'DRS',
+                     'EST': 'EST', 'ESTATE': 'EST', 'ESTATES': 'ESTS', 'ESTS': 'ESTS',
+                     'EXP': 'EXPY', 'EXPR': 'EXPY', 'EXPRESS': 'EXPY', 'EXPRESSWAY': 'EXPY', 'EXPW': 'EXPY',
+                     'EXPY': 'EXPY',
+                     'EXT': 'EXT', 'EXTENSION': 'EXT', 'EXTN': 'EXT', 'EXTNSN': 'EXT',
+                     'FIELD': 'FLD', 'FLD': 'FLD', 'FIELDS': 'FLDS', 'FLDS': 'FLDS',
+                     'FOREST': 'FRST', 'FORESTS': 'FRST', 'FRST': 'FRST',
+                     'FREEWAY': 'FWY', 'FREEWY': 'FWY', 'FRWAY': 'FWY', 'FRWY': 'FWY', 'FWY': 'FWY',
+                     'GARDEN': 'GDN', 'GARDN': 'GDN', 'GRDEN': 'GDN', 'GRDN': 'GDN', 'GDN': 'GDN',
+                     'GARDENS': 'GDNS', 'GDNS': 'GDNS', 'GRDNS': 'GDNS',
+                     'GATEWAY': 'GTWY', 'GATEWY': 'GTWY', 'GATWAY': 'GTWY', 'GTWAY': 'GTWY', 'GTWY': 'GTWY',
+                     'GLEN': 'GLN', 'GLN': 'GLN',
+                     'GREEN': 'GRN', 'GRN': 'GRN',
+                     'GROV': 'GRV', 'GROVE': 'GRV', 'GRV': 'GRV',
+                     'HARB': 'HBR', 'HARBOR': 'HBR', 'HARBR': 'HBR', 'HBR': 'HBR', 'HRBOR': 'HBR',
+                     'HEIGHTS': 'HTS', 'HT': 'HTS', 'HTS': 'HTS',
+                     'HIGHWAY': 'HWY', 'HIGHWY': 'HWY', 'HIWAY': 'HWY', 'HIWY': 'HWY', 'HWAY': 'HWY', 'HWY': 'HWY',
+                     'HILL': 'HL', 'HL': 'HL', 'HILLS': 'HLS', 'HLS': 'HLS',
+                     'HOLLOW': 'HOLW', 'HLLW': 'HOLW', 'HOLLOWS': 'HOLW', 'HOLW': 'HOLW', 'HOLWS': 'HOLW',
+                     'IS': 'IS', 'ISLAND': 'IS', 'ISLND': 'IS',
+                     'JCT': 'JCT', 'JCTION': 'JCT', 'JCTN': 'JCT', 'JUNCTION': 'JCT', 'JUNCTN': 'JCT',
+                     'KNL': 'KNL', 'KNOL': 'KNL', 'KNOLL': 'KNL',
+                     'LAKE': 'LK', 'LK': 'LK', 'LAKES': 'LKS', 'LKS': 'LKS',
+                     'LANDING': 'LNDG', 'LNDG': 'LNDG', 'LNDNG': 'LNDG',
+                     'LANE': 'LN', 'LN': 'LN',
+                     'LOOP': 'LOOP', 'LOOPS': 'LOOP',
+                     'MALL': 'MALL',
+                     'MDW': 'MDW', 'MEADOW': 'MDW', 'MDWS': 'MDWS', 'MEADOWS': 'MDWS', 'MEDOWS': 'MDWS',
+                     'MEWS': 'MEWS',
+                     'MNT': 'MT', 'MOUNT': 'MT', 'MT': 'MT',
+                     'MNTAIN': 'MTN', 'MNTN': 'MTN', 'MOUNTAIN': 'MTN', 'MOUNTIN': 'MTN', 'MTIN': 'MTN',
+                     'MTN': 'MTN',
+                     'OVAL': 'OVAL', 'OVL': 'OVAL',
+                     'OVERPASS': 'OPAS', 'OPAS': 'OPAS',
+                     'PARK': 'PARK', 'PRK': 'PARK', 'PARKS': 'PARK',
+                     'PARKWAY': 'PKWY', 'PARKWY': 'PKWY', 'PKWAY': 'PKWY', 'PKWY': 'PKWY', 'PKY': 'PKWY',
+                     'PARKWAYS': 'PKWY', 'PKWYS': 'PKWY',
+                     'PASS': 'PASS', 'PATH': 'PATH', 'PATHS': 'PATH',
+                     'PIKE': 'PIKE', 'PIKES': 'PIKE',
+                     'PINE': 'PNE', 'PNE': 'PNE', 'PINES': 'PNES', 'PNES': 'PNES',
+                     'PL': 'PL', 'PLACE': 'PL',
+                     'PLAZA': 'PLZ', 'PLZ': 'PLZ', 'PLZA': 'PLZ',
+                     'POINT': 'PT', 'PT': 'PT', 'POINTS': 'PTS', 'PTS': 'PTS',
+                     'PORT': 'PRT', 'PRT': 'PRT',
+                     'RADIAL': 'RADL', 'RAD': 'RADL', 'RADIEL': 'RADL', 'RADL': 'RADL',
+                     'RAMP': 'RAMP',
+                     'RANCH': 'RNCH', 'RANCHES': 'RNCH', 'RNCH': 'RNCH', 'RNCHS': 'RNCH',
+                     'RDG': 'RDG', 'RDGE': 'RDG', 'RIDGE': 'RDG', 'RDGS': 'RDGS', 'RIDGES': 'RDGS',
+                     'RIV': 'RIV', 'RIVER': 'RIV', 'RVR': 'RIV', 'RIVR': 'RIV',
+                     'RD': 'RD', 'ROAD': 'RD', 'RDS': 'RDS', 'ROADS': 'RDS',
+                     'ROUTE': 'RTE', 'RTE': 'RTE',
+                     'ROW': 'ROW', 'RUE': 'RUE', 'RUN': 'RUN',
+                     'SHORE': 'SHR', 'SHR': 'SHR', 'SHORES': 'SHRS', 'SHRS': 'SHRS',
+                     'SKYWAY': 'SKWY', 'SKWY': 'SKWY',
+                     'SPG': 'SPG', 'SPNG': 'SPG', 'SPRING': 'SPG', 'SPRNG': 'SPG',
+                     'SPGS': 'SPGS', 'SPNGS': 'SPGS', 'SPRINGS': 'SPGS', 'SPRNGS': 'SPGS',
+                     'SQ': 'SQ', 'SQR': 'SQ', 'SQRE': 'SQ', 'SQU': 'SQ', 'SQUARE': 'SQ',
+                     'STA': 'STA', 'STATION': 'STA', 'STATN': 'STA', 'STN': 'STA',
+                     'ST': 'ST', 'STR': 'ST', 'STREET': 'ST', 'STRT': 'ST', 'STREETS': 'STS', 'STS': 'STS',
+                     'SMT': 'SMT', 'SUMIT': 'SMT', 'SUMITT': 'SMT', 'SUMMIT': 'SMT',
+                     'TER': 'TER', 'TERR': 'TER', 'TERRACE': 'TER',
+                     'TRACE': 'TRCE', 'TRACES': 'TRCE', 'TRCE': 'TRCE',
+                     'TRAIL': 'TRL', 'TRAILS': 'TRL', 'TRL': 'TRL', 'TRLS': 'TRL',
+                     'TUNEL': 'TUNL', 'TUNL': 'TUNL', 'TUNLS': 'TUNL', 'TUNNEL': 'TUNL', 'TUNNELS': 'TUNL',
+                     'TPKE': 'TPKE', 'TRNPK': 'TPKE', 'TURNPIKE': 'TPKE', 'TURNPK': 'TPKE',
+                     'UNDERPASS': 'UPAS', 'UPAS': 'UPAS',
+                     'VALLEY': 'VLY', 'VALLY': 'VLY', 'VLLY': 'VLY', 'VLY': 'VLY',
+                     'VIA': 'VIA', 'VIADCT': 'VIA', 'VIADUCT': 'VIA',
+                     'VIEW': 'VW', 'VW': 'VW', 'VIEWS': 'VWS', 'VWS': 'VWS',
+                     'VILL': 'VLG', 'VILLAG': 'VLG', 'VILLAGE': 'VLG', 'VILLG': 'VLG', 'VILLIAGE': 'VLG',
+                     'VLG': 'VLG',
+                     'VILLE': 'VL', 'VL': 'VL',
+                     'VIS': 'VIS', 'VIST': 'VIS', 'VISTA': 'VIS', 'VST': 'VIS', 'VSTA': 'VIS',
+                     'WALK': 'WALK', 'WALKS': 'WALK',
+                     'WALL': 'WALL',
+                     'WAY': 'WAY', 'WY': 'WAY', 'WAYS': 'WAYS'}
+
+# Directionals, Appendix B
+direction_map = {'N': 'N', 'NORTH': 'N', 'S': 'S', 'SOUTH': 'S', 'E': 'E', 'EAST': 'E', 'W': 'W', 'WEST': 'W',
+                 'NE': 'NE', 'NORTHEAST': 'NE', 'NW': 'NW', 'NORTHWEST': 'NW',
+                 'SE': 'SE', 'SOUTHEAST': 'SE', 'SW': 'SW', 'SOUTHWEST': 'SW'}
+
+# Secondary unit designators, Appendix C2, that are followed by a number
+unit_designators = ['APARTMENT', 'APT', 'BUILDING', 'BLDG', 'DEPARTMENT', 'DEPT', 'FLOOR', 'FL', 'HANGAR', 'HNGR',
+                    'LOT', 'OFFICE', 'OFC', 'PIER', 'ROOM', 'RM', 'SLIP', 'SPACE', 'SPC', 'STOP', 'SUITE', 'STE',
+                    'TRAILER', 'TRLR', 'UNIT']
+
+# Fractions written as single characters
+fraction_map = {'¼': '1/4', '½': '1/2', '¾': '3/4'}
+
+
+#### Coordinate validation ####
+# Coarse outline of mainland Los Angeles County as (latitude, longitude)
+# vertices, generous along land borders and following the coast; the
+# islands are left out. Permits outside it are flagged.
+la_boundary = [(34.823, -118.894), (34.823, -117.646), (34.242, -117.646), (34.030, -117.735),
+               (33.946, -117.783), (33.860, -117.990), (33.745, -118.115), (33.705, -118.285),
+               (33.770, -118.430), (33.850, -118.410), (34.000, -118.525), (34.040, -118.740),
+               (34.030, -118.950), (34.170, -118.950)]
+
+# Permits further than this many meters from the median of other permits
+# with the same value of a column are flagged
+outlier_distances = {'census_tract': 3000, 'zip_code': 8000}
@@ -0,0 +1,144 @@
+import sys
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.pipeline.transform_data import create_full_address, split_lat_long
+from src.toolkits.postgresql import Table, fingerprint
+
+
+def _quote(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def partitions(table, id_col, count, by=None, where=None):
+    """
+    Returns count SQL conditions that split the rows of table selected by
+    where into disjoint partitions, and the name of the table holding the
+    assignment, if any. With by, rows are assigned by a hash of that
+    column, so rows sharing a value (eg. a zip_code, and with it every
+    copy of an address) fall in the same partition. Otherwise the rows are
+    split into ranges of id_col of about equal size.
+
+    Params
+    ------
+    table : Table
+
+    count : int
+        Number of partitions
+
+    by : str
+        Column to partition on, eg. "zip_code" or "council_district"
+
+    where : str
+        Condition selecting the rows to partition, eg. from incremental_filter
+    """
+
+    selected = " WHERE " + where if where else ""
+
+    # The transform may rewrite by (eg. zip_code), so the assignment is
+    # stored by id before any worker starts, otherwise rows could move to
+    # a partition that has not run yet
+    if by:
+        assignment = "tmp_partitions_{}".format(uuid.uuid4().hex[:8])
+        sql = """
+        CREATE UNLOGGED TABLE {assignment} AS
+        SELECT {id_col}, abs(hashtext(coalesce({by}::text, ''))) % {count} AS part FROM {table}{where};
+        CREATE INDEX ON {assignment} (part);
+        """.format(assignment=assignment, id_col=id_col, by=by, count=count, table=table.table, where=selected)
+        table._run_query(sql, msg='Assigned rows of "{}" to {} partitions by {}.'.format(table.table, count, by))
+
+        return ["{id_col} IN (SELECT {id_col} FROM {assignment} WHERE part = {part})".format(
+            id_col=id_col, assignment=assignment, part=part) for part in range(count)], assignment
+
+    sql = """
+    SELECT min({id_col}) AS low, max({id_col}) AS high FROM (
+        SELECT {id_col}, ntile({count}) OVER (ORDER BY {id_col}) AS part FROM {table}{where}
+    ) parts GROUP BY part ORDER BY part;
+    """.format(id_col=id_col, count=count, table=table.table, where=selected)
+    ranges = table.fetch_data(sql=sql)
+
+    return ["{id_col} >= {low} AND {id_col} <= {high}".format(id_col=id_col, low=_quote(low), high=_quote(high))
+            for low, high in zip(ranges["low"], ranges["high"])], None
+
+
+def transform_partition(name, id_col, types_dict, condition):
+    """
+    Fetches one partition on its own connection, runs create_full_address
+    and split_lat_long and writes back the changed values. Runs in a
+    worker process. Returns the rows fetched, the update_values report and
+    the seconds of each stage; raises if the write fails.
+    """
+
+    table = Table(name=name, id_col=id_col)
+    seconds = {}
+
+    start = time.perf_counter()
+    data = table.fetch_data(sql="SELECT * FROM {} WHERE {};".format(name, condition))
+    seconds["fetch_data"] = time.perf_counter() - start
+
+    if not len(data):
+        return {"rows": 0, "written": {"rows": 0, "columns": [], "failed": False}, "seconds": seconds}
+
+    baseline = fingerprint(data)
+
+    for stage, func in (("create_full_address", create_full_address), ("split_lat_long", split_lat_long)):
+        start = time.perf_counter()
+        data = func(data)
+        seconds[stage] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    written = table.update_values(data, id_col=id_col, types_dict=types_dict, update_schema=False,
+                                  baseline=baseline)
+    seconds["update_values"] = time.perf_counter() - start
+
+    if written["failed"]:
+        raise RuntimeError('Could not write partition back to "{}".'.format(name))
+
+    return {"rows": len(data), "written": written, "seconds": seconds}
+
+
+def transform_parallel(table, id_col, types_dict, workers=4, by=None, where=None, partitions_per_worker=4):
+    """
+    Runs transform_partition over the partitions of table in a pool of
+    worker processes, each with its own database connection. Partitions
+    are disjoint, so the result does not depend on the order in which they
+    finish. There are several partitions per worker to balance the load
+    and bound the memory of each. Derived columns must exist before it is
+    called.
+
+    Yields the result of each partition in partition order. Failed
+    partitions are reported as they come and raise a RuntimeError once
+    every partition has finished, so the run is known to be incomplete.
+    """
+
+    conditions, assignment = partitions(table, id_col, workers * partitions_per_worker, by=by, where=where)
+    if where and not assignment:
+        conditions = ["({}) AND ({})".format(where, condition) for condition in conditions]
+
+    print('Transforming "{}" in {} partitions on {} processes.'.format(table.table, len(conditions), workers))
+
+    # Fresh interpreters: connections and threads are never inherited
+    context = multiprocessing.get_context("spawn")
+    failed = []
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(transform_partition, table.table, id_col, types_dict, condition)
+                       for condition in conditions]
+
+            for condition, future in zip(conditions, futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print("Error: partition {} failed: {}".format(condition, e))
+                    failed.append(condition)
+    finally:
+        if assignment:
+            table._run_query("DROP TABLE IF EXISTS {};".format(assignment),
+                             msg='Dropped partition table "{}".'.format(assignment))
+
+    if failed:
+        raise RuntimeError('{} of {} partitions of "{}" failed.'.format(len(failed), len(conditions), table.table))
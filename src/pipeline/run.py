@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import time
+import argparse
+from collections import OrderedDict
 from pathlib import Path
 sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
 import warnings
@@ -10,20 +13,460 @@ import numpy as np
 import pandas as pd
 import psycopg2
 from src.pipeline.dictionaries import types_dict, replace_map
-from src.pipeline.transform_data import create_full_address, split_lat_long
-from src.toolkits.geospatial import geocode_from_address
-from src.toolkits.postgresql import Database, Table
+from src.pipeline.transform_data import (create_full_address, split_lat_long, full_address_sql, lat_long_sql,
+                                       transform_sql, validate_coordinates)
+from src.pipeline.parallel import transform_parallel
+from src.toolkits.geospatial import geocode_from_address, GeocodeCache, LocalGazetteer
+from src.toolkits import profiling
+from src.toolkits.postgresql import Database, Table, fingerprint
 
-def main(name=None, id_col=None, replace_map=replace_map, types_dict=types_dict):
+# Columns added to the table by the transform stages
+derived_columns = ["full_address", "address_key", "latitude", "longitude", "coordinate_flags"]
+
+
+class StageTimer():
+
+    """
+    Accumulates wall time and rows processed for each pipeline stage and
+    prints a rows/sec summary.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.failures = 0
+
+    def add(self, stage, seconds, rows):
+        record = self.stages.setdefault(stage, {"seconds": 0.0, "rows": 0})
+        record["seconds"] += seconds
+        record["rows"] += rows
+
+    def run(self, stage, func, data, **kwargs):
+        """
+        Runs func(data, **kwargs) and records its time against stage.
+        Returns the result of func.
+        """
+
+        start = time.perf_counter()
+        with profiling.span(stage, rows=len(data)):
+            result = func(data, **kwargs)
+        self.add(stage, time.perf_counter() - start, len(data))
+
+        return result
+
+    def written(self, report):
+        """
+        Records an update_values report: rows written and columns touched,
+        and counts the writes that failed.
+        """
+
+        self.failures += bool(report.get("failed"))
+        record = self.stages.setdefault("rows_written", {"rows": 0, "columns": set()})
+        record["rows"] += report["rows"]
+        record["columns"].update(report["columns"])
+
+        return report
+
+    def summary(self):
+        print("{:<24}{:>12}{:>12}{:>14}".format("Stage", "Rows", "Seconds", "Rows/sec"))
+        for stage, record in self.stages.items():
+            if stage == "rows_written":
+                continue
+            rate = record["rows"] / record["seconds"] if record["seconds"] else float("nan")
+            print("{:<24}{:>12}{:>12.2f}{:>14.0f}".format(stage, record["rows"], record["seconds"], rate))
+
+        if "rows_written" in self.stages:
+            record = self.stages["rows_written"]
+            print("Rows written: {}, columns: {}.".format(record["rows"], sorted(record["columns"]) or None))
+
+        if self.failures:
+            print("Error: {} writes failed.".format(self.failures))
+
+
+def transform(data, timer, cache=None, gazetteer=None):
+    """
+    Runs the transform stages on a dataframe. Missing coordinates are
+    filled from sibling permits (gazetteer, or the rows of data itself)
+    before any geocoding requests are made.
+    """
+
+    data = timer.run("create_full_address", create_full_address, data)
+
+    gazetteer = gazetteer or LocalGazetteer.from_data(data)
+    data = timer.run("geocode_from_address", geocode_from_address, data, cache=cache, gazetteer=gazetteer)
+    data = timer.run("split_lat_long", split_lat_long, data)
+
+    return data
+
+
+def nearby_gazetteer(table, pending):
+    """
+    Builds a gazetteer from the permits sharing a zip code with the permits
+    matching the condition pending, rather than from the whole table:
+    addresses are only matched within their zip code. Zip code 0 counts as
+    missing, as in create_full_address.
+    """
+
+    zip_code = "coalesce(nullif(zip_code, 0), -1)"
+    where = "{zip_code} IN (SELECT {zip_code} FROM {table} WHERE {pending})".format(zip_code=zip_code,
+                                                                                  table=table.table, pending=pending)
+
+    return LocalGazetteer.from_table(table, where=where)
+
+
+def add_derived_columns(table, types_dict):
+    """
+    Adds the columns written by the transform stages to the table before
+    any data is fetched.
+    """
+
+    table.add_columns_from_data(pd.DataFrame(columns=derived_columns))
+    table.update_types(types_dict=types_dict, columns=derived_columns)
+
+
+def incremental_filter(table, id_col, watermark):
+    """
+    Returns a condition selecting permits whose watermark column is at or
+    after the value stored by the last successful run, plus permits that
+    were never transformed. Returns None before the first run, so the whole
+    table is processed. Rows equal to the watermark are selected again in
+    case more arrived after the last run; unchanged rows are not written
+    back.
+    """
+
+    value = table.get_watermark(watermark)
+
+    # Keep both filters cheap on large tables
+    table.create_index(table.table, [watermark])
+    table.create_index(table.table, [id_col], where="full_address IS NULL", name=table.table + "_pending_idx")
+
+    if value is None:
+        print('No watermark for "{}.{}", processing the whole table.'.format(table.table, watermark))
+        return None
+
+    print('Processing permits with {} on or after {}.'.format(watermark, value))
+
+    return "{watermark} >= {value} OR full_address IS NULL".format(watermark=watermark, value=table._literal(value))
+
+
+def high_water(data, watermark, current=None):
+    """
+    Returns the largest value of the watermark column in data, or current
+    if that is larger or data has no values.
+    """
+
+    values = pd.to_datetime(data[watermark]).dropna() if watermark in data.columns else pd.Series(dtype=object)
+    current = pd.to_datetime(current) if current is not None else None
+
+    if values.empty:
+        return current
+
+    return values.max() if current is None or values.max() > current else current
+
+
+def run_streaming(table, id_col, types_dict, chunksize, timer, cache=None, sql=None, watermark=None,
+                  compact=False, where=None):
+    """
+    Processes the table in chunks of at most chunksize rows. Each chunk is
+    transformed and written back before the next one is fetched, so peak
+    memory is bounded by the chunk size rather than the table size. where
+    is the condition of sql, if any.
+
+    Returns the high-water mark of the watermark column over all chunks,
+    if a watermark column is given.
+    """
+
+    # Add derived columns up front: ALTER TABLE cannot run while the
+    # server-side cursor below holds a lock on the table
+    add_derived_columns(table, types_dict)
+
+    chunks = table.iter_chunks(sql=sql, chunksize=chunksize, compact=compact)
+    high, gazetteer = None, None
+
+    while True:
+        start = time.perf_counter()
+        data = next(chunks, None)
+
+        if data is None:
+            break
+
+        timer.add("fetch_data", time.perf_counter() - start, len(data))
+        baseline = fingerprint(data)
+
+        if watermark:
+            high = high_water(data, watermark, high)
+
+        # Permits already geocoded by earlier runs cover every chunk; built
+        # once, on the first chunk with permits to geocode
+        if gazetteer is None and data['latitude_longitude'].isnull().any():
+            pending = "latitude_longitude IS NULL" + (" AND ({})".format(where) if where else "")
+            gazetteer = nearby_gazetteer(table, pending)
+
+        data = transform(data, timer, cache=cache, gazetteer=gazetteer)
+        timer.written(timer.run("update_values", table.update_values, data, id_col=id_col,
+                                types_dict=types_dict, update_schema=False, baseline=baseline))
+
+    return high
+
+
+def run_in_database(table, id_col, types_dict, timer, cache=None, where=None, watermark=None):
+    """
+    Runs create_full_address and split_lat_long as a single UPDATE inside
+    PostgreSQL (see transform_sql), so no rows are fetched to build
+    addresses or parse coordinates. Only permits still missing coordinates
+    are then fetched to be geocoded and written back.
+
+    Returns the high-water mark of the watermark column over the rows
+    selected by where, if a watermark column is given.
+    """
+
+    add_derived_columns(table, types_dict)
+
+    text_columns = table.schema.loc[table.schema['sql_type'].str.match(r'(VARCHAR|CHAR|TEXT)'), 'column_name'].tolist()
+    sql = transform_sql(table.table, text_columns=text_columns, where=where)
+
+    start = time.perf_counter()
+    rows = table._run_query(sql, msg='Transformed "{}" in the database.'.format(table.table))
+    timer.add("transform_sql", time.perf_counter() - start, rows or 0)
+    columns = [*full_address_sql(text_columns), *lat_long_sql()]
+    timer.written({"rows": rows or 0, "columns": columns if rows else [], "failed": rows is None})
+
+    high = max_watermark(table, watermark, where) if watermark else None
+
+    # Geocode what SQL could not fill
+    geocode_pending(table, id_col, types_dict, timer, cache=cache, where=where)
+
+    return high
+
+
+def max_watermark(table, watermark, where=None):
+    """
+    Returns the largest value of the watermark column over the rows
+    selected by where.
+    """
+
+    selected = " WHERE {}".format(where) if where else ""
+    value = table.fetch_data("SELECT max({}) AS high FROM {}{};".format(watermark, table.table, selected))
+
+    return high_water(value, "high")
+
+
+def geocode_pending(table, id_col, types_dict, timer, cache=None, where=None):
+    """
+    Fetches the permits with an address but still without coordinates
+    after the transform, geocodes them and writes them back.
+    """
+
+    pending = "latitude_longitude IS NULL AND full_address IS NOT NULL" + (" AND ({})".format(where) if where else "")
+    start = time.perf_counter()
+    data = table.fetch_data("SELECT * FROM {} WHERE {};".format(table.table, pending))
+    timer.add("fetch_data", time.perf_counter() - start, len(data))
+
+    if len(data):
+        baseline = fingerprint(data)
+        gazetteer = nearby_gazetteer(table, pending)
+
+        data = timer.run("geocode_from_address", geocode_from_address, data, cache=cache, gazetteer=gazetteer)
+        data = timer.run("split_lat_long", split_lat_long, data)
+        timer.written(timer.run("update_values", table.update_values, data, id_col=id_col,
+                                types_dict=types_dict, update_schema=False, baseline=baseline))
+
+
+def run_parallel(table, id_col, types_dict, workers, timer, cache=None, partition_by=None, where=None,
+                 watermark=None):
+    """
+    Runs create_full_address and split_lat_long on partitions of the table
+    in worker processes (see transform_parallel), each fetching and
+    writing back its own rows. Geocoding stays in this process, once for
+    all partitions, to keep a single request rate, cache and gazetteer.
+
+    Returns the high-water mark of the watermark column over the rows
+    selected by where, if a watermark column is given.
+    """
+
+    add_derived_columns(table, types_dict)
+
+    high = max_watermark(table, watermark, where) if watermark else None
+
+    # Stage seconds are summed over workers; transform_parallel is wall time
+    start, rows = time.perf_counter(), 0
+    try:
+        for result in transform_parallel(table, id_col, types_dict, workers=workers, by=partition_by, where=where):
+            for stage, seconds in result["seconds"].items():
+                timer.add(stage, seconds, result["rows"])
+            timer.written(result["written"])
+            rows += result["rows"]
+    except RuntimeError as e:
+        print("Error:", e)
+        timer.written({"rows": 0, "columns": [], "failed": True})
+    timer.add("transform_parallel", time.perf_counter() - start, rows)
+
+    geocode_pending(table, id_col, types_dict, timer, cache=cache, where=where)
+
+    return high
+
+
+def regeocode(data, cache=None, gazetteer=None):
+    """
+    Clears the coordinates of flagged permits and geocodes them again.
+    Their cached locations are dropped first, so they are resolved from
+    gazetteer or the geocoder rather than the suspect cache entry.
+    """
+
+    if cache is not None:
+        cache.delete(data['address_key'].dropna().unique().tolist())
+
+    data['latitude_longitude'] = None
+    data['latitude'] = np.nan
+    data['longitude'] = np.nan
+
+    data = geocode_from_address(data, cache=cache, gazetteer=gazetteer)
+
+    return split_lat_long(data)
+
+
+def check_coordinates(table, id_col, types_dict, timer, cache=None, where=None):
+    """
+    Validates the coordinates of the table (see validate_coordinates) and
+    re-geocodes the permits flagged for the first time. Flags are stored
+    in coordinate_flags, so permits flagged by earlier runs are not sent
+    again and geocoding cost follows the number of bad coordinates rather
+    than the table size. Only the columns needed are fetched; with where,
+    only the selected permits are validated, and only the permits sharing
+    their census tract, zip code or coordinates are fetched as neighbors.
+    """
+
+    add_derived_columns(table, types_dict)
+
+    columns = [id_col, "full_address", "address_key", "street_name", "census_tract", "zip_code", "latitude_longitude",
+               "latitude", "longitude", "coordinate_flags"]
+
+    if where:
+        # Every group validate_coordinates compares a selected permit with
+        sql = """
+        WITH selected AS (SELECT census_tract, zip_code, latitude, longitude FROM {table} WHERE {where})
+        SELECT {columns}, ({where}) AS selected FROM {table}
+        WHERE ({where})
+            OR census_tract IN (SELECT census_tract FROM selected)
+            OR zip_code IN (SELECT zip_code FROM selected)
+            OR (latitude, longitude) IN (SELECT latitude, longitude FROM selected);
+        """.format(table=table.table, where=where, columns=', '.join(columns))
+    else:
+        sql = "SELECT {}, TRUE AS selected FROM {};".format(', '.join(columns), table.table)
+
+    start = time.perf_counter()
+    data = table.fetch_data(sql=sql, coerce_float=True)
+    timer.add("fetch_data", time.perf_counter() - start, len(data))
+
+    selected = data.pop("selected").fillna(False).astype(bool).to_numpy()
+
+    if not selected.any():
+        return
+
+    flags = data["coordinate_flags"].copy()
+    previous = flags.notnull().to_numpy()
+    baseline = fingerprint(data)
+
+    data = timer.run("validate_coordinates", validate_coordinates, data)
+    routed = data["coordinate_flags"].notnull().to_numpy() & ~previous & selected
+
+    if routed.any():
+        print("Re-geocoding {} permits with suspicious coordinates.".format(routed.sum()))
+
+        # Neighbors with sound coordinates only
+        sound = data[data["coordinate_flags"].isnull()].dropna(subset=["address_key", "latitude", "longitude"])
+        gazetteer = LocalGazetteer(sound["address_key"], sound["latitude"], sound["longitude"])
+
+        fixed = timer.run("regeocode", regeocode, data[routed].copy(), cache=cache, gazetteer=gazetteer)
+        for column in ["latitude_longitude", "latitude", "longitude"]:
+            data.loc[routed, column] = fixed[column].to_numpy()
+
+        # Permits still suspect keep their flag and are not sent again
+        data = timer.run("validate_coordinates", validate_coordinates, data)
+
+    # Neighbors may be missing some of their own groups; keep their flags
+    data["coordinate_flags"] = data["coordinate_flags"].where(selected, flags)
+
+    timer.written(timer.run("update_values", table.update_values, data, id_col=id_col, types_dict=types_dict,
+                            update_schema=False, baseline=baseline))
+
+
+def main(name=None, id_col=None, replace_map=replace_map, types_dict=types_dict, chunksize=None,
+         incremental=False, watermark="status_date", in_database=False, swap_types=False,
+         compact=False, profile=None, workers=None, partition_by=None):
+
+    # profile=True prints spans at the end, a path also writes them as JSON
+    if profile:
+        profiling.enable()
 
     permits_raw = Table(name=name, id_col=id_col)
     permits_raw.format_table_names(replace_map=replace_map, update=True)
-    permits_raw.update_types(types_dict=types_dict)
-    data = permits_raw.fetch_data()
-    data = create_full_address(data)
-    geocode_from_address(data)
-    data = split_lat_long(data)
-    permits_raw.update_values(data=data, id_col=id_col, types_dict=types_dict)
+    permits_raw.update_types(types_dict=types_dict, swap=swap_types)
+
+    timer = StageTimer()
+    cache = GeocodeCache()
+
+    # Incremental runs only fetch permits changed since the last run
+    sql, where, gazetteer, high = None, None, None, None
+    if incremental:
+        add_derived_columns(permits_raw, types_dict)
+        where = incremental_filter(permits_raw, id_col, watermark)
+        if where:
+            sql = "SELECT * FROM {} WHERE {};".format(permits_raw.table, where)
+        high = permits_raw.get_watermark(watermark)
+
+    if in_database:
+        high = run_in_database(permits_raw, id_col=id_col, types_dict=types_dict, timer=timer, cache=cache,
+                               where=where, watermark=watermark if incremental else None) or high
+    elif workers:
+        high = run_parallel(permits_raw, id_col=id_col, types_dict=types_dict, workers=workers, timer=timer,
+                            cache=cache, partition_by=partition_by, where=where,
+                            watermark=watermark if incremental else None) or high
+    elif chunksize:
+        high = run_streaming(permits_raw, id_col=id_col, types_dict=types_dict, chunksize=chunksize, timer=timer,
+                             cache=cache, sql=sql, watermark=watermark if incremental else None,
+                             compact=compact, where=where) or high
+    else:
+        start = time.perf_counter()
+        data = permits_raw.fetch_data(sql=sql, compact=compact, report=compact)
+        timer.add("fetch_data", time.perf_counter() - start, len(data))
+
+        if len(data):
+            baseline = fingerprint(data)
+            high = high_water(data, watermark, high) if incremental else None
+
+            # Permits geocoded by earlier runs, near the selected ones only
+            if incremental and data['latitude_longitude'].isnull().any():
+                pending = "latitude_longitude IS NULL" + (" AND ({})".format(where) if where else "")
+                gazetteer = nearby_gazetteer(permits_raw, pending)
+
+            data = transform(data, timer, cache=cache, gazetteer=gazetteer)
+            timer.written(timer.run("update_values", permits_raw.update_values, data, id_col=id_col,
+                                    types_dict=types_dict, baseline=baseline))
+        else:
+            print('No permits to process in "{}".'.format(permits_raw.table))
+
+    check_coordinates(permits_raw, id_col=id_col, types_dict=types_dict, timer=timer, cache=cache, where=where)
+
+    # Only advance the watermark once every row up to it was written;
+    # after a failed write the next run selects the same permits again
+    if incremental and high is not None:
+        if timer.failures:
+            print('Error: watermark "{}" not advanced, {} writes failed.'.format(watermark, timer.failures))
+        else:
+            permits_raw.set_watermark(watermark, pd.Timestamp(high).date())
+
+    timer.summary()
+    print("Geocode cache hits: {hits}, negative hits: {negative_hits}, misses: {misses}.".format(**cache.stats))
+
+    # Connection setup is paid once; everything else reuses the pool
+    stats = permits_raw.pool_stats()
+    print("Database connections opened: {opened}, reused: {reused}.".format(**stats))
+
+    if profiling.enabled():
+        profiling.report()
+        path = profile if isinstance(profile, str) else profiling.output_path()
+        if path:
+            profiling.dump(path)
 
     return
 
@@ -36,6 +479,32 @@ if __name__ == '__main__':
     # load up the .env entries as environment variables
     #load_dotenv(find_dotenv())
 
-    params = {"name": "permits_raw", "id_col": "pcis_permit_no", "replace_map": replace_map, "types_dict": types_dict}
+    parser = argparse.ArgumentParser(description="Transform and geocode permits data.")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Process the table in streaming chunks of this many rows")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process permits new or changed since the last incremental run")
+    parser.add_argument("--watermark", default="status_date",
+                        help="Date column used as the high-water mark of incremental runs")
+    parser.add_argument("--in-database", action="store_true",
+                        help="Build addresses and split coordinates with SQL inside PostgreSQL")
+    parser.add_argument("--swap-types", action="store_true",
+                        help="Migrate column types by copying into a new table instead of ALTER TABLE")
+    parser.add_argument("--profile", nargs="?", const=True, default=None, metavar="JSON",
+                        help="Print time, rows, bytes and peak memory per stage and SQL statement; "
+                             "also write them to JSON if a path is given (or set PERMITS_PROFILE)")
+    parser.add_argument("--compact", action="store_true",
+                        help="Fetch columns as memory-efficient dtypes and report bytes saved per column")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Transform partitions of the table in this many processes")
+    parser.add_argument("--partition-by", default=None, metavar="COLUMN",
+                        help="Partition by a hash of this column (eg. zip_code) instead of ranges of rows")
+    args = parser.parse_args()
+
+    params = {"name": "permits_raw", "id_col": "pcis_permit_no", "replace_map": replace_map, "types_dict": types_dict,
+              "chunksize": args.chunksize, "incremental": args.incremental, "watermark": args.watermark,
+              "in_database": args.in_database, "swap_types": args.swap_types,
+              "compact": args.compact, "profile": args.profile, "workers": args.workers,
+              "partition_by": args.partition_by}
 
-    main(**params)
\ No newline at end of file
+    main(**params)
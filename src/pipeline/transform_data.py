@@ -1,54 +1,400 @@
 import os
+import re
 import sys
+import warnings
 from pathlib import Path
 import numpy as np
 import pandas as pd
 
 # Set path for modules
 sys.path[0] = str(Path(__file__).resolve().parents[2]) 
+from src.pipeline.dictionaries import la_boundary, outlier_distances
+from src.toolkits.addresses import address_key, address_key_sql, normalize_street_name
+from src.toolkits.geospatial import haversine, point_in_polygon
 
 # default='warn'; turn off SettingWithCopyWarning
 pd.options.mode.chained_assignment = None
 
 
+# Address columns concatenated into full_address, in order
+address_columns = ["address_start", "street_direction", "street_name", "street_suffix", "suffix_direction",
+                   "zip_code"]
+
+
+def _factorize_text(series):
+    """
+    Converts a column to stripped strings with runs of whitespace collapsed.
+    String operations run once per distinct value rather than once per row.
+    Returns integer codes and an array of distinct strings; code -1 (missing
+    values) maps to the empty string at the end of the array. Whole-number
+    floats (integer columns holding NaN) are written without a decimal part.
+    """
+
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques)
+
+    if pd.api.types.is_float_dtype(uniques) and (uniques % 1 == 0).all():
+        uniques = uniques.astype('int64')
+
+    text = uniques.astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    return codes, np.append(text.to_numpy(dtype=object), '')
+
+
 # Concatenate address columns into full_address column
 def create_full_address(data):
 
+    """
+    Builds full_address from the address columns with column-wise string
+    operations. Missing parts are skipped and runs of whitespace collapse
+    to a single space, eg. "123 N MAIN ST 90012". Also adds address_key,
+    the normalized form of the address (see toolkits.addresses).
+    """
+
     # Truncate suffix_direction to first letter (N, S, E, W)
-    data['suffix_direction'] = data['suffix_direction'].str[0].fillna('')
+    codes, text = _factorize_text(data['suffix_direction'])
+    data['suffix_direction'] = pd.Series(text, dtype=object).str[0].to_numpy()[codes]
 
-    # Convert zip_code to string
-    data['zip_code'] = data['zip_code'].fillna(0).replace(0, '').astype(object)
+    # Treat zip code 0 as missing
+    zero = (data['zip_code'] == 0).fillna(False).astype(bool)
+    data['zip_code'] = data['zip_code'].mask(zero)
 
-    # Combine address columns to concatenate
-    address_columns = ["address_start", "street_direction", "street_name", "street_suffix", "suffix_direction",
-                      "zip_code"]
+    # Concatenate address values column by column; each non-empty part is
+    # prefixed with its separator so missing parts add nothing
+    full_address = np.full(len(data), '', dtype=object)
 
-    # Concatenate address values
-    data['full_address'] = data[address_columns].fillna('').astype(str).apply(' '.join, axis=1).str.replace('  ', ' ')
+    for column in address_columns:
+        codes, text = _factorize_text(data[column])
+        text = np.where(text != '', ' ' + text, '')
+        full_address = full_address + text[codes]
+
+    data['full_address'] = pd.Series(full_address, index=data.index, dtype=object).str[1:]
 
     # Replace empty strings with NaN values
-    data[address_columns] = data[address_columns].replace('', np.nan)
+    text_columns = [column for column in address_columns if data[column].dtype == object]
+    data[text_columns] = data[text_columns].replace('', np.nan)
+
+    if pd.api.types.is_numeric_dtype(data['zip_code']):
+        data['zip_code'] = data['zip_code'].astype('Int64')
 
-    data['zip_code'] = data['zip_code'].astype('Int64')
+    data['address_key'] = address_key(data)
     
     return data
 
 
+# Plain decimal number, without exponent, "inf" or "nan". The byte-level
+# parser, lat_long_pattern and lat_long_sql_pattern all accept exactly this
+_number = r'[-+]?(?:\d+\.?\d*|\.\d+)'
+
+# Single "(latitude, longitude)" value; used for values the byte-level
+# parser rejects
+lat_long_pattern = re.compile(r'^\s*\(\s*({0})\s*,\s*({0})\s*\)\s*$'.format(_number))
+
+# Bytes a well-formed value may contain
+_lat_long_bytes = np.zeros(256, dtype=bool)
+_lat_long_bytes[np.frombuffer(b'0123456789.+-(), \t\r\f\v', dtype=np.uint8)] = True
+
+
+def _lat_long_buffer(text):
+    """
+    Joins values into one ASCII byte buffer, one value per line. Returns the
+    buffer and a mask of values wrapped in parentheses with exactly one
+    comma. Non-ASCII text or embedded line breaks mark every value invalid.
+    """
+
+    n = len(text)
+    valid = np.zeros(n, dtype=bool)
+
+    try:
+        buffer = np.frombuffer('\n'.join(text).encode('ascii'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None, valid
+
+    newlines = np.flatnonzero(buffer == ord('\n'))
+    if n == 0 or len(newlines) != n - 1:
+        return None, valid
+
+    starts = np.r_[0, newlines + 1]
+    ends = np.r_[newlines, len(buffer)]
+
+    # Shortest value is "(0,0)"
+    valid = ends - starts >= 5
+    valid &= buffer[np.minimum(starts, len(buffer) - 1)] == ord('(')
+    valid &= buffer[np.maximum(ends - 1, 0)] == ord(')')
+
+    # One of each delimiter per line
+    for char in '(),':
+        line = np.searchsorted(newlines, np.flatnonzero(buffer == ord(char)))
+        valid &= np.bincount(line, minlength=n) == 1
+
+    # Only digits, signs, decimal points and spaces between them, so float
+    # parsing cannot accept exponents, "inf" or "nan"
+    other = np.flatnonzero(~_lat_long_bytes[buffer] & (buffer != ord('\n')))
+    valid &= np.bincount(np.searchsorted(newlines, other), minlength=n) == 0
+
+    return buffer, valid
+
+
+def _parse_lat_long_buffer(buffer):
+    """
+    Converts a buffer of well-formed lines to an (n, 2) float64 array in a
+    single call. If a value is not a number (eg. "1 5" or "1..2"), the
+    fields are converted again one by one, with NaN for the bad ones only.
+    """
+
+    # Blank out parentheses and turn line breaks into commas: "lat,lon,lat,lon..."
+    values = buffer.copy()
+    values[(values == ord('(')) | (values == ord(')'))] = ord(' ')
+    values[values == ord('\n')] = ord(',')
+
+    fields = values.tobytes().split(b',')
+
+    try:
+        return np.array(fields, dtype=np.float64).reshape(-1, 2)
+    except ValueError:
+        fields = pd.Series(fields, dtype=object).str.decode('ascii')
+        return pd.to_numeric(fields, errors='coerce').to_numpy(dtype=np.float64).reshape(-1, 2)
+
+
+def parse_lat_long(series):
+    """
+    Parses "(latitude, longitude)" strings into two float64 arrays with a
+    byte-level parser over all values at once. Values that are present but
+    malformed come back as NaN and are flagged in the returned mask.
+
+    Returns
+    -------
+    latitude, longitude : numpy arrays of float64
+    malformed : numpy array of bool
+    """
+
+    present = series.notnull().to_numpy()
+    text = series[present].astype(str).to_numpy(dtype=object)
+
+    parsed = np.full((len(text), 2), np.nan)
+    pending = np.ones(len(text), dtype=bool)
+
+    # Bulk parse the well-formed values
+    buffer, valid = _lat_long_buffer(text)
+
+    if valid.any():
+        if not valid.all():
+            buffer, _ = _lat_long_buffer(text[valid])
+
+        # Values the bulk parse could not convert are retried below
+        values = _parse_lat_long_buffer(buffer)
+        parsed[valid] = values
+        pending = ~valid
+        pending[valid] = np.isnan(values).any(axis=1)
+
+    # Anything left falls back to a regular expression per value
+    for i in np.flatnonzero(pending):
+        match = lat_long_pattern.match(text[i])
+        if match:
+            parsed[i] = float(match.group(1)), float(match.group(2))
+
+    latitude = np.full(len(series), np.nan)
+    longitude = np.full(len(series), np.nan)
+    latitude[present] = parsed[:, 0]
+    longitude[present] = parsed[:, 1]
+
+    malformed = present & ~(np.isfinite(latitude) & np.isfinite(longitude))
+    latitude[malformed] = np.nan
+    longitude[malformed] = np.nan
+
+    return latitude, longitude, malformed
+
+
 def split_lat_long(data):
+
+    """
+    Adds float latitude and longitude columns parsed from latitude_longitude.
+    Columns are added in place. On re-runs only rows without coordinates
+    are parsed, so running it twice is cheap and gives the same result.
+    Malformed values and rows that could not be geocoded are reported and
+    left as NaN.
+    """
     
-    # Check that there are no more missing coordinates before proceeding
-    if data['latitude_longitude'].isnull().any(): 
-        raise AssertionError("Missing coordinates must be geocoded.")
-
-    # Split latitude_longitude into separate columns and convert to float values: latitude, longitude
-    if ['latitude', 'longitude'] not in data.columns.tolist():
-        lat_long_series = data['latitude_longitude'].astype(str).str[1:-1].str.split(',', expand=True) \
-                            .astype(float).rename(columns={0: "latitude", 1: "longitude"})
-
-        # Add to original data
-        ### Add drop duplicate columns
-        return pd.concat([data, lat_long_series], axis=1)
-    
+    # Rows the geocoder could not resolve (or cached as failures) stay empty
+    num_missing = data['latitude_longitude'].isnull().sum()
+    if num_missing: 
+        warnings.warn("{} rows have no coordinates after geocoding and were left empty.".format(num_missing))
+
+    # Parse only rows not already split, eg. when the columns were fetched from the table
+    if {'latitude', 'longitude'}.issubset(data.columns):
+        data['latitude'] = data['latitude'].astype(float)
+        data['longitude'] = data['longitude'].astype(float)
+        pending = (data['latitude'].isnull() | data['longitude'].isnull()).to_numpy()
     else:
-        return None
+        data['latitude'] = np.nan
+        data['longitude'] = np.nan
+        pending = np.ones(len(data), dtype=bool)
+
+    if not pending.any():
+        return data
+
+    latitude, longitude, malformed = parse_lat_long(data.loc[pending, 'latitude_longitude'])
+
+    data.loc[pending, 'latitude'] = latitude
+    data.loc[pending, 'longitude'] = longitude
+
+    if malformed.any():
+        examples = data.loc[pending, 'latitude_longitude'][malformed].unique()[:5].tolist()
+        warnings.warn("{} latitude_longitude values could not be parsed and were left empty, eg. {}"
+                      .format(malformed.sum(), examples))
+
+    return data
+
+
+def validate_coordinates(data, boundary=la_boundary, distances=outlier_distances, min_group=5, max_streets=2):
+
+    """
+    Flags suspicious latitude and longitude values in a coordinate_flags
+    column, as a comma separated list of:
+
+    outside : outside the boundary polygon, eg. (0, 0)
+    outlier : further than distances[column] meters from the median of
+              the permits with the same value of column (eg. census_tract,
+              zip_code), in groups of at least min_group permits
+    shared  : exactly the same coordinates as permits on more than
+              max_streets different streets, eg. a geocoder fallback to the
+              center of the city
+
+    Rows without coordinates or flags are None. Groups are formed from the
+    rows of data only, so pass enough of the table for them to be
+    meaningful.
+    """
+
+    latitude = data['latitude'].astype(float).to_numpy()
+    longitude = data['longitude'].astype(float).to_numpy()
+    known = ~(np.isnan(latitude) | np.isnan(longitude))
+    flags = {}
+
+    flags['outside'] = known & ~point_in_polygon(latitude, longitude, boundary)
+
+    # Medians from points inside the boundary only, so far-off points do not drag them
+    points = pd.DataFrame({"latitude": latitude, "longitude": longitude})
+    inside = known & ~flags['outside']
+    flags['outlier'] = np.zeros(len(data), dtype=bool)
+
+    for column, distance in distances.items():
+        if column not in data.columns:
+            continue
+
+        group = points.assign(key=data[column].to_numpy())[inside & data[column].notnull().to_numpy()]
+        grouped = group.groupby("key")
+        medians = grouped[["latitude", "longitude"]].transform("median")
+        far = haversine(medians["latitude"].to_numpy(), medians["longitude"].to_numpy(),
+                        group["latitude"].to_numpy(), group["longitude"].to_numpy()) > distance
+
+        flags['outlier'][group.index.to_numpy()] |= far & (grouped["latitude"].transform("size") >= min_group).to_numpy()
+
+    flags['shared'] = np.zeros(len(data), dtype=bool)
+    if 'street_name' in data.columns:
+        shared = points.assign(street=normalize_street_name(data['street_name']).to_numpy())[known]
+        streets = shared.groupby(["latitude", "longitude"])["street"].transform("nunique")
+        flags['shared'][shared.index.to_numpy()] = (streets > max_streets).to_numpy()
+
+    text = np.full(len(data), '', dtype=object)
+    for flag, mask in flags.items():
+        text = np.where(mask, text + ',' + flag, text)
+
+    text = pd.Series(text, index=data.index, dtype=object)
+    data['coordinate_flags'] = text.str[1:].where(text != '', None)
+
+    flagged = (text != '').sum()
+    if flagged:
+        warnings.warn("{} rows have suspicious coordinates: {}.".format(
+            flagged, {flag: int(mask.sum()) for flag, mask in flags.items() if mask.any()}))
+
+    return data
+
+
+#### In-database transforms ####
+# The same transforms compiled to SQL expressions, so a full-table run can
+# execute as one UPDATE inside PostgreSQL without fetching any rows.
+# Numeric columns are expected to have their types from types_dict.
+
+# Numbers accepted by the byte-level parser (see _number)
+_sql_number = '({})'.format(_number)
+lat_long_sql_pattern = r'^\s*\(\s*{0}\s*,\s*{0}\s*\)\s*$'.format(_sql_number)
+
+
+def _sql_text(expression):
+    """
+    SQL for a value as text with runs of whitespace collapsed and stripped,
+    NULL if nothing is left (see _factorize_text).
+    """
+
+    return "NULLIF(btrim(regexp_replace(({})::text, '\\s+', ' ', 'g')), '')".format(expression)
+
+
+def full_address_sql(text_columns=()):
+    """
+    Returns {column: SQL expression} for the columns set by
+    create_full_address: suffix_direction truncated to its first letter,
+    zip code 0 as NULL, empty strings in text_columns as NULL,
+    full_address joined with concat_ws, which skips NULL parts, and
+    address_key normalized from the new values.
+    """
+
+    expressions = {
+        "suffix_direction": "left({}, 1)".format(_sql_text("suffix_direction")),
+        "zip_code": "CASE WHEN zip_code::text = '0' THEN NULL ELSE zip_code END",
+    }
+
+    for column in text_columns:
+        if column in address_columns and column not in expressions:
+            expressions[column] = "NULLIF({}, '')".format(column)
+
+    parts = [_sql_text(expressions.get(column, column)) for column in address_columns]
+    expressions["full_address"] = "NULLIF(concat_ws(' ', {}), '')".format(', '.join(parts))
+    expressions["address_key"] = address_key_sql(expressions)
+
+    return expressions
+
+
+def lat_long_sql():
+    """
+    Returns {column: SQL expression} for the columns set by split_lat_long.
+    Only rows missing either coordinate are parsed, malformed values give
+    NULL.
+    """
+
+    match = "regexp_match(latitude_longitude, '{}')".format(lat_long_sql_pattern)
+    pending = "latitude IS NULL OR longitude IS NULL"
+
+    return {
+        "latitude": "CASE WHEN {} THEN ({})[1]::numeric ELSE latitude END".format(pending, match),
+        "longitude": "CASE WHEN {} THEN ({})[2]::numeric ELSE longitude END".format(pending, match),
+    }
+
+
+def transform_sql(table, text_columns=(), where=None):
+    """
+    Compiles create_full_address and split_lat_long to a single UPDATE of
+    table. Rows whose values would not change are skipped, so re-runs
+    write nothing.
+
+    Params
+    ------
+    table : str
+        Table with the address columns, latitude_longitude and the derived
+        columns full_address, latitude and longitude
+
+    text_columns : list of str
+        Columns with a text type, their empty strings are set to NULL
+
+    where : str
+        Optional condition limiting the rows transformed
+    """
+
+    expressions = {**full_address_sql(text_columns), **lat_long_sql()}
+
+    assignments = ',\n\t'.join('{} = {}'.format(column, expression) for column, expression in expressions.items())
+    changed = "({}) IS DISTINCT FROM ({})".format(', '.join(expressions),
+                                                  ',\n\t'.join(expressions.values()))
+
+    return "UPDATE {table} SET\n\t{assignments}\nWHERE {changed}{where};\n".format(
+        table=table, assignments=assignments, changed=changed,
+        where=" AND ({})".format(where) if where else "")
@@ -0,0 +1,337 @@
+import re
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+from src.pipeline.dictionaries import street_suffix_map, direction_map, unit_designators, fraction_map
+
+# Parts of address_key, in order
+key_columns = ["address_start", "address_fraction_start", "street_direction", "street_name", "street_suffix",
+               "suffix_direction", "zip_code"]
+
+# Trailing unit of a street name, eg. "MAIN ST APT 4" or "MAIN ST #4B".
+# Written so Python and PostgreSQL regular expressions agree
+unit_pattern = r'(\s({})\s+|\s*#\s*)[A-Z0-9-]+$'.format('|'.join(unit_designators))
+_unit = re.compile(unit_pattern)
+
+# Lookups are applied to folded values: upper case without periods or spaces
+_code_fold = re.compile(r'[.\s]+')
+_fraction = re.compile(r'^[0-9]+/[0-9]+$')
+_zip = re.compile(r'^([0-9]{5})')
+
+
+#### Vectorized normalization ####
+# Each function normalizes the distinct values of a column only, then maps
+# them back to rows by their codes, so cost grows with the number of
+# distinct values rather than rows.
+
+def _distinct(series):
+    """
+    Factorizes a column into integer codes and its distinct values as
+    stripped strings. Whole-number floats (integer columns holding NaN)
+    are written without a decimal part.
+    """
+
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques)
+
+    if pd.api.types.is_float_dtype(uniques) and (uniques % 1 == 0).all():
+        uniques = uniques.astype('int64')
+
+    return codes, uniques.astype(str).str.strip()
+
+
+def _codes(series, func):
+    """
+    Normalizes the distinct values of a column with func. Returns a code
+    per row, equal for values that normalize alike and -1 where missing
+    or normalized to '', and the normalized values.
+    """
+
+    codes, values = _distinct(series)
+    normalized = np.asarray(func(values), dtype=object)
+    normalized_codes, uniques = pd.factorize(np.where(normalized == '', None, normalized))
+
+    return np.append(normalized_codes, -1)[codes], np.asarray(uniques, dtype=object)
+
+
+def _normalize(series, func):
+    codes, uniques = _codes(series, func)
+    return pd.Series(np.append(uniques, None)[codes], index=series.index, dtype=object)
+
+
+def _lookup(values, table):
+    folded = values.str.upper().str.replace(_code_fold, '', regex=True)
+    return folded.map(lambda value: table.get(value, value))
+
+
+def _directions(values):
+    return _lookup(values, direction_map)
+
+
+def _suffixes(values):
+    return _lookup(values, street_suffix_map)
+
+
+def _fractions(values):
+    values = values.str.replace(r'\s+', '', regex=True)
+    for character, fraction in fraction_map.items():
+        values = values.str.replace(character, fraction, regex=False)
+
+    return values.where(values.str.match(_fraction), '')
+
+
+def _street_names(values):
+    values = values.str.upper().str.replace('.', '', regex=False).str.replace(r'[,\s]+', ' ', regex=True)
+    return values.str.strip().str.replace(_unit, '', regex=True).str.strip()
+
+
+def _zips(values):
+    return values.str.extract(_zip, expand=False).fillna('')
+
+
+def _numbers(values):
+    return values
+
+
+def normalize_direction(series):
+    """
+    Abbreviates directions, eg. "North", "n." -> "N", "South West" -> "SW".
+    Unknown values are kept folded to upper case.
+    """
+
+    return _normalize(series, _directions)
+
+
+def normalize_suffix(series):
+    """
+    Abbreviates street suffixes, eg. "Avenue", "AV" -> "AVE".
+    """
+
+    return _normalize(series, _suffixes)
+
+
+def normalize_fraction(series):
+    """
+    Normalizes address fractions, eg. " 1 / 2", "½" -> "1/2". Values that
+    are not a fraction are dropped.
+    """
+
+    return _normalize(series, _fractions)
+
+
+def normalize_street_name(series):
+    """
+    Folds street names to upper case without periods or commas and with
+    single spaces, and strips a trailing unit, eg. "St. Andrews Pl, Apt 4"
+    -> "ST ANDREWS PL".
+    """
+
+    return _normalize(series, _street_names)
+
+
+def normalize_zip(series):
+    """
+    Keeps the five-digit ZIP code, eg. 90012.0, "90012-1234" -> "90012".
+    Zero and malformed codes are dropped.
+    """
+
+    return _normalize(series, _zips)
+
+
+def normalize_number(series):
+    return _normalize(series, _numbers)
+
+
+normalizers = {
+    "address_start": normalize_number,
+    "address_fraction_start": normalize_fraction,
+    "street_direction": normalize_direction,
+    "street_name": normalize_street_name,
+    "street_suffix": normalize_suffix,
+    "suffix_direction": normalize_direction,
+    "zip_code": normalize_zip,
+}
+
+# Normalization of the distinct values of each key column
+_normalizers = {
+    "address_start": _numbers,
+    "address_fraction_start": _fractions,
+    "street_direction": _directions,
+    "street_name": _street_names,
+    "street_suffix": _suffixes,
+    "suffix_direction": _directions,
+    "zip_code": _zips,
+}
+
+
+def address_key(data):
+    """
+    Returns a canonical key for the address of each row, the same for
+    every spelling of a location, eg. "1234 1/2 N MAIN ST S 90012" for
+    "1234", "½", "North", "Main, Apt 4", "Street", "South", 90012.0.
+    Units are left out. Rows without a street name have no key. Columns
+    of key_columns missing from data are skipped.
+
+    Example
+    -------
+    data['address_key'] = address_key(data)
+    """
+
+    columns = [column for column in key_columns if column in data.columns]
+    codes = {column: _codes(data[column], _normalizers[column]) for column in columns}
+
+    # Number the distinct combinations of normalized parts; keys are only
+    # built once per combination
+    groups = np.zeros(len(data), dtype=np.int64)
+    for column in columns:
+        column_codes, uniques = codes[column]
+        groups = pd.factorize(groups * (len(uniques) + 1) + column_codes + 1)[0]
+
+    count = groups.max() + 1 if len(groups) else 0
+    first = np.empty(count, dtype=np.int64)
+    first[groups[::-1]] = np.arange(len(groups) - 1, -1, -1)
+
+    key = np.full(count, '', dtype=object)
+    named = np.zeros(count, dtype=bool)
+
+    for column in columns:
+        column_codes, uniques = codes[column]
+        group_codes = column_codes[first]
+        key = key + np.append(' ' + uniques, '').astype(object)[group_codes]
+        if column == "street_name":
+            named = group_codes >= 0
+
+    key = pd.Series(key, dtype=object).str[1:].where(named, None).to_numpy(dtype=object)
+
+    return pd.Series(key[groups], index=data.index, dtype=object)
+
+
+# Trailing ZIP code of a free-form address, eg. "... 90012" or "... 90012-1234"
+_text_zip = re.compile(r'\s([0-9]{5})(-[0-9]{4})?$')
+
+
+def _fold(value):
+    return _code_fold.sub('', value.upper())
+
+
+def parse_address(address):
+    """
+    Splits a free-form address string into the columns of key_columns,
+    eg. "123 North Main Street, Apt 4, 90012" -> {"address_start": "123",
+    "street_direction": "NORTH", "street_name": "MAIN", "street_suffix":
+    "STREET", "zip_code": "90012"}. Parts are told apart by position and
+    the lookup tables, so a street named like a direction or suffix can be
+    read as one. Units are dropped.
+    """
+
+    text = re.sub(r'[,\s]+', ' ', str(address).replace('.', '')).strip()
+    parts = {}
+
+    match = _text_zip.search(' ' + text)
+    if match:
+        parts["zip_code"] = match.group(1)
+        text = text[:match.start()].strip()
+
+    text = _unit.sub('', text.upper()).strip()
+    tokens = text.split()
+
+    if tokens and tokens[0].isdigit():
+        parts["address_start"] = tokens.pop(0)
+
+    if tokens and _fractions(pd.Series(tokens[:1])).iloc[0]:
+        parts["address_fraction_start"] = tokens.pop(0)
+
+    # Directions may be written in two words, eg. "SOUTH WEST"
+    for count in (2, 1):
+        if len(tokens) > count and _fold(''.join(tokens[:count])) in direction_map:
+            parts["street_direction"], tokens = ' '.join(tokens[:count]), tokens[count:]
+            break
+
+    if len(tokens) > 1 and _fold(tokens[-1]) in direction_map:
+        parts["suffix_direction"] = tokens.pop()
+
+    if len(tokens) > 1 and _fold(tokens[-1]) in street_suffix_map:
+        parts["street_suffix"] = tokens.pop()
+
+    if tokens:
+        parts["street_name"] = ' '.join(tokens)
+
+    return parts
+
+
+def address_key_of(address):
+    """
+    Returns the address_key of one free-form address string, for one-off
+    lookups, eg. in GeocodeCache or LocalGazetteer. Spellings of the same
+    address share a key, eg. "123 N Main Street 90012" and "123 NORTH MAIN
+    ST 90012" -> "123 N MAIN ST 90012". Returns None for missing addresses
+    or without a street name.
+    """
+
+    if address is None or address is pd.NA or (isinstance(address, float) and np.isnan(address)):
+        return None
+
+    parts = parse_address(address)
+
+    return address_key(pd.DataFrame({column: [parts.get(column)] for column in key_columns})).iloc[0]
+
+
+#### SQL ####
+# The same normalization as SQL expressions, for in-database transforms
+
+def _sql_lookup(expression, table):
+    """
+    CASE expression mapping a folded value through table; values without
+    an entry are kept.
+    """
+
+    folded = "NULLIF(upper(regexp_replace(({})::text, '[.\\s]+', '', 'g')), '')".format(expression)
+    branches = ' '.join("WHEN '{}' THEN '{}'".format(key, value) for key, value in table.items() if key != value)
+
+    return "CASE {folded} {branches} ELSE {folded} END".format(folded=folded, branches=branches)
+
+
+def normalize_sql(column, expression=None):
+    """
+    SQL expression normalizing one of key_columns, matching normalizers.
+    expression is the SQL for its value, defaults to the column itself.
+    """
+
+    expression = expression or column
+    text = "btrim(({})::text)".format(expression)
+
+    if column in ("street_direction", "suffix_direction"):
+        return _sql_lookup(expression, direction_map)
+
+    if column == "street_suffix":
+        return _sql_lookup(expression, street_suffix_map)
+
+    if column == "address_fraction_start":
+        fraction = "regexp_replace({}, '\\s+', '', 'g')".format(text)
+        for character, value in fraction_map.items():
+            fraction = "replace({}, '{}', '{}')".format(fraction, character, value)
+        return "substring({} from '{}')".format(fraction, _fraction.pattern)
+
+    if column == "street_name":
+        name = "btrim(regexp_replace(replace(upper({}), '.', ''), '[,\\s]+', ' ', 'g'))".format(text)
+        return "NULLIF(btrim(regexp_replace({}, '{}', '')), '')".format(name, unit_pattern)
+
+    if column == "zip_code":
+        return "substring({} from '^[0-9]{{5}}')".format(text)
+
+    return "NULLIF({}, '')".format(text)
+
+
+def address_key_sql(expressions=None):
+    """
+    SQL expression for address_key. expressions maps key columns to the
+    SQL for their values, eg. after other transforms in the same UPDATE.
+    """
+
+    expressions = expressions or {}
+    parts = [normalize_sql(column, expressions.get(column)) for column in key_columns]
+
+    return "CASE WHEN {} IS NOT NULL THEN NULLIF(concat_ws(' ', {}), '') END".format(
+        normalize_sql("street_name", expressions.get("street_name")), ', '.join(parts))
@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+import numpy as np
+from src.toolkits.postgresql import Database
+from src.toolkits.profiling import span
+
+QUOTE, NEWLINE = ord('"'), ord('\n')
+
+
+def split_csv(path, chunk_bytes=1 << 25, nrows=None, block_size=1 << 24):
+    """
+    Splits a CSV file into chunks of roughly chunk_bytes that end on record
+    boundaries. A newline ends a record only outside a quoted field, ie.
+    after an even number of quotes ("" inside a field counts twice). The
+    header row is skipped. Yields (start, end, rows) byte ranges as the
+    file is scanned, so loading can begin before the scan finishes.
+
+    Params
+    ------
+    path : str
+        CSV file with a header row
+
+    chunk_bytes : int
+        Target size of each chunk
+
+    nrows : int
+        Stop after this many records, eg. to load a sample
+    """
+
+    size = os.path.getsize(path)
+    start, end, rows, total = None, None, 0, 0
+    parity, stop = 0, False
+
+    with open(path, 'rb') as f:
+        for offset in range(0, size, block_size):
+            block = np.frombuffer(f.read(block_size), dtype=np.uint8)
+
+            # Quote parity at every newline, carried over from earlier blocks
+            # (uint8 overflow keeps parity)
+            quotes = np.cumsum(block == QUOTE, dtype=np.uint8)
+            newlines = np.flatnonzero(block == NEWLINE)
+            ends = offset + 1 + newlines[((quotes[newlines] + parity) & 1) == 0]
+            parity = (parity + int(quotes[-1])) & 1
+
+            if start is None and len(ends):
+                start, end, ends = int(ends[0]), int(ends[0]), ends[1:]
+
+            if nrows is not None and total + len(ends) >= nrows:
+                ends, stop = ends[:nrows - total], True
+            total += len(ends)
+
+            # Cut chunks wherever a record end passes chunk_bytes
+            while len(ends):
+                cut = np.searchsorted(ends, start + chunk_bytes)
+                if cut == len(ends):
+                    rows, end = rows + len(ends), int(ends[-1])
+                    break
+
+                yield start, int(ends[cut]), rows + cut + 1
+                start, end, rows, ends = int(ends[cut]), int(ends[cut]), 0, ends[cut + 1:]
+
+            if stop:
+                break
+
+        # Last record may have no trailing newline
+        if start is not None and not stop and end < size:
+            f.seek(end)
+            if f.read().strip():
+                rows, end = rows + 1, size
+
+    if rows:
+        yield start, end, rows
+
+
+class FileRange():
+
+    """
+    File-like view of bytes start to end of a file, as read by
+    cursor.copy_expert.
+    """
+
+    def __init__(self, path, start, end):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _copy_range(db, table, path, start, end):
+    """
+    Copies one chunk of the file into table on its own connection and
+    transaction.
+    """
+
+    stream = FileRange(path, start, end)
+    try:
+        with db._connection() as con, span(table, "copy", bytes=end - start):
+            cur = con.cursor()
+            cur.copy_expert("COPY {} FROM STDIN WITH (FORMAT CSV);".format(table), stream, size=1 << 20)
+            cur.close()
+    finally:
+        stream.close()
+
+
+def load_csv(path, table="permits_raw", workers=4, chunk_bytes=1 << 25, nrows=None):
+    """
+    Loads a raw CSV file into a table created by postgres/init.sql, in
+    chunks copied in parallel over several connections. Prints progress
+    and rows/sec as chunks complete. Each chunk commits on its own, so a
+    failed chunk is reported with its byte range and the others are kept.
+
+    Returns a dictionary with the rows loaded, seconds, rows/sec and the
+    byte ranges of failed chunks.
+
+    Example
+    -------
+    load_csv("data/raw/permits_raw.csv", table="permits_raw", workers=8)
+    """
+
+    db = Database(pool_min=1, pool_max=workers)
+    size = os.path.getsize(path)
+    start_time = time.perf_counter()
+    loaded, done, failed = 0, 0, []
+
+    print('Loading "{}" into "{}" with {} workers...'.format(path, table, workers))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_copy_range, db, table, path, start, end): (start, end, rows)
+                   for start, end, rows in split_csv(path, chunk_bytes=chunk_bytes, nrows=nrows)}
+
+        for future in as_completed(futures):
+            start, end, rows = futures[future]
+
+            try:
+                future.result()
+                loaded += rows
+                done += end - start
+            except Exception as e:
+                print("Error: chunk at bytes {}-{} failed: {}".format(start, end, e))
+                failed.append((start, end))
+                continue
+
+            seconds = time.perf_counter() - start_time
+            print("Loaded {:,} rows ({:.0%} of file) at {:,.0f} rows/sec.".format(loaded, done / size,
+                                                                               loaded / seconds))
+
+    seconds = time.perf_counter() - start_time
+    print('Loaded {:,} rows into "{}" in {:.1f} s ({:,.0f} rows/sec).'.format(loaded, table, seconds,
+                                                                          loaded / seconds if seconds else 0))
+
+    return {"rows": loaded, "seconds": seconds, "rows_per_sec": loaded / seconds if seconds else 0,
+            "failed": failed}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Load a raw permits CSV file into PostgreSQL in parallel.")
+    parser.add_argument("path", help="CSV file with a header row")
+    parser.add_argument("--table", default="permits_raw", help="Table to load, created by postgres/init.sql")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel connections")
+    parser.add_argument("--chunk-mb", type=int, default=32, help="Size of each chunk in MB")
+    parser.add_argument("--nrows", type=int, default=None, help="Only load the first nrows records")
+    args = parser.parse_args()
+
+    report = load_csv(args.path, table=args.table, workers=args.workers, chunk_bytes=args.chunk_mb << 20,
+                      nrows=args.nrows)
+
+    sys.exit(1 if report["failed"] else 0)
@@ -1,15 +1,24 @@
 import os
+import re
 import sys
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv, find_dotenv
+import numpy as np
 import pandas as pd
 import psycopg2 # SQL libraries
 from geopy.geocoders import Nominatim # Geocoding
 from geopy.geocoders import GoogleV3
-from geopy.extra.rate_limiter import RateLimiter
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
 
 
 sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for modules
+from src.toolkits.profiling import span
+from src.toolkits.addresses import address_key, address_key_of
 pd.options.mode.chained_assignment = None  # default='warn'; turn off SettingWithCopyWarning
 
 # find .env automagically by walking up directories until it's found, then
@@ -20,62 +29,870 @@ load_dotenv(find_dotenv());
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_AGENT = os.getenv("GOOGLE_AGENT")
 
+# Errors worth retrying with backoff; anything else fails the address
+RETRY_ERRORS = (GeocoderTimedOut, GeocoderUnavailable, TimeoutError, ConnectionError)
+
+# Geocode cache location, kept with the other intermediate data (ignored by git)
+GEOCODE_CACHE = os.getenv("GEOCODE_CACHE") or \
+                str(Path(__file__).resolve().parents[2] / "data" / "interim" / "geocode_cache.sqlite")
+
+
+
+#### Geocode cache ####
+class GeocodeCache():
+
+    """
+    Persistent cache of geocoding results keyed by address_key (see
+    toolkits.addresses), so every spelling of an address shares one entry,
+    stored in a local SQLite file. Addresses that could not be geocoded are
+    cached as negative results and not retried until negative_ttl expires.
+    Tracks hits and misses in the stats dictionary.
+
+    Example
+    -------
+    cache = GeocodeCache()
+    geocode_from_address(data, cache=cache)
+
+    cache.stats
+    { "hits": 120, "negative_hits": 3, "misses": 8, "stored": 8 }
+
+    Params
+    ------
+    path : string
+        Location of the SQLite file, created if missing
+
+    ttl : int
+        Seconds before a found location expires; None never expires
+
+    negative_ttl : int
+        Seconds before a failed lookup is retried
+    """
+
+    def __init__(self, path=GEOCODE_CACHE, ttl=None, negative_ttl=30 * 24 * 3600):
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "stored": 0}
+
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("""
+        CREATE TABLE IF NOT EXISTS geocodes (
+            address TEXT PRIMARY KEY,
+            latitude REAL,
+            longitude REAL,
+            found INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """)
+        self._con.commit()
+
+    def __len__(self):
+        return self._con.execute("SELECT COUNT(*) FROM geocodes;").fetchone()[0]
+
+    def get_many(self, addresses):
+        """
+        Looks up address keys. Returns a dictionary of key to (latitude,
+        longitude), or None for cached failures. Keys that are not cached or
+        have expired are left out. Use address_key_of for a single address
+        string.
+        """
+
+        now = time.time()
+        results = {}
+        addresses = list(addresses)
+
+        # Stay under SQLite's limit on bound parameters
+        for i in range(0, len(addresses), 500):
+            batch = addresses[i:i + 500]
+            sql = "SELECT address, latitude, longitude, found, updated_at FROM geocodes WHERE address IN ({});" \
+                    .format(','.join('?' * len(batch)))
+
+            for address, latitude, longitude, found, updated_at in self._con.execute(sql, batch):
+                ttl = self.ttl if found else self.negative_ttl
+                if ttl is not None and now - updated_at > ttl:
+                    continue
+                results[address] = (latitude, longitude) if found else None
+
+        self.stats["hits"] += sum(1 for value in results.values() if value is not None)
+        self.stats["negative_hits"] += sum(1 for value in results.values() if value is None)
+        self.stats["misses"] += len(addresses) - len(results)
+
+        return results
+
+    def put_many(self, results):
+        """
+        Stores a dictionary of address key to (latitude, longitude), or
+        None for addresses that could not be geocoded.
+        """
+
+        now = time.time()
+        rows = [(address, *(location or (None, None)), int(location is not None), now)
+                for address, location in results.items()]
+
+        self._con.executemany("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?);", rows)
+        self._con.commit()
+        self.stats["stored"] += len(rows)
+
+        return self
+
+    def delete(self, addresses):
+        """
+        Removes address keys from the cache, eg. when a cached location
+        turned out to be wrong.
+        """
+
+        self._con.executemany("DELETE FROM geocodes WHERE address = ?;", [(address,) for address in addresses])
+        self._con.commit()
+
+        return self
+
+    def close(self):
+        self._con.close()
+
+
+#### Rate limiting ####
+class TokenBucket():
+
+    """
+    Thread-safe token bucket shared by all geocoding workers. Tokens refill
+    at rate per second up to capacity; acquire() blocks until one is
+    available, so the combined request rate never exceeds rate after an
+    initial burst of at most capacity requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+#### Geocoder backends ####
+class Geocoder():
+
+    """
+    Interface for geocoder backends. A backend implements geocode(address)
+    and returns (latitude, longitude), or None if the address cannot be
+    found. Backends are callable, so an instance can be passed anywhere a
+    geocoder function is accepted (geocode_many, geocode_from_address).
+
+    remote is False for backends that answer locally, which are then
+    queried directly instead of through the rate-limited thread pool.
+    """
+
+    remote = True
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+    def __call__(self, address):
+        return self.geocode(address)
+
+
+@lru_cache(maxsize=None)
+def _google_client(key, agent, timeout, domain, scheme):
+    # One client per configuration, reused for every request
+    return GoogleV3(api_key=key, user_agent=agent, timeout=timeout, domain=domain, scheme=scheme)
+
+
+class GoogleGeocoder(Geocoder):
+
+    """
+    Google Maps Geocoding API backend. All instances with the same settings
+    share one GoogleV3 client. Point domain and scheme at a local HTTP
+    stand-in (eg. domain="localhost:8000", scheme="http") to test without
+    the network. Incurs a charge at $0.005 per request.
+    """
+
+    def __init__(self, key=None, agent=None, timeout=10, domain="maps.googleapis.com", scheme=None):
+        self.client = _google_client(key or GOOGLE_API_KEY, agent or GOOGLE_AGENT, timeout, domain, scheme)
+
+    def geocode(self, address):
+        location = self.client.geocode(address)
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+
+class NominatimGeocoder(Geocoder):
+
+    """
+    OpenStreetMap Nominatim backend. The public server allows about one
+    request per second; use rate=1 with geocode_many, or point domain at a
+    self-hosted instance.
+    """
+
+    def __init__(self, agent=None, timeout=10, domain="nominatim.openstreetmap.org", scheme=None):
+        self.client = Nominatim(user_agent=agent or GOOGLE_AGENT or "permits-data", timeout=timeout,
+                                domain=domain, scheme=scheme)
+
+    def geocode(self, address):
+        location = self.client.geocode(address)
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+
+class LocalGazetteer(Geocoder):
+
+    """
+    Offline backend that resolves addresses against permits that already
+    have coordinates. An address is matched exactly on its address_key;
+    otherwise its house number is interpolated between the nearest
+    known house numbers on either side on the same street and zip code, if
+    both are within max_gap. Lookups are dictionary and binary searches in
+    memory, at no API cost.
+
+    Example
+    -------
+    gazetteer = LocalGazetteer.from_data(data)
+    gazetteer.geocode("1201 North Main Street 90012")
+    (34.0635, -118.2368)
+    gazetteer.lookup("1201 N MAIN ST 90012")
+    (34.0635, -118.2368)
+
+    geocode_from_address(data, gazetteer=gazetteer)
+    """
+
+    remote = False
+
+    # Address keys "<number> [<fraction>] <street> <zip>", zip optional
+    _parts = re.compile(r'^(\d+)(?:\s+\d+/\d+)?\s+(.+?)(?:\s+(\d{5}))?$')
+
+    def __init__(self, keys, latitudes, longitudes, max_gap=100):
+
+        self.max_gap = max_gap
+
+        data = pd.DataFrame({"address": pd.Series(keys, dtype=object).to_numpy(),
+                             "latitude": np.asarray(latitudes, dtype=float),
+                             "longitude": np.asarray(longitudes, dtype=float)}).dropna()
+
+        # Exact matches; permits at the same address are averaged
+        exact = data.groupby("address")[["latitude", "longitude"]].mean()
+        self._exact = dict(zip(exact.index, zip(exact["latitude"], exact["longitude"])))
+
+        # House numbers along each street and zip code, sorted for interpolation
+        parts = exact.index.to_series().str.extract(self._parts)
+        parts.columns = ["number", "street", "zip_code"]
+        parts = pd.concat([parts.reset_index(drop=True), exact.reset_index(drop=True)], axis=1).dropna(subset=["number"])
+        parts["number"] = parts["number"].astype(int)
+        parts["zip_code"] = parts["zip_code"].fillna('')
+
+        streets = parts.groupby(["street", "zip_code", "number"])[["latitude", "longitude"]].mean().reset_index()
+        self._streets = {key: (group["number"].to_numpy(), group["latitude"].to_numpy(), group["longitude"].to_numpy())
+                         for key, group in streets.groupby(["street", "zip_code"])}
+
+    def __len__(self):
+        return len(self._exact)
+
+    @classmethod
+    def from_data(cls, data, max_gap=100):
+        """
+        Builds a gazetteer from the rows of a dataframe with both an
+        address_key (or the address columns to build it) and
+        latitude_longitude.
+        """
+
+        from src.pipeline.transform_data import parse_lat_long
+
+        keys = data['address_key'] if 'address_key' in data.columns else address_key(data)
+        known = keys.notnull() & data['latitude_longitude'].notnull()
+        latitude, longitude, _ = parse_lat_long(data.loc[known, 'latitude_longitude'])
+
+        return cls(keys[known], latitude, longitude, max_gap=max_gap)
+
+    @classmethod
+    def from_table(cls, table, where=None, max_gap=100):
+        """
+        Builds a gazetteer from a Table with address_key, latitude and
+        longitude columns, fetching only those columns of the rows selected
+        by where.
+        """
+
+        sql = """
+        SELECT address_key, latitude, longitude FROM {table}
+        WHERE address_key IS NOT NULL AND latitude IS NOT NULL AND longitude IS NOT NULL{where};
+        """.format(table=table.table, where=" AND ({})".format(where) if where else "")
+        known = table.fetch_data(sql=sql, coerce_float=True)
+
+        return cls(known['address_key'], known['latitude'], known['longitude'], max_gap=max_gap)
+
+    def geocode(self, address):
+        return self.lookup(address_key_of(address))
+
+    def lookup(self, address):
+        """
+        Resolves an address_key, see geocode for address strings.
+        """
+
+        if address is None:
+            return None
+
+        if address in self._exact:
+            return self._exact[address]
+
+        match = self._parts.match(address)
+        if not match:
+            return None
+
+        number, street, zip_code = int(match.group(1)), match.group(2), match.group(3) or ''
+        if (street, zip_code) not in self._streets:
+            return None
+
+        numbers, latitudes, longitudes = self._streets[(street, zip_code)]
+        i = np.searchsorted(numbers, number)
+
+        # Need a known house number on both sides within max_gap
+        if i == 0 or i == len(numbers):
+            return None
+
+        low, high = numbers[i - 1], numbers[i]
+        if number - low > self.max_gap or high - number > self.max_gap:
+            return None
+
+        weight = (number - low) / (high - low)
+        return (latitudes[i - 1] + weight * (latitudes[i] - latitudes[i - 1]),
+                longitudes[i - 1] + weight * (longitudes[i] - longitudes[i - 1]))
+
+
+class ChainGeocoder(Geocoder):
+
+    """
+    Tries backends in order and returns the first location found, eg.
+    ChainGeocoder(NominatimGeocoder(), GoogleGeocoder()).
+    """
+
+    def __init__(self, *backends):
+        self.backends = backends
+        self.remote = any(getattr(backend, "remote", True) for backend in backends)
+
+    def geocode(self, address):
+        for backend in self.backends:
+            location = backend(address)
+            if location is not None:
+                return location
+        return None
+
+
+# Remote backends by name
+backends = {"google": GoogleGeocoder, "nominatim": NominatimGeocoder}
+
+
+def get_geocoder(name="google", **kwargs):
+    """
+    Returns a geocoder backend by name, eg. get_geocoder("nominatim").
+    """
+
+    if name not in backends:
+        raise ValueError("Unknown geocoder '{}', choose from {}.".format(name, list(backends)))
+
+    return backends[name](**kwargs)
+
+
+def google_geocoder(key=None, agent=None, timeout=10, domain="maps.googleapis.com", scheme=None):
+
+    """
+    Returns a Google Maps backend, see GoogleGeocoder.
+    """
+
+    return GoogleGeocoder(key=key, agent=agent, timeout=timeout, domain=domain, scheme=scheme)
+
+
 # Create helper function to geocode missing latitude_longitude values
 def geocode(address, key, agent, timeout=10):
 
     """
-    Uses GoogleMaps API to batch geocode address strings to lat/long coordinates. RateLimiter is to 
-    avoid timeout errors. If an address cannot be geocoded it is left as NaN. Use of GoogleMaps 
-    API incurs a charge at $0.005 per request.
+    Uses GoogleMaps API to geocode an address string to lat/long coordinates. If an address 
+    cannot be geocoded returns None. Use of GoogleMaps API incurs a charge at $0.005 per request.
     """
 
     if address:
-        # Instantiates GoogleMaps geocoder
-        geolocator = GoogleV3(api_key=key or key, 
-                                user_agent=agent or agent, 
-                                timeout=timeout)
+        return google_geocoder(key, agent, timeout)(address)
+    else:
+        return None
 
-        # Adds Rate Limiter to space out requests
-        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-        location = geolocator.geocode(address)
-        latitude, longitude = location.latitude, location.longitude
 
-        return latitude, longitude
-    else:
-        return np.nan
+def geocode_many(addresses, geocoder, rate=10, max_workers=4, retries=3, backoff=1.0, retry_on=RETRY_ERRORS,
+                 keys=None):
+
+    """
+    Geocodes addresses concurrently on a thread pool. Requests from all
+    workers draw from one TokenBucket, so the combined rate stays under
+    rate requests per second with at most max_workers in flight. Timeouts
+    and unavailable errors are retried with exponential backoff.
+
+    Returns a list in the same order as addresses holding (latitude,
+    longitude), None when the address was not found, or the exception
+    raised by the last attempt.
+
+    Params
+    ------
+    addresses : list of strings
+
+    geocoder : callable
+        Function of an address string returning (latitude, longitude) or None
+
+    rate : float
+        Requests per second across all workers
+
+    max_workers : int
+        Number of concurrent requests
+
+    retries : int
+        Retries per address after the first attempt
+
+    backoff : float
+        Seconds to wait before the first retry, doubled on each retry
+
+    keys : list of strings
+        address_key of each address; addresses sharing a key are requested
+        once and share the result
+    """
+
+    if keys is not None:
+        requests = {}
+        for key, address in zip(keys, addresses):
+            requests.setdefault(key, address)
+        results = dict(zip(requests, geocode_many(list(requests.values()), geocoder, rate=rate,
+                                                  max_workers=max_workers, retries=retries, backoff=backoff,
+                                                  retry_on=retry_on)))
+        return [results[key] for key in keys]
+
+    bucket = TokenBucket(rate)
+
+    def lookup(address):
+        for attempt in range(retries + 1):
+            bucket.acquire()
+            try:
+                return geocoder(address)
+            except retry_on as e:
+                if attempt == retries:
+                    return e
+                time.sleep(backoff * 2 ** attempt)
+            except Exception as e:
+                return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool, span("geocode_many", "api", rows=len(addresses)):
+        return list(pool.map(lookup, addresses))
+
 
 # Takes addresses and outputs coordinates
-def geocode_from_address(data, key=None, agent=None):
+def geocode_from_address(data, key=None, agent=None, cache=None, geocoder=None, rate=10, max_workers=4,
+                         gazetteer=None):
+
+    """
+    Fills missing latitude_longitude values by geocoding full_address. Each
+    distinct address_key is looked up at most once per call, so spellings
+    of the same address are paid for once, and results are read from and
+    written to cache when a GeocodeCache is given. Rows without a key (no
+    street name) are not geocoded.
+    Addresses are resolved from the cache first, then from gazetteer (at no
+    cost), and only the remainder is sent to geocoder.
+
+    Params
+    ------
+    data : pandas Dataframe
+        Dataframe with full_address, latitude_longitude and address_key (or
+        the address columns to build it) columns; updated in place
+
+    key, agent : string
+        Google Maps API key and user agent, loaded from .env if not given
+
+    cache : GeocodeCache
+        Persistent cache of previous results
+
+    geocoder : Geocoder or callable
+        Backend or function of an address string returning (latitude,
+        longitude) or None; defaults to GoogleGeocoder
+
+    rate, max_workers : 
+        Requests per second and concurrent requests, see geocode_many
+
+    gazetteer : LocalGazetteer
+        Local backend tried before geocoder, eg. LocalGazetteer.from_data(data)
+    """
     
     # Extract rows missing in latitude_longitude
-    data_missing = data[data['latitude_longitude'].isnull()==1]
-    
-    # How many rows are missing coordinates
-    num_missing = len(data_missing)
+    missing = data['latitude_longitude'].isnull()
 
-    # Calculate cost
-    cost = num_missing * 0.005
-    print("Cost for geocoding {} addresses is ${:.2f}.".format(num_missing, cost))
-
-    # Google Maps environment variables
-    load_dotenv(find_dotenv());
-    key = os.getenv("GOOGLE_API_KEY") or key
-    agent = os.getenv("GOOGLE_AGENT") or agent
-
-    # Geocode missing coordinates using full addresses
-    if len(data_missing) > 0:
-        try:
-            print("Geocoding...")
-            data_missing.loc[:, 'latitude_longitude'] = data_missing['full_address'].apply(geocode, args=(key,
-                                                                                                    agent))
-            print("{} locations were assigned coordinates.".format(num_missing))
-        except Exception as e:
-            print("Error:\n", e)
-    else:
+    if not missing.any():
         print("No missing coordinates.")
         return data
 
+    # One lookup per distinct address key
+    keys = (data['address_key'] if 'address_key' in data.columns else address_key(data))[missing]
+    addresses = data.loc[missing, 'full_address'].fillna(keys)
+    distinct = keys.dropna().unique().tolist()
+
+    cached = cache.get_many(distinct) if cache is not None else {}
+    pending = [address for address in distinct if address not in cached]
+
+    # Resolve from sibling permits before paying for requests
+    local = {}
+    if gazetteer is not None:
+        local = {address: gazetteer.lookup(address) for address in pending}
+        local = {address: location for address, location in local.items() if location is not None}
+        pending = [address for address in pending if address not in local]
+
+    # Calculate cost
+    cost = len(pending) * 0.005
+    print("{} rows missing coordinates, {} distinct addresses, {} cached, {} resolved locally."
+          .format(missing.sum(), len(distinct), len(cached), len(local)))
+    print("Cost for geocoding {} addresses is ${:.2f}.".format(len(pending), cost))
+
+    if geocoder is None and pending:
+        # Google Maps environment variables
+        load_dotenv(find_dotenv());
+        key = os.getenv("GOOGLE_API_KEY") or key
+        agent = os.getenv("GOOGLE_AGENT") or agent
+        geocoder = GoogleGeocoder(key, agent)
+
+    # Geocode with the first original spelling of each address
+    originals = addresses.groupby(keys).first()
+    results = {}
+
+    if pending:
+        print("Geocoding...")
+
+        # Local backends need no rate limiting or threads
+        if getattr(geocoder, "remote", True):
+            locations = geocode_many(originals[pending].tolist(), geocoder, rate=rate, max_workers=max_workers)
+        else:
+            locations = [geocoder(originals[address]) for address in pending]
+
+        for address, location in zip(pending, locations):
+            if isinstance(location, Exception):
+                # Not cached, so failed requests are retried next run
+                print("Error:", address, location)
+            else:
+                results[address] = location
+
+    if cache is not None and results:
+        cache.put_many(results)
+
     # Update dataframe
-    data.update(data_missing, overwrite=False)
+    locations = {address: "({}, {})".format(*location)
+                 for address, location in {**cached, **local, **results}.items() if location is not None}
+    data['latitude_longitude'] = data['latitude_longitude'].fillna(keys.map(locations).reindex(data.index))
+
+    print("{} locations were assigned coordinates.".format(data.loc[missing, 'latitude_longitude'].notnull().sum()))
+
+    return data
+
+
+#### Spatial queries ####
+# Radius, nearest-neighbor and bounding box queries over permit coordinates,
+# in memory with SpatialIndex or in PostgreSQL with a GiST index on the
+# built-in point type (no PostGIS needed). Distances are great-circle
+# distances in meters. Longitudes are assumed not to wrap around 180.
+
+EARTH_RADIUS = 6371008.8 # Mean radius in meters
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    """
+    Great-circle distance in meters from one point to arrays of points.
+    """
+
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+
+    a = np.sin((latitudes - latitude) / 2) ** 2 + \
+        np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Smallest (south, west, north, east) box holding every point within
+    radius meters of a point.
+    """
+
+    angle = radius / EARTH_RADIUS
+    south, north = latitude - np.degrees(angle), latitude + np.degrees(angle)
+
+    # Poles inside the circle: every longitude
+    if south <= -90 or north >= 90 or angle >= np.pi / 2:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+
+    spread = np.degrees(np.arcsin(min(np.sin(angle) / np.cos(np.radians(latitude)), 1.0)))
+
+    return south, longitude - spread, north, longitude + spread
+
+
+def point_in_polygon(latitudes, longitudes, polygon):
+    """
+    Boolean mask of the points inside a polygon of (latitude, longitude)
+    vertices, by ray casting; one pass over the points per edge.
+    """
+
+    latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+    inside = np.zeros(len(latitudes), dtype=bool)
+
+    for (lat1, lon1), (lat2, lon2) in zip(polygon, polygon[1:] + polygon[:1]):
+        crosses = (lat1 > latitudes) != (lat2 > latitudes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            edge = lon1 + (latitudes - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        inside ^= crosses & (longitudes < edge)
+
+    return inside
+
+
+class SpatialIndex():
+
+    """
+    In-memory grid index over coordinates. Points are bucketed into cells
+    of about cell_size meters and sorted by cell, column by column, so the
+    points of a range of cells in one column are a contiguous slice found
+    by binary search. A query scans only the cells overlapping its box.
+
+    Example
+    -------
+    index = SpatialIndex.from_table(permits, id_col="pcis_permit_no")
+    index.within(34.0522, -118.2437, 500)
+    index.nearest(34.0522, -118.2437, k=10)
+    index.bbox(34.04, -118.26, 34.06, -118.24)
+    """
+
+    def __init__(self, latitudes, longitudes, ids=None, id_col="id", cell_size=250):
+
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        ids = np.arange(len(latitudes)) if ids is None else np.asarray(ids)
+        known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+
+        self.id_col = id_col
+        self.cell_size = cell_size
+
+        latitudes, longitudes, ids = latitudes[known], longitudes[known], ids[known]
+
+        if not len(latitudes):
+            latitudes, longitudes = np.zeros(0), np.zeros(0)
+
+        # Cells are about square at the mean latitude
+        self._origin = (latitudes.min(), longitudes.min()) if len(latitudes) else (0.0, 0.0)
+        self._height = np.degrees(cell_size / EARTH_RADIUS)
+        self._width = self._height / max(np.cos(np.radians(latitudes.mean() if len(latitudes) else 0.0)), 1e-6)
+
+        rows, columns = self._cells(latitudes, longitudes)
+        self._rows = int(rows.max()) + 1 if len(rows) else 1
+        self._columns = int(columns.max()) + 1 if len(columns) else 1
+
+        keys = columns * self._rows + rows
+        order = np.argsort(keys, kind="stable")
+
+        self._keys = keys[order]
+        self.latitudes, self.longitudes, self.ids = latitudes[order], longitudes[order], ids[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_data(cls, data, id_col=None, cell_size=250):
+        """
+        Builds an index from a dataframe with latitude and longitude
+        columns; points are identified by id_col, or the index.
+        """
+
+        ids = data[id_col].to_numpy() if id_col else data.index.to_numpy()
+
+        return cls(data['latitude'], data['longitude'], ids=ids, id_col=id_col or "id", cell_size=cell_size)
+
+    @classmethod
+    def from_table(cls, table, id_col=None, where=None, cell_size=250):
+        """
+        Builds an index from a Table with latitude and longitude columns,
+        fetching only id_col and the coordinates.
+        """
+
+        id_col = id_col or table.id_col
+        sql = """
+        SELECT {id_col}, latitude, longitude FROM {table}
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL{where};
+        """.format(id_col=id_col, table=table.table, where=" AND ({})".format(where) if where else "")
+        known = table.fetch_data(sql=sql, coerce_float=True)
+
+        return cls.from_data(known, id_col=id_col, cell_size=cell_size)
+
+    def _cells(self, latitudes, longitudes):
+        rows = np.floor((np.asarray(latitudes) - self._origin[0]) / self._height).astype(np.int64)
+        columns = np.floor((np.asarray(longitudes) - self._origin[1]) / self._width).astype(np.int64)
+
+        return rows, columns
+
+    def _candidates(self, south, west, north, east):
+        """
+        Positions of the points in the cells overlapping a box.
+        """
+
+        (row_low, row_high), (column_low, column_high) = self._cells([south, north], [west, east])
+        row_low, row_high = max(row_low, 0), min(row_high, self._rows - 1)
+        column_low, column_high = max(column_low, 0), min(column_high, self._columns - 1)
+
+        if row_low > row_high or column_low > column_high or not len(self):
+            return np.zeros(0, dtype=np.int64)
+
+        columns = np.arange(column_low, column_high + 1) * self._rows
+        starts = np.searchsorted(self._keys, columns + row_low, side="left")
+        ends = np.searchsorted(self._keys, columns + row_high, side="right")
+
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def _result(self, positions, distances=None):
+        result = pd.DataFrame({self.id_col: self.ids[positions], "latitude": self.latitudes[positions],
+                               "longitude": self.longitudes[positions]})
+
+        if distances is not None:
+            result["distance"] = distances
+            result = result.sort_values("distance", kind="mergesort").reset_index(drop=True)
+
+        return result
+
+    def bbox(self, south, west, north, east):
+        """
+        Points inside a box of latitudes and longitudes.
+        """
+
+        positions = self._candidates(south, west, north, east)
+        latitudes, longitudes = self.latitudes[positions], self.longitudes[positions]
+        inside = (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+
+        return self._result(positions[inside])
+
+    def within(self, latitude, longitude, radius):
+        """
+        Points within radius meters of a point, nearest first, with their
+        distance in meters.
+        """
+
+        positions = self._candidates(*bounding_box(latitude, longitude, radius))
+        distances = haversine(latitude, longitude, self.latitudes[positions], self.longitudes[positions])
+        inside = distances <= radius
+
+        return self._result(positions[inside], distances[inside])
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        The k points nearest to a point, nearest first, with their distance
+        in meters. The search radius doubles from one cell until it holds k
+        points.
+        """
+
+        k = min(k, len(self))
+        radius = self.cell_size
+
+        while True:
+            result = self.within(latitude, longitude, radius)
+            if len(result) >= k:
+                return result.head(k)
+            radius *= 2
+
+
+#### Server-side spatial queries ####
+# A GiST index on point(longitude, latitude) answers box containment with
+# <@ and nearest-neighbor ordering with <-> without a full scan
+
+def location_sql(latitude="latitude", longitude="longitude"):
+    return "point({}::float8, {}::float8)".format(longitude, latitude)
+
+
+def distance_sql(latitude, longitude):
+    """
+    SQL expression for the great-circle distance in meters from a point,
+    as in haversine.
+    """
+
+    return ("2 * {radius} * asin(least(sqrt(power(sin(radians(latitude::float8 - {latitude}) / 2), 2) + "
+            "cos(radians({latitude})) * cos(radians(latitude::float8)) * "
+            "power(sin(radians(longitude::float8 - {longitude}) / 2), 2)), 1))").format(
+                radius=EARTH_RADIUS, latitude=float(latitude), longitude=float(longitude))
+
+
+def _box_sql(south, west, north, east):
+    return "{} <@ box(point({}, {}), point({}, {}))".format(location_sql(), float(west), float(south),
+                                                           float(east), float(north))
+
+
+def create_spatial_index(table):
+    """
+    Creates a GiST index on the coordinates of a Table for query_bbox,
+    query_within and query_nearest.
+    """
+
+    table.create_index(table.table, ["({})".format(location_sql())], using="gist",
+                       name=table.table + "_location_idx")
+
+    return table
+
+
+def query_bbox(table, south, west, north, east, columns="*"):
+    """
+    Fetches the rows of a Table inside a box of latitudes and longitudes.
+    """
+
+    sql = "SELECT {} FROM {} WHERE {};".format(columns, table.table, _box_sql(south, west, north, east))
+
+    return table.fetch_data(sql=sql, coerce_float=True)
+
+
+def query_within(table, latitude, longitude, radius, columns="*"):
+    """
+    Fetches the rows of a Table within radius meters of a point, nearest
+    first, with their distance in meters. The index narrows rows to the
+    bounding box of the circle.
+    """
+
+    sql = """
+    SELECT * FROM (
+        SELECT {columns}, {distance} AS distance FROM {table} WHERE {box}
+    ) near WHERE distance <= {radius} ORDER BY distance;
+    """.format(columns=columns, distance=distance_sql(latitude, longitude), table=table.table,
+               box=_box_sql(*bounding_box(latitude, longitude, radius)), radius=float(radius))
+
+    return table.fetch_data(sql=sql, coerce_float=True)
+
+
+def query_nearest(table, latitude, longitude, k=1, columns="*"):
+    """
+    Fetches the k rows of a Table nearest to a point, nearest first, with
+    their distance in meters. The index orders rows by distance in
+    degrees, which is not quite distance on the ground, so the k rows it
+    finds first only bound the radius of a query_within.
+    """
+
+    sql = """
+    SELECT max({distance}) AS radius FROM (
+        SELECT latitude, longitude FROM {table} WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY {location} <-> point({longitude}, {latitude}) LIMIT {k}
+    ) near;
+    """.format(distance=distance_sql(latitude, longitude), table=table.table, location=location_sql(),
+               longitude=float(longitude), latitude=float(latitude), k=int(k))
+    radius = table.fetch_data(sql=sql, coerce_float=True)["radius"].iloc[0]
+
+    if pd.isnull(radius):
+        return query_within(table, latitude, longitude, 0, columns=columns).head(0)
 
-    return
\ No newline at end of file
+    # Pad for floating point differences between the two distances
+    return query_within(table, latitude, longitude, radius * (1 + 1e-9) + 1e-6, columns=columns).head(k)
@@ -0,0 +1,137 @@
+import sys
+import decimal
+from pathlib import Path
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+
+# pyarrow is optional; only Parquet snapshots need it
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa, ds = None, None
+
+
+def _require():
+    if pa is None:
+        raise ImportError("Parquet snapshots require pyarrow, eg. conda install pyarrow")
+
+
+def arrow_type(type_code):
+    """
+    Arrow type for a column of a query result, by the PostgreSQL type OID
+    in cursor.description. NUMERIC is stored as float64, as in
+    compact_dtypes; types without a match are stored as text.
+    """
+
+    _require()
+
+    types = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(),
+             701: pa.float64(), 1700: pa.float64(), 1082: pa.date32(), 1114: pa.timestamp('us'),
+             1184: pa.timestamp('us', tz='UTC')}
+
+    return types.get(type_code, pa.string())
+
+
+def _column_array(values, arrow_type):
+    """
+    Builds one Arrow array from a column of fetched values.
+    """
+
+    if pa.types.is_floating(arrow_type):
+        values = [float(value) if isinstance(value, decimal.Decimal) else value for value in values]
+    elif pa.types.is_string(arrow_type):
+        values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+
+    return pa.array(values, type=arrow_type)
+
+
+def record_batches(cursor, chunksize=100000):
+    """
+    Fetches an executed query from cursor chunksize rows at a time and
+    yields Arrow record batches, built column by column without pandas.
+    Returns None if the query has no rows, otherwise the schema and the
+    iterator of batches.
+    """
+
+    _require()
+
+    rows = cursor.fetchmany(chunksize)
+
+    if not rows:
+        return None
+
+    schema = pa.schema([(column[0], arrow_type(column[1])) for column in cursor.description])
+
+    def batches(rows):
+        while rows:
+            columns = zip(*rows)
+            yield pa.RecordBatch.from_arrays([_column_array(values, field.type)
+                                              for values, field in zip(columns, schema)], schema=schema)
+            rows = cursor.fetchmany(chunksize)
+
+    return schema, batches(rows)
+
+
+def write_dataset(batches, schema, path, partition_cols=None, overwrite=False):
+    """
+    Writes record batches to a directory of Parquet files, in hive style
+    subdirectories (eg. council_district=5/) if partition_cols are given.
+    Batches are written as they arrive. Returns the paths of the files
+    written.
+    """
+
+    _require()
+
+    files = []
+
+    ds.write_dataset(batches, str(path), schema=schema, format="parquet",
+                     partitioning=list(partition_cols) if partition_cols else None, partitioning_flavor="hive",
+                     existing_data_behavior="delete_matching" if overwrite else "error",
+                     file_visitor=lambda written: files.append(written.path))
+
+    return files
+
+
+def dataset(path):
+    """
+    Opens a directory written by write_dataset, with its partition
+    columns.
+    """
+
+    _require()
+
+    return ds.dataset(str(path), format="parquet", partitioning="hive")
+
+
+def iter_parquet(path, columns=None, filter=None, chunksize=100000):
+    """
+    Yields a Parquet dataset as dataframes of at most chunksize rows.
+
+    Params
+    ------
+    columns : list of str
+        Columns to read, defaults to all including partition columns
+
+    filter : pyarrow.dataset.Expression
+        Rows to read, eg. ds.field("council_district") == 5; filters on
+        partition columns skip whole directories
+    """
+
+    for batch in dataset(path).to_batches(columns=columns, filter=filter, batch_size=chunksize):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def read_parquet(path, columns=None, filter=None):
+    """
+    Reads a Parquet dataset into one dataframe, eg. to run the transform
+    stages on a local snapshot.
+
+    Example
+    -------
+    from pyarrow.dataset import field
+
+    data = read_parquet("data/interim/permits", filter=field("issue_year") == 2019)
+    """
+
+    return dataset(path).to_table(columns=columns, filter=filter).to_pandas()
@@ -0,0 +1,403 @@
+import sys
+import time
+import struct
+from decimal import Decimal
+from pathlib import Path
+import numpy as np
+import pandas as pd
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+
+# Binary COPY framing, see "Binary Format" in the PostgreSQL COPY docs
+header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+trailer = struct.pack('>h', -1)
+
+# Dates and timestamps are sent relative to the PostgreSQL epoch
+pg_epoch = np.datetime64('2000-01-01', 'us')
+
+# Fixed width binary representations by SQL type
+fixed_types = {'SMALLINT': '>i2', 'INTEGER': '>i4', 'BIGINT': '>i8',
+               'REAL': '>f4', 'DOUBLE PRECISION': '>f8', 'BOOLEAN': '?'}
+text_types = ('TEXT', 'VARCHAR', 'CHARACTER VARYING', 'CHAR', 'CHARACTER')
+
+# Text spellings of booleans PostgreSQL accepts: these words, case
+# insensitive, and any prefix of them that is not ambiguous
+_bool_words = {'true': True, 'yes': True, 'on': True, '1': True,
+               'false': False, 'no': False, 'off': False, '0': False}
+
+
+def _unambiguous_prefixes(words):
+    """
+    Maps every prefix of the words to their value, leaving out prefixes
+    shared by words of different values, eg. "o" for "on" and "off".
+    """
+
+    prefixes = {}
+    for word, value in words.items():
+        for end in range(1, len(word) + 1):
+            prefixes.setdefault(word[:end], set()).add(value)
+
+    return {prefix: values.pop() for prefix, values in prefixes.items() if len(values) == 1}
+
+
+bool_spellings = _unambiguous_prefixes(_bool_words)
+
+
+def base_type(sql_type):
+    """
+    Strips lengths and precisions from a SQL type, eg. VARCHAR(50) -> VARCHAR.
+    """
+
+    return sql_type.split('(')[0].strip().upper()
+
+
+def supports(sql_type):
+    """
+    Returns True if columns of sql_type can be sent with FORMAT BINARY.
+    """
+
+    sql_type = base_type(sql_type)
+
+    return sql_type in fixed_types or sql_type in text_types or \
+           sql_type in ('NUMERIC', 'DATE', 'TIMESTAMP', 'TIMESTAMP WITHOUT TIME ZONE')
+
+
+#### Column encoders ####
+# Each encoder returns (lengths, payload): the byte length of every value
+# (-1 for NULL) and the concatenated bytes of the non-null values.
+
+def _booleans(values):
+    """
+    Converts non-null values to a bool array. Numbers are true when not
+    zero; strings are parsed as PostgreSQL parses boolean input (see
+    bool_spellings), so "f" or "0" are false. Other values raise.
+    """
+
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=bool)
+
+    folded = values.map(lambda value: str(value).strip().lower() if not isinstance(value, (bool, np.bool_))
+                        else 'true' if value else 'false')
+    parsed = folded.map(bool_spellings)
+
+    if parsed.isnull().any():
+        raise ValueError('Column "{}" has values that are not booleans, eg. {!r}.'.format(
+            values.name, values[parsed.isnull()].iloc[0]))
+
+    return parsed.to_numpy(dtype=bool)
+
+
+def _encode_fixed(series, dtype):
+
+    nulls = series.isna().to_numpy()
+    values = series[~nulls]
+    kind = np.dtype(dtype).kind
+
+    if kind == 'i':
+        values = pd.to_numeric(values)
+        if pd.api.types.is_integer_dtype(values):
+            values = values.to_numpy(dtype='int64')
+        else:
+            floats = values.to_numpy(dtype='float64')
+            if not np.array_equal(floats, np.floor(floats)):
+                raise ValueError('Column "{}" has non-integer values.'.format(series.name))
+            values = floats.astype('int64')
+        info = np.iinfo(dtype)
+        if len(values) and (values.min() < info.min or values.max() > info.max):
+            raise ValueError('Column "{}" has values out of range for {}.'.format(series.name, dtype))
+    elif kind == 'f':
+        values = pd.to_numeric(values).to_numpy(dtype='float64')
+    else:
+        values = _booleans(values)
+
+    payload = values.astype(dtype).view(np.uint8)
+    lengths = np.where(nulls, -1, np.dtype(dtype).itemsize)
+
+    return lengths, payload
+
+
+def _encode_text(series):
+
+    nulls = series.isna().to_numpy()
+    text = series[~nulls].astype(str).to_numpy()
+
+    # Empty strings load as NULL, as they do from unquoted CSV fields
+    empty = text == ''
+    nulls[np.flatnonzero(~nulls)[empty]] = True
+    values = [value.encode('utf-8') for value in text[~empty]]
+
+    lengths = np.full(len(series), -1, dtype=np.int64)
+    lengths[~nulls] = [len(value) for value in values]
+
+    return lengths, np.frombuffer(b''.join(values), dtype=np.uint8)
+
+
+def _encode_datetime(series, unit, dtype):
+
+    nulls = series.isna().to_numpy()
+    values = pd.to_datetime(series[~nulls]).to_numpy().astype('datetime64[us]')
+    values = ((values - pg_epoch) // np.timedelta64(1, unit)).astype(dtype)
+
+    return np.where(nulls, -1, np.dtype(dtype).itemsize), values.view(np.uint8)
+
+
+def numeric_bytes(value):
+    """
+    Encodes one number in the NUMERIC binary format: ndigits, weight, sign
+    and display scale followed by base 10000 digits.
+
+    Example
+    -------
+    >>> numeric_bytes(Decimal('-12.5'))
+    b'\\x00\\x02\\x00\\x00@\\x00\\x00\\x01\\x00\\x0c\\x13\\x88'
+    """
+
+    # Floats go through their shortest repr, like to_csv writes them
+    text = repr(value) if isinstance(value, float) else str(value)
+
+    if text.lower() in ('nan', 'inf', '-inf', 'infinity', '-infinity'):
+        if text.lower() != 'nan':
+            raise ValueError('NUMERIC does not accept {}.'.format(value))
+        return struct.pack('>hhHh', 0, 0, 0xC000, 0)
+
+    # Exponent notation is expanded to plain digits first
+    if 'e' in text or 'E' in text:
+        text = '{:f}'.format(Decimal(text))
+
+    negative = text.startswith('-')
+    integer, _, fraction = text.lstrip('+-').partition('.')
+    integer = integer.lstrip('0')
+
+    # Align the decimal point on a 4 digit boundary
+    digits = '0' * (-len(integer) % 4) + integer + fraction + '0' * (-len(fraction) % 4)
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = (len(integer) + 3) // 4 - 1
+
+    # Leading and trailing zero groups are implied
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+
+    if not groups:
+        negative, weight = False, 0
+
+    return struct.pack('>hhHh{}H'.format(len(groups)), len(groups), weight,
+                       0x4000 if negative else 0, len(fraction), *groups)
+
+
+def _numeric_arrays(negative, coefficient, scale):
+    """
+    Encodes numbers given as sign, digits without the decimal point and
+    number of fraction digits as NUMERIC, using integer arithmetic on all
+    values at once. Coefficients must have at most 15 digits. Returns
+    (lengths, payload).
+    """
+
+    # Pad the fraction to whole base 10000 digits, least significant first
+    fraction_groups = (scale + 3) // 4
+    coefficient = coefficient * 10 ** (fraction_groups * 4 - scale)
+    groups = (coefficient[:, None] // 10000 ** np.arange(5)) % 10000
+
+    # Leading and trailing zero groups are implied
+    nonzero = groups != 0
+    present = nonzero.any(axis=1)
+    low = np.where(present, nonzero.argmax(axis=1), 0)
+    high = np.where(present, 4 - nonzero[:, ::-1].argmax(axis=1), -1)
+    ndigits = high - low + 1
+
+    # Most significant group first, then shift each row to its highest group
+    shifted = np.take_along_axis(groups[:, ::-1], np.minimum((4 - high)[:, None] + np.arange(5), 4), axis=1)
+    shifted[np.arange(5) >= ndigits[:, None]] = 0
+
+    fields = np.empty((len(coefficient), 9), dtype='>u2')
+    fields[:, 0] = ndigits
+    fields[:, 1] = np.where(present, high - fraction_groups, 0).astype('>i2').view('>u2')
+    fields[:, 2] = np.where(negative & present, 0x4000, 0)
+    fields[:, 3] = scale
+    fields[:, 4:] = shifted
+
+    lengths = 8 + 2 * ndigits
+    payload = fields.view(np.uint8).reshape(len(coefficient), 18)[np.arange(18) < lengths[:, None]]
+
+    return lengths, payload
+
+
+def _encode_numeric(series):
+
+    nulls = series.isna().to_numpy()
+    values = series[~nulls]
+
+    # Floats go through their shortest repr, like to_csv writes them
+    text = [repr(value) if isinstance(value, float) else str(value) for value in values]
+    parts = [value.lstrip('+-').partition('.') for value in text]
+    plain = np.array([(integer + fraction).isdigit() and len(integer + fraction) <= 15
+                      for integer, _, fraction in parts], dtype=bool)
+
+    # Plain decimals are encoded together, exponents, NaN and long values
+    # one at a time
+    negative = np.array([value.startswith('-') for value in text], dtype=bool)
+    coefficient = np.array([int(integer + fraction) for (integer, _, fraction), ok in zip(parts, plain) if ok],
+                           dtype=np.int64)
+    scale = np.array([len(fraction) for _, _, fraction in parts], dtype=np.int64)
+
+    plain_lengths, plain_payload = _numeric_arrays(negative[plain], coefficient, scale[plain])
+    others = [numeric_bytes(value) for value in values[~plain]]
+
+    value_lengths = np.empty(len(values), dtype=np.int64)
+    value_lengths[plain] = plain_lengths
+    value_lengths[~plain] = [len(value) for value in others]
+    starts = np.cumsum(value_lengths) - value_lengths
+
+    payload = np.empty(value_lengths.sum(), dtype=np.uint8)
+    payload[_repeat_ranges(starts[plain], plain_lengths)] = plain_payload
+    payload[_repeat_ranges(starts[~plain], value_lengths[~plain])] = np.frombuffer(b''.join(others), dtype=np.uint8)
+
+    lengths = np.full(len(series), -1, dtype=np.int64)
+    lengths[~nulls] = value_lengths
+
+    return lengths, payload
+
+
+def encode_column(series, sql_type):
+    """
+    Encodes a column as (lengths, payload) for the given SQL type.
+    """
+
+    sql_type = base_type(sql_type)
+
+    if sql_type in fixed_types:
+        return _encode_fixed(series, fixed_types[sql_type])
+    if sql_type in text_types:
+        return _encode_text(series)
+    if sql_type == 'NUMERIC':
+        return _encode_numeric(series)
+    if sql_type == 'DATE':
+        return _encode_datetime(series, 'D', '>i4')
+    if sql_type in ('TIMESTAMP', 'TIMESTAMP WITHOUT TIME ZONE'):
+        return _encode_datetime(series, 'us', '>i8')
+
+    raise TypeError('No binary COPY encoder for type {}.'.format(sql_type))
+
+
+def _repeat_ranges(starts, lengths):
+    """
+    Returns start, start + 1, ..., start + length - 1 for every pair.
+    """
+
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def encode_rows(data, sql_types):
+    """
+    Encodes the rows of a dataframe as binary COPY tuples, without the
+    file header and trailer. Every field is placed in a single output
+    buffer using offsets computed from the column lengths.
+    """
+
+    n, k = data.shape
+    columns = [encode_column(data[name], sql_types[name]) for name in data.columns]
+
+    lengths = np.column_stack([column[0] for column in columns]).astype(np.int64)
+    sizes = 4 + np.maximum(lengths, 0)
+
+    row_sizes = 2 + sizes.sum(axis=1)
+    row_starts = np.cumsum(row_sizes) - row_sizes
+    field_starts = row_starts[:, None] + 2 + np.cumsum(sizes, axis=1) - sizes
+
+    buffer = np.empty(row_sizes.sum(), dtype=np.uint8)
+
+    # Field count, then length prefix and payload for every field
+    buffer[row_starts[:, None] + np.arange(2)] = np.frombuffer(struct.pack('>h', k), dtype=np.uint8)
+    for j, (column_lengths, payload) in enumerate(columns):
+        prefixes = column_lengths.astype('>i4').view(np.uint8).reshape(n, 4)
+        buffer[field_starts[:, j, None] + np.arange(4)] = prefixes
+
+        present = column_lengths > 0
+        buffer[_repeat_ranges(field_starts[present, j] + 4, column_lengths[present])] = payload
+
+    return buffer.tobytes()
+
+
+def iter_binary(data, sql_types, chunksize=10000):
+    """
+    Yields a dataframe as a binary COPY stream, chunksize rows at a time.
+
+    Params
+    ------
+    data : pd.DataFrame
+        Rows to send, in the column order named in the COPY statement
+
+    sql_types : dict
+        SQL type for each column, eg. from types_dict or Table.schema
+
+    chunksize : int
+        Rows encoded per chunk, bounds the memory of the encoder
+    """
+
+    return iter_binary_frames([data], sql_types, chunksize=chunksize)
+
+
+def iter_binary_frames(frames, sql_types, chunksize=10000):
+    """
+    Yields an iterator of dataframes with the same columns as one binary
+    COPY stream, eg. batches read from a file. Only one dataframe is held
+    in memory at a time.
+    """
+
+    yield header
+    for data in frames:
+        for start in range(0, len(data), chunksize):
+            yield encode_rows(data.iloc[start:start + chunksize], sql_types)
+    yield trailer
+
+
+def iter_csv(data, chunksize=10000, sep=',', header_row=True):
+    """
+    Yields a dataframe as CSV with a header row, chunksize rows at a time.
+    """
+
+    for start in range(0, max(len(data), 1), chunksize):
+        chunk = data.iloc[start:start + chunksize]
+        yield chunk.to_csv(index=False, header=header_row and start == 0, sep=sep).encode('utf-8')
+
+
+class CopyStream():
+
+    """
+    File-like wrapper around an iterator of bytes, as read by
+    cursor.copy_expert. Only one chunk is held in memory at a time.
+
+    Example
+    -------
+    >>> stream = CopyStream(iter_binary(data, types_dict))
+    >>> cur.copy_expert("COPY tmp FROM STDIN WITH (FORMAT BINARY)", stream)
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.position = 0
+        self.bytes = 0
+        self.seconds = 0.0 # Spent producing chunks, ie. encoding
+
+    def read(self, size=-1):
+
+        # Refill once the current chunk is used up
+        while self.position >= len(self.buffer):
+            start = time.perf_counter()
+            self.buffer = next(self.chunks, None)
+            self.seconds += time.perf_counter() - start
+            self.position = 0
+            if self.buffer is None:
+                self.buffer = b''
+                return b''
+
+        end = len(self.buffer) if size is None or size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        self.bytes += len(data)
+
+        return data
+
@@ -6,14 +6,421 @@ from dotenv import load_dotenv, find_dotenv
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import threading
+import time
+import uuid
 import warnings
-from io import StringIO
+from contextlib import contextmanager
 from src.pipeline.dictionaries import types_dict, replace_map
+from src.toolkits import parquet
+from src.toolkits.profiling import span, statement_name
+from src.toolkits.pgcopy import CopyStream, iter_binary, iter_binary_frames, iter_csv, supports
 
 # if modulename not in sys.modules: print...
 load_dotenv(find_dotenv());
 
 
+#### Connection pool ####
+class ConnectionPool():
+
+    """
+    Thread-safe pool of psycopg2 connections. A single pool is shared by
+    every Database and Table instance with the same connection parameters
+    so that connection setup (TCP and authentication handshake) is paid
+    once per process instead of once per query.
+
+    Connections are health checked on checkout: closed or broken
+    connections are discarded, and connections idle for longer than
+    max_idle seconds are pinged with "SELECT 1" before being reused.
+
+    Example
+    --------
+    pool = ConnectionPool(minconn=1, maxconn=5, dbname="permits",
+                          user="postgres", password="postgres",
+                          host="localhost", port=5432)
+
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*) FROM permits_raw;")
+        print(cur.fetchone())
+
+    pool.stats
+    { "opened": 1, "reused": 0, "discarded": 0 }
+
+    Params
+    ------
+    minconn : int
+        Number of connections opened when the pool is created and kept
+        idle between checkouts
+
+    maxconn : int
+        Maximum number of connections checked out at the same time
+
+    max_idle : int
+        Seconds a connection may sit idle before it is pinged on checkout
+
+    timeout : int
+        Seconds to wait for a free connection before raising an error
+
+    **params
+        Connection arguments passed to psycopg2.connect()
+    """
+
+    def __init__(self, minconn=1, maxconn=5, max_idle=30, timeout=30, **params):
+
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Pool size must satisfy 0 <= minconn <= maxconn and maxconn >= 1.")
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.params = params
+        self.stats = {"opened": 0, "reused": 0, "discarded": 0}
+
+        self._idle = []  # (connection, time returned to pool)
+        self._in_use = 0
+        self._lock = threading.Condition()
+
+        for _ in range(minconn):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        """
+        Opens a new connection. Internal to the pool.
+        """
+
+        con = psycopg2.connect(connect_timeout=3, **self.params)
+        self.stats["opened"] += 1
+
+        return con
+
+    def _is_healthy(self, con, idle_since):
+        """
+        Checks that a pooled connection can be reused.
+        """
+
+        if con.closed or con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        # Only ping connections that have been idle for a while
+        if time.monotonic() - idle_since > self.max_idle:
+            try:
+                cur = con.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+                con.rollback()
+            except Exception:
+                return False
+
+        return True
+
+    def _discard(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        self.stats["discarded"] += 1
+
+    def getconn(self):
+        """
+        Checks out a healthy connection, opening a new one if no idle
+        connection is available and the pool is not exhausted.
+        """
+
+        deadline = time.monotonic() + self.timeout
+
+        with self._lock:
+            while True:
+                while self._idle:
+                    con, idle_since = self._idle.pop()
+                    if self._is_healthy(con, idle_since):
+                        self._in_use += 1
+                        self.stats["reused"] += 1
+                        return con
+                    self._discard(con)
+
+                if self._in_use < self.maxconn:
+                    con = self._open()
+                    self._in_use += 1
+                    return con
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._lock.wait(remaining):
+                    raise psycopg2.pool.PoolError("Connection pool exhausted ({} connections in use)."
+                                                  .format(self.maxconn))
+
+    def putconn(self, con, close=False):
+        """
+        Returns a connection to the pool. Open transactions are rolled back.
+        """
+
+        with self._lock:
+            self._in_use -= 1
+
+            if close or con.closed:
+                self._discard(con)
+            else:
+                try:
+                    if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        con.rollback()
+                    self._idle.append((con, time.monotonic()))
+                except Exception:
+                    self._discard(con)
+
+            self._lock.notify()
+
+    def grow(self, maxconn):
+        """
+        Raises maxconn to at least maxconn, waking callers waiting for a
+        free connection. Pools never shrink.
+        """
+
+        with self._lock:
+            if maxconn > self.maxconn:
+                self.maxconn = maxconn
+                self._lock.notify_all()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection, commits on success,
+        rolls back on error and always returns the connection to the pool.
+        """
+
+        con = self.getconn()
+        try:
+            yield con
+            if not con.closed:
+                con.commit()
+        except Exception:
+            if not con.closed:
+                con.rollback()
+            raise
+        finally:
+            self.putconn(con)
+
+    def closeall(self):
+        """
+        Closes all idle connections.
+        """
+
+        with self._lock:
+            while self._idle:
+                con, _ = self._idle.pop()
+                con.close()
+
+
+# Pools are shared per process and per set of connection parameters
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(minconn=1, maxconn=5, **params):
+    """
+    Returns the shared ConnectionPool for a set of connection parameters,
+    creating it on first use. Pools are keyed by process id so that forked
+    workers never reuse a connection opened by their parent. A caller asking
+    for a larger maxconn than the pool has grows it, so it never blocks on a
+    pool sized by an earlier caller.
+    """
+
+    key = (os.getpid(),) + tuple(sorted((k, str(v)) for k, v in params.items()))
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(minconn=minconn, maxconn=maxconn, **params)
+        else:
+            _pools[key].grow(maxconn)
+
+        return _pools[key]
+
+
+# High-water marks of incremental runs
+watermarks_ddl = """
+CREATE TABLE IF NOT EXISTS pipeline_watermarks (
+    table_name TEXT, column_name TEXT, value TEXT, updated_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (table_name, column_name)
+);
+"""
+
+# Table schemas are cached per database and table name and shared by all
+# Table instances; DDL methods invalidate their entry
+_schema_cache = {}
+
+# Type names as PostgreSQL spells them, eg. "VARCHAR(50)" -> "character
+# varying(50)", cached per database so repeated type diffs need no queries
+_type_cache = {}
+
+
+def _cast(column, col_type):
+    """
+    Returns the expression converting column to col_type, as used by
+    ALTER ... USING and the copy of a table swap.
+    """
+
+    if "DATE" in col_type.upper():
+        return "{column}::{col_type}".format(column=column, col_type=col_type)
+    elif "INT" in col_type.upper() or "NUM" in col_type.upper():
+        return "{column}::text::numeric::{col_type}".format(column=column, col_type=col_type)
+
+    return column
+
+
+def _alter_type(column, col_type):
+    """
+    Returns the ALTER TABLE clause changing the type of column.
+    """
+
+    using = _cast(column, col_type)
+
+    return "ALTER {column} TYPE {col_type}{using}".format(column=column, col_type=col_type,
+                                                          using=" USING " + using if using != column else "")
+
+
+def _canonical(series):
+    """
+    Converts a column to a form that hashes the same before and after a
+    round trip through the table: numbers (including Decimal and nullable
+    integers) as float64, everything else as strings.
+    """
+
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+
+    if kind in ('integer', 'floating', 'decimal', 'mixed-integer-float'):
+        return pd.to_numeric(series.astype(object).where(series.notnull(), np.nan)).astype('float64')
+
+    return series.astype(str).where(series.notnull(), None)
+
+
+# Hash of missing values; 0 is the hash of 0.0
+_missing_hash = np.uint64(0x9E3779B97F4A7C15)
+
+
+def fingerprint(data):
+    """
+    Returns one 64-bit hash per cell of a dataframe, with the same index and
+    columns. Take a fingerprint right after fetching data and pass it to
+    Table.update_values(baseline=...) to write back only what changed. Uses
+    8 bytes per cell instead of a copy of the data.
+    """
+
+    hashes = {}
+    for column in data.columns:
+        values = pd.util.hash_pandas_object(_canonical(data[column]), index=False).to_numpy()
+
+        # Missing values hash alike whatever the column holds otherwise, eg.
+        # a column fetched empty as float NaN and filled with strings
+        values[data[column].isnull().to_numpy()] = _missing_hash
+        hashes[column] = values
+
+    return pd.DataFrame(hashes, index=data.index)
+
+
+def changed_values(data, baseline):
+    """
+    Compares a dataframe with a fingerprint of its earlier state. Returns a
+    boolean mask of changed rows and a list of changed columns. Columns not
+    in the baseline count as changed wherever they hold a value.
+    """
+
+    current = fingerprint(data)
+    shared = [column for column in current.columns if column in baseline.columns]
+
+    cells = current[shared].ne(baseline[shared].reindex(current.index))
+    for column in current.columns:
+        if column not in baseline.columns:
+            cells[column] = data[column].notnull().to_numpy()
+
+    rows = cells.any(axis=1).to_numpy()
+    columns = [column for column in current.columns if cells[column].any()]
+
+    return rows, columns
+
+
+#### Compact dtypes ####
+# Nullable integer dtypes by SQL type; other integers stay Int64
+compact_integers = {"SMALLINT": "Int16", "INTEGER": "Int32"}
+
+
+def _string_dtype():
+    """
+    Arrow-backed string dtype if pandas and pyarrow support it, else None.
+    """
+
+    try:
+        return pd.StringDtype("pyarrow")
+    except (TypeError, ImportError):
+        return None
+
+
+def compact_dtypes(data, sql_types, category_ratio=0.5):
+    """
+    Converts fetched columns to compact dtypes by their SQL type: nullable
+    Int16/Int32 for SMALLINT/INTEGER, float64 for NUMERIC, datetime64 for
+    dates and, for text, category when there are fewer than category_ratio
+    distinct values per row (eg. status, permit_type, zone) or Arrow-backed
+    strings otherwise. Text stays object if pyarrow is not installed.
+
+    Params
+    ------
+    data : pandas.DataFrame
+        As returned by Table.fetch_data
+
+    sql_types : dict
+        SQL type by column name, eg. Table.get_types()
+
+    category_ratio : float
+        Largest share of distinct values for a text column to become a
+        category
+    """
+
+    string_dtype = _string_dtype()
+
+    for column in data.columns:
+        sql_type = sql_types.get(column, "").upper()
+        values = data[column]
+
+        # Empty text and date columns come back as float64 NaN
+        if values.dtype == 'float64' and values.isnull().all():
+            continue
+
+        try:
+            if sql_type in compact_integers:
+                data[column] = values.astype(compact_integers[sql_type])
+            elif sql_type.startswith(("NUMERIC", "DECIMAL", "REAL", "DOUBLE")):
+                data[column] = pd.to_numeric(values.astype(object).where(values.notnull(), np.nan)).astype('float64')
+            elif sql_type.startswith(("DATE", "TIMESTAMP")):
+                data[column] = pd.to_datetime(values)
+            elif sql_type.startswith(("VARCHAR", "CHAR", "TEXT")) and values.dtype == object:
+                if values.nunique() < category_ratio * len(values):
+                    data[column] = values.astype('category')
+                elif string_dtype is not None:
+                    data[column] = values.astype(string_dtype)
+        except (TypeError, ValueError, OverflowError) as e:
+            warnings.warn('Column "{}" kept as {}: {}'.format(column, values.dtype, e))
+
+    return data
+
+
+def dtype_report(before, after):
+    """
+    Returns the dtype and bytes of each column before and after
+    compact_dtypes, with a total row.
+    """
+
+    report = pd.DataFrame({"dtype_before": before.dtypes.astype(str),
+                           "bytes_before": before.memory_usage(index=False, deep=True),
+                           "dtype_after": after.dtypes.astype(str),
+                           "bytes_after": after.memory_usage(index=False, deep=True)})
+    report.loc["total"] = ["", report["bytes_before"].sum(), "", report["bytes_after"].sum()]
+    report["ratio"] = report["bytes_after"] / report["bytes_before"]
+
+    return report
+
+
 #### Database class ####
 class Database():
 
@@ -59,10 +466,25 @@ class Database():
     cur.close()
     con.close()
 
+
+    Example: Borrowing a pooled connection
+    --------
+
+    # Connection is committed and returned to the shared pool on exit
+    with db._connection() as con:
+        cur = con.cursor()
+        cur.execute(custom_sql)
+        print(cur.fetchall())
+
+    # Connections opened vs. reused by all instances in this process
+    db.pool_stats()
+    { "opened": 1, "reused": 9, "discarded": 0 }
+
     """
 
     def __init__(self, user="postgres", password="postgres",
-                 dbname=None, host="localhost", port=5432):
+                 dbname=None, host="localhost", port=5432,
+                 pool_min=1, pool_max=5):
 
         # Loaded from .env if not explicit
         self.user = os.getenv("POSTGRES_USER") or user
@@ -70,6 +492,10 @@ class Database():
         self.dbname = os.getenv("POSTGRES_DB") or dbname
         self.host = os.getenv("DB_HOST") or host
         self.port = os.getenv("DB_PORT") or port
+
+        # Size of the connection pool shared by all instances
+        self.pool_min = pool_min
+        self.pool_max = pool_max
         
     def _connect(self):
 
@@ -99,6 +525,97 @@ class Database():
             return None
 
         return con
+
+    @property
+    def _pool(self):
+        """
+        Shared connection pool for this database.
+        """
+
+        return get_pool(minconn=self.pool_min, maxconn=self.pool_max,
+                        dbname=self.dbname, user=self.user, password=self.password,
+                        host=self.host, port=self.port)
+
+    def _connection(self):
+        """
+        Context manager that borrows a connection from the shared pool.
+        Commits on success, rolls back on error.
+        """
+
+        return self._pool.connection()
+
+    @contextmanager
+    def _borrow(self, con=None):
+        """
+        Yields con if given, so that several steps can share one session
+        (eg. TEMP staging tables), otherwise a connection from the pool.
+        Rolls back con on error.
+        """
+
+        if con is None:
+            with self._connection() as con:
+                yield con
+            return
+
+        try:
+            yield con
+        except Exception:
+            con.rollback()
+            raise
+
+    def pool_stats(self):
+        """
+        Returns the number of connections opened, reused and discarded by
+        the shared pool.
+        """
+
+        return dict(self._pool.stats)
+
+    def _schema_key(self, table_name):
+        """
+        Key of a table in the shared schema cache.
+        """
+
+        return (self.host, str(self.port), self.dbname, table_name)
+
+    def _invalidate_schema(self, table_name):
+        """
+        Drops a table from the shared schema cache. Called after any
+        statement that changes the columns or types of a table.
+        """
+
+        _schema_cache.pop(self._schema_key(table_name), None)
+
+    def _resolve_types(self, type_names):
+        """
+        Returns {type name: canonical name} as format_type() reports it for
+        a column of that type, eg. "INT" -> "integer". Unknown names are
+        looked up together in a rolled back temporary table.
+        """
+
+        key = self._schema_key(None)[:3]
+        missing = sorted({name for name in type_names if key + (name,) not in _type_cache})
+
+        if missing:
+            tmp_table = "tmp_types_{}".format(uuid.uuid4().hex[:8])
+            columns = ', '.join('c{} {}'.format(i, name) for i, name in enumerate(missing))
+
+            try:
+                with self._borrow() as con:
+                    cur = con.cursor()
+                    cur.execute("CREATE TEMP TABLE {} ({});".format(tmp_table, columns))
+                    cur.execute("""
+                    SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                    WHERE attrelid = 'pg_temp.{}'::regclass AND attnum > 0 ORDER BY attnum;
+                    """.format(tmp_table))
+                    for name, (canonical,) in zip(missing, cur.fetchall()):
+                        _type_cache[key + (name,)] = canonical
+                    cur.close()
+                    con.rollback()
+            except Exception as e:
+                print("Error:", e)
+
+        return {name: _type_cache.get(key + (name,)) for name in type_names}
     
     @property
     def _con(self):
@@ -113,46 +630,63 @@ class Database():
 
         """
         try:
-            con = self._connect()
-            print('Connected as user "{}" to database "{}" on http://{}:{}.'.format(self.user,self.dbname,
-                                                               self.host,self.port))
-            con.close()
+            with self._connection():
+                print('Connected as user "{}" to database "{}" on http://{}:{}.'.format(self.user,self.dbname,
+                                                                   self.host,self.port))
         except Exception as e:
-            con.rollback()
             print('Error:', e)
-        finally:
-            if con is not None:
-                con.close()
                 
-    def _run_query(self, sql, msg=None):
+    def _literal(self, value):
         """
-        Runs internal queries.
+        Returns value quoted as a SQL literal by psycopg2, for values that
+        must be written into a statement, eg. a condition reused in
+        several queries.
+
+        Example
+        -------
+        db._literal("O'Brien")
+        "'O''Brien'"
         """
-        try:
-            con = self._connect()
-        except Exception as e:
-            print("Error:", e)            
-            
-        try:
+
+        with self._borrow() as con:
             cur = con.cursor()
-            cur.execute(sql)
-            con.commit()
+            literal = cur.mogrify("%s", (value,)).decode(psycopg2.extensions.encodings[con.encoding])
             cur.close()
-            print(msg)
+
+        return literal
+
+    def _run_query(self, sql, msg=None, con=None, raise_errors=False):
+        """
+        Runs internal queries, on con if given. Returns the number of rows
+        affected by the last statement, or None on error. With
+        raise_errors=True errors are printed and raised instead, eg. for
+        steps of a write that must not look successful.
+        """
+
+        rowcount = None
+
+        try:
+            with self._borrow(con) as con, span(statement_name(sql), "sql") as record:
+                cur = con.cursor()
+                cur.execute(sql)
+                rowcount = cur.rowcount
+                record["rows"] = rowcount if rowcount >= 0 else None
+                con.commit()
+                cur.close()
+                print(msg)
         except Exception as e:
-            con.rollback()
             print("Error:", e)
-        finally:
-            if con is not None:
-                con.close()
+            if raise_errors:
+                raise
         
-        return
+        return rowcount
 
-    def create_table(self, table_name, types_dict, id_col, columns=None):
+    def create_table(self, table_name, types_dict, id_col, columns=None, primary_key=True):
         """
         Creates a new table. Requires name, dictionary of column names as keys
         and their PostgreSQL types as values, and an id column as primary key.
-        Desired columns can be specified.
+        Desired columns can be specified. The primary key lets
+        Table.upsert_values insert and update rows in one statement.
 
         Params
         ------
@@ -168,6 +702,9 @@ class Database():
 
         columns : list of strings
             List of columns to select from types_dict
+
+        primary_key : bool
+            Adds a PRIMARY KEY constraint on id_col
         """
         
         # Append id_col to selected columns
@@ -175,7 +712,10 @@ class Database():
         
         # Subsets types_dict by columns argument and formats into string if no columns are specified
         types_dict = types_dict if not columns else {key:value for key, value in types_dict.items() if key in set(columns)}
-        names = ',\n\t'.join(['{key} {val}'.format(key=key, val=val) for key, val in types_dict.items()])
+        names = ['{key} {val}'.format(key=key, val=val) for key, val in types_dict.items()]
+        if primary_key:
+            names.append('PRIMARY KEY ({id_col})'.format(id_col=id_col))
+        names = ',\n\t'.join(names)
         
         # Build queries
         sql = 'CREATE TABLE {table_name} (\n\t{names}\n);\n\n' \
@@ -183,6 +723,7 @@ class Database():
         
         # Execute query
         self._run_query(sql, msg='Created table "{name}" in database "{dbname}".'.format(name=table_name, dbname=self.dbname))
+        self._invalidate_schema(table_name)
         
         return self
     
@@ -196,9 +737,77 @@ class Database():
         
         # Execute query
         self._run_query(sql, msg="Dropped table {}.".format(table_name))
+        self._invalidate_schema(table_name)
         
         return self
     
+    def has_unique_key(self, table_name, id_col):
+        """
+        Returns True if id_col alone is covered by a primary key, unique
+        constraint or unique index, as INSERT ... ON CONFLICT requires.
+        """
+
+        sql = """
+        SELECT count(*) FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = '{table_name}'::regclass AND i.indisunique AND i.indnatts = 1
+        AND i.indpred IS NULL AND a.attname = '{id_col}';
+        """.format(table_name=table_name, id_col=id_col)
+
+        try:
+            with self._connection() as con:
+                cur = con.cursor()
+                cur.execute(sql)
+                found = cur.fetchone()[0] > 0
+                cur.close()
+        except Exception as e:
+            print("Error:", e)
+            found = False
+
+        return found
+
+    def add_primary_key(self, table_name, id_col):
+        """
+        Adds a primary key on id_col to an existing table, eg. one loaded by
+        src/toolkits/bulk_load.py, unless id_col already has a unique key. Fails
+        if id_col has duplicate or null values.
+        """
+
+        if self.has_unique_key(table_name, id_col):
+            return self
+
+        sql = 'ALTER TABLE {table_name} ADD PRIMARY KEY ({id_col});\n'.format(table_name=table_name, id_col=id_col)
+
+        self._run_query(sql, msg='Added primary key "{}" to "{}".'.format(id_col, table_name))
+
+        return self
+
+    def create_index(self, table_name, columns, where=None, name=None, using=None):
+        """
+        Creates an index on one or more columns unless it already exists.
+        A where clause makes a partial index; using selects the index
+        method, eg. "gist". Expressions must be in parentheses and need a
+        name.
+
+        Example
+        -------
+        db.create_index("permits_raw", ["status_date"])
+        db.create_index("permits_raw", ["pcis_permit_no"], where="full_address IS NULL",
+                        name="permits_raw_pending_idx")
+        """
+
+        columns = [columns] if isinstance(columns, str) else columns
+        name = name or '{}_{}_idx'.format(table_name, '_'.join(columns))
+
+        sql = 'CREATE INDEX IF NOT EXISTS {name} ON {table_name}{using} ({columns}){where};\n' \
+                            .format(name=name, table_name=table_name, columns=', '.join(columns),
+                                    using=' USING ' + using if using else '',
+                                    where=' WHERE ' + where if where else '')
+
+        self._run_query(sql, msg='Index "{}" is ready.'.format(name))
+
+        return self
+
     def _subset_types_dict(self, types_dict, columns):
         """
         Internal method to Table class.
@@ -209,24 +818,45 @@ class Database():
         
         return types_dict, columns
 
-    def _create_temp_table(self, types_dict, id_col, columns=None):
+    def _create_temp_table(self, types_dict, id_col, columns=None, tmp_table=None, staging='temp', con=None):
         """
-        Creates temporary table for update_values operation.
+        Creates staging table for update_values operation. Only the
+        selected columns (and id_col) are included if columns are given.
+
+        Params
+        ------
+        tmp_table : str
+            Name of the staging table, defaults to tmp_<table>. Use a
+            unique name per run so concurrent workers do not collide
+
+        staging : str
+            'temp' for a TEMP table, private to the session of con and
+            never WAL-logged; 'unlogged' for an UNLOGGED table visible to
+            other sessions; 'logged' for a regular table
+
+        con : connection
+            Connection to create the table on; TEMP tables must be filled
+            and read on the same connection
+
+        Raises the database error if the table cannot be created.
         """
         
         # Append id_col to selected columns
-        columns = None if not columns else [id_col] + columns
+        columns = None if not columns else list(dict.fromkeys([id_col] + columns))
+        select = '*' if not columns else ', '.join(columns)
 
         # CREATE TABLE query
-        tmp_table = "tmp_" + self.table
+        tmp_table = tmp_table or "tmp_" + self.table
+        kind = {'temp': 'TEMP ', 'unlogged': 'UNLOGGED ', 'logged': ''}[staging]
 
         sql = """
         DROP TABLE IF EXISTS {tmp_table};
-        CREATE TABLE {tmp_table} AS (SELECT * FROM {table}) WITH NO DATA;
-        """.format(tmp_table=tmp_table, table=self.table)
+        CREATE {kind}TABLE {tmp_table} AS (SELECT {select} FROM {table}) WITH NO DATA;
+        """.format(tmp_table=tmp_table, kind=kind, select=select, table=self.table)
 
         # Execute query
-        self._run_query(sql, msg='Created temporary table "{}".'.format(tmp_table))
+        self._run_query(sql, msg='Created {}staging table "{}".'.format(kind.lower(), tmp_table), con=con,
+                        raise_errors=True)
         
         return self
     
@@ -238,16 +868,16 @@ class Database():
         WHERE schemaname NOT IN ('pg_catalog', 'information_schema');
         """
         
+        results = []
+
         try:
-            con = self._connect()
-            cur = con.cursor()
-            cur.execute(sql)
+            with self._connection() as con:
+                cur = con.cursor()
+                cur.execute(sql)
+                results = cur.fetchall()
+                cur.close()
         except Exception as e:
-            con.rollback()
             print("Error:", e)
-            
-        results = cur.fetchall()
-        cur.close()
         
         tables = []
         
@@ -267,12 +897,17 @@ class Table(Database):
     Methods
     -------
     fetch_data() --> Returns a pandas dataframe of table
+    iter_chunks() --> Streams the table as dataframes of bounded size
     get_names() --> Returns table column names
     get_types() --> Returns types dictionary in form "column name": "PostgreSQL type" 
+    refresh_schema() --> Reloads cached column names and types
     format_table_names() --> Standardizes column names 
     add_columns_from_data() --> Adds new columns from a pandas dataframe
     update_values() --> Updates rows from a pandas dataframe
     update_types() --> Updates column types from a dictionary in form "column name": "PostgreSQL type"
+    changed_types() --> Returns the columns whose type differs from a types dictionary
+    to_parquet() --> Exports the table or a query to partitioned Parquet files
+    from_parquet() --> Loads Parquet files back into the table
 
     Example 1: Preparing a database table
     -------
@@ -308,9 +943,9 @@ class Table(Database):
     """
 
     def __init__(self, name, id_col, user="postgres", password="postgres",
-                 dbname=None, host="localhost", port=5432):
+                 dbname=None, host="localhost", port=5432, pool_min=1, pool_max=5):
         
-        super().__init__(user, password, dbname, host, port)
+        super().__init__(user, password, dbname, host, port, pool_min, pool_max)
         
         self.table = name
         self.id_col = id_col
@@ -326,40 +961,142 @@ class Table(Database):
     # Connect to database
     def __connect(self):
         return super(Table, self)._connect()
+
+    # Borrow a pooled connection
+    def __connection(self):
+        return super(Table, self)._connection()
     
     # Check info on connection
     def __con(self):
         return super(Table, self)._con
     
     # Run query
-    def __run_query(self, sql, msg):
-        return super(Table, self)._run_query(sql, msg)
+    def __run_query(self, sql, msg, con=None, raise_errors=False):
+        return super(Table, self)._run_query(sql, msg, con=con, raise_errors=raise_errors)
     
     def __subset_types_dict(self, types_dict, columns):
         return super(Table, self)._subset_types_dict(types_dict, columns)
 
-    def __create_temp_table(self, types_dict, id_col, columns):
-        return super(Table, self)._create_temp_table(types_dict, id_col, columns)
+    def __create_temp_table(self, types_dict, id_col, columns, tmp_table=None, staging='temp', con=None):
+        return super(Table, self)._create_temp_table(types_dict, id_col, columns, tmp_table=tmp_table,
+                                                     staging=staging, con=con)
+
+    def __drop_staging(self, tmp_table, con=None):
+        """
+        Drops the staging table of a failed write; the error was already
+        printed by the step that raised it.
+        """
+
+        print('Error: nothing written to "{}".'.format(self.table))
+        self.__run_query("DROP TABLE IF EXISTS {};".format(tmp_table), con=con,
+                         msg='Dropped staging table "{}".'.format(tmp_table))
     
     # Fetch data from sql query
-    def fetch_data(self, sql=None, coerce_float=False, parse_dates=None):
+    def fetch_data(self, sql=None, coerce_float=False, parse_dates=None, chunksize=None, compact=False,
+                   report=False):
         """
         Fetches data from PostgreSQL table. Tries to preserve NA values
         for integers within pandas Dataframe and uses np.nan
         for other dtypes.
+
+        If chunksize is given, returns an iterator of dataframes with at
+        most chunksize rows each instead (see iter_chunks).
+
+        compact=True converts columns to memory-efficient dtypes by their
+        SQL type (see compact_dtypes); report=True also prints the bytes
+        of each column before and after.
         """
+
+        if chunksize:
+            return self.iter_chunks(sql=sql, chunksize=chunksize, coerce_float=coerce_float,
+                                    parse_dates=parse_dates, compact=compact)
         
         sql = sql or "SELECT * FROM {};".format(self.table)
         
-        con = self.__connect()
-        
         # Fetch fresh data
-        data = pd.read_sql_query(sql=sql, con=con, coerce_float=coerce_float, parse_dates=parse_dates)
+        with self.__connection() as con, span(self.table, "fetch") as record:
+            data = pd.read_sql_query(sql=sql, con=con, coerce_float=coerce_float, parse_dates=parse_dates)
+            record["rows"] = len(data)
+
+        data = self._recast_types(data)
+
+        if compact:
+            data = self._compact(data, report=report)
+        
+        return data
+
+    def iter_chunks(self, sql=None, chunksize=50000, coerce_float=False, parse_dates=None, compact=False):
+        """
+        Streams data from PostgreSQL table through a named server-side
+        cursor and yields dataframes of at most chunksize rows. Only one
+        chunk is held in memory at a time. Integer columns are recast to
+        Int64 per chunk, as in fetch_data.
+
+        Example
+        -------
+        for chunk in permits_raw.iter_chunks(chunksize=10000):
+            process(chunk)
+
+        Params
+        ------
+        sql : string
+            Query to run, defaults to the whole table
+
+        chunksize : int
+            Number of rows per dataframe
+
+        coerce_float : bool
+            Converts decimal.Decimal values to float
+
+        parse_dates : list of strings
+            Columns to convert to datetime
+
+        compact : bool
+            Converts each chunk to memory-efficient dtypes (see
+            compact_dtypes)
+        """
+
+        sql = sql or "SELECT * FROM {};".format(self.table)
+
+        # Unique name so concurrent iterators on one connection never clash
+        cursor_name = "fetch_{}_{}".format(self.table, uuid.uuid4().hex[:8])
+
+        with self.__connection() as con:
+            cur = con.cursor(name=cursor_name)
+            cur.itersize = chunksize
+
+            try:
+                cur.execute(sql)
+
+                while True:
+                    with span(self.table, "fetch") as record:
+                        rows = cur.fetchmany(chunksize)
+                        record["rows"] = len(rows)
+
+                    if not rows:
+                        break
+
+                    columns = [col[0] for col in cur.description]
+                    data = pd.DataFrame.from_records(rows, columns=columns, coerce_float=coerce_float)
+
+                    for column in parse_dates or []:
+                        data[column] = pd.to_datetime(data[column])
+
+                    data = self._recast_types(data)
+                    yield self._compact(data) if compact else data
+            finally:
+                cur.close()
+
+    def _recast_types(self, data):
+        """
+        Recasts integer columns to nullable Int64 and replaces None with
+        np.nan. Internal to fetch_data and iter_chunks.
+        """
         
         # Recast integer columns to preserve original types
         try: 
             update_dict = self.get_types(pandas_integers=True)
-            update_dict = {k: v for k, v in update_dict.items() if v}
+            update_dict = {k: v for k, v in update_dict.items() if v and k in data.columns}
             data = data.astype(update_dict)
         except:
             warnings.warn('Dataframe dtypes may be incorrect.')
@@ -367,31 +1104,156 @@ class Table(Database):
         
         # Replace None with np.nan
         data.fillna(np.nan, inplace=True)
-        
-        # Close db connection
-        con.close()
 
         return data
+
+    def _compact(self, data, report=False):
+        """
+        Applies compact_dtypes with the SQL types of the table, printing
+        a dtype_report if report is True. Internal to fetch_data and
+        iter_chunks.
+        """
+
+        # Shallow copy: columns are replaced, not modified, so the
+        # original frame stays intact for the report
+        compacted = compact_dtypes(data.copy(deep=False), self.get_types())
+
+        if report:
+            summary = dtype_report(data, compacted)
+            print(summary.to_string())
+            print('Compacted "{}" from {:,.0f} to {:,.0f} bytes.'.format(self.table,
+                                                                        *summary.loc["total", ["bytes_before",
+                                                                                               "bytes_after"]]))
+
+        return compacted
     
+    # Cached schema of table
+    @property
+    def schema(self):
+        """
+        Returns the cached schema of the table as a dataframe with one row
+        per column: column_name, ordinal_position, sql_type, pandas_type and
+        pg_type (the full type, eg. numeric(10,2)).
+        Loaded from information_schema on first use and shared by all Table
+        instances; DDL methods on Table invalidate it automatically.
+        """
+
+        key = self._schema_key(self.table)
+
+        if key not in _schema_cache:
+            schema = self._fetch_schema()
+
+            # Do not cache tables that do not exist (yet)
+            if schema.empty:
+                return schema
+
+            _schema_cache[key] = schema
+
+        return _schema_cache[key]
+
+    def _fetch_schema(self):
+        """
+        Queries column names, positions and types in a single round trip.
+        """
+
+        sql = """
+        SELECT column_name, ordinal_position,
+        CASE 
+            WHEN domain_name is not null then domain_name
+            WHEN data_type='character varying' THEN 'varchar('||character_maximum_length||')'
+            WHEN data_type='character' THEN 'char('||character_maximum_length||')'
+            WHEN data_type='numeric' THEN 'numeric'
+            ELSE data_type
+        END AS sql_type,
+        CASE 
+            WHEN domain_name is not null then domain_name
+            WHEN data_type='smallint' OR data_type='integer' THEN 'Int64'
+        END AS pandas_type,
+        format_type(a.atttypid, a.atttypmod) AS pg_type
+        FROM information_schema.columns c
+        LEFT JOIN pg_attribute a 
+            ON a.attrelid = (quote_ident(c.table_schema)||'.'||quote_ident(c.table_name))::regclass 
+            AND a.attname = c.column_name
+        WHERE table_name = '{}'
+        ORDER BY ordinal_position;
+        """.format(self.table)
+
+        try:
+            with self.__connection() as con, span("schema", "sql"):
+                data = pd.read_sql_query(sql, con)
+        except Exception as e:
+            print("Error:", e)
+            data = pd.DataFrame(columns=['column_name', 'ordinal_position', 'sql_type', 'pandas_type', 'pg_type'])
+
+        data['sql_type'] = data['sql_type'].str.upper()
+
+        return data
+
+    def refresh_schema(self):
+        """
+        Discards the cached schema and reloads it from the database.
+        """
+
+        self._invalidate_schema(self.table)
+        self.schema
+
+        return self
+
+    #### Watermarks ####
+    # High-water marks of incremental runs, one per table and column,
+    # kept in the database next to the data they describe
+
+    def get_watermark(self, column):
+        """
+        Returns the high-water mark of column stored by set_watermark as a
+        string, or None if no run has completed yet.
+        """
+
+        sql = watermarks_ddl + """
+        SELECT value FROM pipeline_watermarks WHERE table_name = %s AND column_name = %s;
+        """
+
+        try:
+            with self.__connection() as con:
+                cur = con.cursor()
+                cur.execute(sql, (self.table, column))
+                row = cur.fetchone()
+                cur.close()
+        except Exception as e:
+            print("Error:", e)
+            row = None
+
+        return row[0] if row else None
+
+    def set_watermark(self, column, value):
+        """
+        Stores the high-water mark of column. Call once a run has written
+        all rows up to value.
+        """
+
+        sql = watermarks_ddl + """
+        INSERT INTO pipeline_watermarks (table_name, column_name, value) VALUES (%s, %s, %s)
+        ON CONFLICT (table_name, column_name) DO UPDATE SET value = EXCLUDED.value, updated_at = now();
+        """
+
+        try:
+            with self.__connection() as con:
+                cur = con.cursor()
+                cur.execute(sql, (self.table, column, str(value)))
+                cur.close()
+                print('Watermark of "{}.{}" set to {}.'.format(self.table, column, value))
+        except Exception as e:
+            print("Error:", e)
+
+        return self
+
     # Get names of column
     def get_names(self):
         """
         Returns names of columns in table.
         """
         
-        # Specific query to retrieve table names
-        sql = "SELECT * FROM information_schema.columns WHERE table_name = N'{}'".format(self.table)
-        
-        # Run query and extract
-        try:
-            con = self.__connect()
-            data = pd.read_sql_query(sql, con)
-            column_series = data['column_name']
-            con.close()
-        except Exception as e:
-            print("Error:", e)
-    
-        return column_series
+        return self.schema['column_name'].copy()
 
     # Get types of columns, returns dict
     def get_types(self, as_dataframe=False, pandas_integers=False):
@@ -409,39 +1271,8 @@ class Table(Database):
             in integer dtypes in pandas Dataframe.
         """
         
-        # Specific query to retrieve table names
-        sql_to_sql = """
-        SELECT column_name, 
-        CASE 
-            WHEN domain_name is not null then domain_name
-            WHEN data_type='character varying' THEN 'varchar('||character_maximum_length||')'
-            WHEN data_type='character' THEN 'char('||character_maximum_length||')'
-            WHEN data_type='numeric' THEN 'numeric'
-            ELSE data_type
-        END AS type
-        FROM information_schema.columns WHERE table_name = 'permits_raw';
-        """
-        
-        sql_to_pandas = """
-        SELECT column_name, 
-        CASE 
-            WHEN domain_name is not null then domain_name
-            WHEN data_type='smallint' OR data_type='integer' THEN 'Int64'
-        END AS type        
-        FROM information_schema.columns WHERE table_name = 'permits_raw';
-        """
-        
-        sql = sql_to_sql if not pandas_integers else sql_to_pandas
-        
-        # Run query and extract
-        try:
-            con = self.__connect()
-            data = pd.read_sql_query(sql, con)
-            con.close()
-        except Exception as e:
-            print("Error:", e)
-        
-        data['type'] = data['type'].str.upper() if not pandas_integers else data['type']
+        type_col = 'sql_type' if not pandas_integers else 'pandas_type'
+        data = self.schema[['column_name', type_col]].rename(columns={type_col: 'type'})
         
         if as_dataframe:
             return data
@@ -509,6 +1340,7 @@ class Table(Database):
             
             # Execute query
             self.__run_query(sql, msg='Updated names in "{}".'.format(self.table))
+            self._invalidate_schema(self.table)
             
             return self
                     
@@ -550,6 +1382,7 @@ class Table(Database):
 
         # Execute query
         self.__run_query(sql, msg='Added new columns to "{name}":\n{cols}'.format(name=self.table, cols=new_names))
+        self._invalidate_schema(self.table)
         
         return self
     
@@ -584,71 +1417,89 @@ class Table(Database):
                 print(list(set(db_columns) - set(data_columns)))
                 return False
         
-    def _copy_from_dataframe(self, data, id_col, columns=None):
+    def _copy_from_dataframe(self, data, id_col, columns=None, copy_format='binary', chunksize=10000,
+                             tmp_table=None, con=None):
         """
         Copies rows from dataframe into a temporary table. Automatically 
-        matches the order of columns between the table and the dataframe.
-        Internal to update_values.
+        matches the order of columns between the table and the dataframe,
+        or copies only the given columns. Internal to update_values.
+
+        Rows are streamed chunksize at a time in binary COPY format, encoded
+        from the column arrays using the table's SQL types. Falls back to
+        streaming CSV if copy_format='csv' or a column type has no binary
+        encoder. Errors are printed and raised, so update_values does not
+        go on with a partial staging table.
         """
         
-        tmp_table = "tmp_" + self.table
+        tmp_table = tmp_table or "tmp_" + self.table
 
-        # Tests whether dataframe columns and table columns are same order
-        match = self._match_column_order(data)
+        try:
+            if columns:
+                # Copy only the selected columns, in the temporary table's order
+                columns = list(dict.fromkeys([id_col] + columns))
+                data = data[columns]
 
-        # Match columns order between table and dataframe
-        if match:
-            # Get columns from table as list
-            db_columns = self.get_names().tolist()
-            
-            # Select columns from dataframe as list
-            data_columns = data.columns.tolist()
+            else:
+                # Tests whether dataframe columns and table columns are same order
+                match = self._match_column_order(data)
 
-            # Rearrange to match
-            data = data[db_columns]
-            print('Rearranged dataframe columns to match "{}".'.format(self.table))
+                # Match columns order between table and dataframe
+                if match:
+                    # Get columns from table as list
+                    db_columns = self.get_names().tolist()
 
-        try:
-            con = self.__connect()
-        except Exception as e:
-            print("Connection Error:", e)
+                    # Rearrange to match
+                    data = data[db_columns]
+                    print('Rearranged dataframe columns to match "{}".'.format(self.table))
 
-        columns = data.columns.tolist() if not columns else columns
+            sql_types = dict(zip(self.schema['column_name'], self.schema['sql_type']))
 
-        dataStream = StringIO()
-        data.to_csv(dataStream, index=False, header=True, sep=',')
-        dataStream.seek(0)
-        
-        sql = """
-        COPY {tmp_table} FROM STDIN WITH (FORMAT CSV, HEADER TRUE);
-        """.format(tmp_table=tmp_table)
-        
-        try:
-            cur = con.cursor()
-            cur.copy_expert(sql, dataStream)
-            con.commit()
-            cur.close()
-            print('Copy successful on table "{}".'.format(self.table))
+            if copy_format == 'binary' and not all(supports(sql_types.get(name, '')) for name in data.columns):
+                print('Copying "{}" as CSV, some column types have no binary encoder.'.format(self.table))
+                copy_format = 'csv'
+
+            if copy_format == 'binary':
+                dataStream = CopyStream(iter_binary(data, sql_types, chunksize=chunksize))
+                options = "FORMAT BINARY"
+            else:
+                dataStream = CopyStream(iter_csv(data, chunksize=chunksize))
+                options = "FORMAT CSV, HEADER TRUE"
+
+            sql = """
+            COPY {tmp_table} ({columns}) FROM STDIN WITH ({options});
+            """.format(tmp_table=tmp_table, columns=', '.join(data.columns), options=options)
+
+            with self._borrow(con) as con, span(self.table, "copy", rows=len(data)) as record:
+                cur = con.cursor()
+                cur.copy_expert(sql, dataStream, size=1 << 16)
+                con.commit()
+                cur.close()
+                record["bytes"], record["python_seconds"] = dataStream.bytes, dataStream.seconds
+                print('Copy successful on table "{}".'.format(self.table))
         except Exception as e:
-            con.rollback()
             print("Error:", e)
-        finally:
-            if con is not None:
-                con.close()
+            raise
                 
         return self          
         
-    def _update_from_temp(self, id_col, columns=None):
+    def _update_from_temp(self, id_col, columns=None, tmp_table=None, con=None):
         """
-        Updates table from temporary table. Internal to update_values.
+        Updates table from temporary table, after indexing and analyzing
+        its id column so the planner can join on it. Internal to
+        update_values. Returns the number of rows updated; raises if the
+        update fails.
         """
         
-        temp_table = "tmp_" + self.table
+        temp_table = tmp_table or "tmp_" + self.table
+        sql_index = 'CREATE INDEX ON {temp_table} ({id_col});\nANALYZE {temp_table};\n' \
+                            .format(temp_table=temp_table, id_col=id_col)
         columns = self.get_names().tolist() if not columns else columns
         sql_update = 'UPDATE {table}\n'.format(table=self.table)
         sql_set = ["SET "]
         
         for name in columns:
+            if name == id_col:
+                continue
             line = "{name} = {tmp_name},\n\t".format(name=name, tmp_name=temp_table + '.' + name)
             sql_set.append(line)
 
@@ -659,73 +1510,413 @@ class Table(Database):
                             .format(temp_table=temp_table, this_table=self.table, id_col=id_col)
         sql_drop = 'DROP TABLE {};\n'.format(temp_table)
                 
-        sql = sql_update + sql_set + sql_from + sql_drop
+        sql = sql_update + sql_set + sql_from
 
         # Execute query
-        self.__run_query(sql, msg='Updated values in "{}".'.format(self.table))
+        self.__run_query(sql_index, msg='Indexed staging table "{}".'.format(temp_table), con=con, raise_errors=True)
+        rows = self.__run_query(sql, msg='Updated values in "{}".'.format(self.table), con=con, raise_errors=True)
+        self.__run_query(sql_drop, msg='Dropped staging table "{}".'.format(temp_table), con=con)
         
-        return self
+        return rows
                   
     # Builds a query to update postgres from a csv file
-    def update_values(self, data, id_col, types_dict, columns=None, sep=','):
+    def update_values(self, data, id_col, types_dict, columns=None, sep=',', update_schema=True, baseline=None,
+                      copy_format='binary', staging='temp'):
         """
         Updates values in dataframe into table. If columns are in the
         dataframe but not in the table, will automatically add those 
         columns and update their types.
+
+        Set update_schema=False to skip the ALTER TABLE statements when the
+        table already has every column, eg. while a server-side cursor from
+        iter_chunks is open on the same table (ALTER TABLE would wait on
+        the cursor's lock).
+
+        Pass baseline=fingerprint(data) taken right after fetching to only
+        write rows and columns that changed since (see changed_values).
+
+        Rows are sent with binary COPY; pass copy_format='csv' to stream
+        CSV instead. They are staged in a TEMP table with a unique name per
+        call, so concurrent workers can update the same table; pass
+        staging='unlogged' or 'logged' to stage in a shared table instead.
+
+        Returns a dictionary with the number of rows written, the columns
+        updated and whether the write failed. A failed write is rolled back
+        and reports no rows or columns.
         """
 
         # Automatically updates table with new columns in dataframe
-        if data.columns.tolist() != columns:
+        if update_schema and data.columns.tolist() != columns:
                 self.add_columns_from_data(data)
                 self.update_types(types_dict=types_dict, columns=columns)        
+
+        # Keep only changed rows and columns
+        if baseline is not None:
+            rows, changed = changed_values(data, baseline)
+            changed = [column for column in changed if column != id_col]
+            if columns:
+                changed = [column for column in changed if column in columns]
+
+            if not rows.any() or not changed:
+                print('No changes to write to "{}".'.format(self.table))
+                return {"rows": 0, "columns": [], "failed": False}
+
+            print('{} of {} rows changed in columns {}.'.format(rows.sum(), len(data), changed))
+            data, columns = data.loc[rows, [id_col] + changed], changed
         
-        columns = self.get_names().tolist() if not columns else [id_col] + columns
+        # Columns of the table missing from data are left untouched
+        columns = [name for name in self.get_names().tolist() if name in data.columns] if not columns \
+                  else [id_col] + columns
         
-        column_params = {"id_col":id_col, "columns":columns}
-
-        self.__create_temp_table(types_dict=types_dict, **column_params) \
-                        ._copy_from_dataframe(data=data, **column_params) \
-                        ._update_from_temp(**column_params)
+        tmp_table = "tmp_{}_{}".format(self.table, uuid.uuid4().hex[:8])
+
+        # All steps share one session, TEMP tables are private to it
+        with self.__connection() as con:
+            column_params = {"id_col":id_col, "columns":columns, "tmp_table":tmp_table, "con":con}
+
+            try:
+                rows = self.__create_temp_table(types_dict=types_dict, staging=staging, **column_params) \
+                                ._copy_from_dataframe(data=data, copy_format=copy_format, **column_params) \
+                                ._update_from_temp(**column_params)
+            except Exception:
+                self.__drop_staging(tmp_table, con=con)
+                return {"rows": 0, "columns": [], "failed": True}
         
-        return
+        return {"rows": rows or 0, "columns": [column for column in columns if column != id_col], "failed": False}
+
+    def _upsert_from_temp(self, id_col, columns=None, tmp_table=None, con=None):
+        """
+        Inserts new rows and updates existing rows by id_col from the
+        temporary table in a single INSERT ... ON CONFLICT statement.
+        Internal to upsert_values. Returns the number of rows inserted and
+        updated; raises if the upsert fails.
+        """
+
+        temp_table = tmp_table or "tmp_" + self.table
+        columns = self.get_names().tolist() if not columns else columns
+        names = ', '.join(columns)
+        sql_set = ',\n\t'.join('{name} = EXCLUDED.{name}'.format(name=name) for name in columns if name != id_col)
+
+        # xmax is 0 on rows that did not exist before the statement
+        sql = """
+        WITH upserted AS (
+            INSERT INTO {table} ({names})
+            SELECT {names} FROM {temp_table}
+            ON CONFLICT ({id_col}) DO {action}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted;
+        """.format(table=self.table, names=names, temp_table=temp_table, id_col=id_col,
+                   action='UPDATE SET\n\t' + sql_set if sql_set else 'NOTHING')
+        sql_index = 'ANALYZE {temp_table};\n'.format(temp_table=temp_table)
+        sql_drop = 'DROP TABLE {};\n'.format(temp_table)
+
+        inserted, updated = 0, 0
+
+        self.__run_query(sql_index, msg='Analyzed staging table "{}".'.format(temp_table), con=con, raise_errors=True)
+        try:
+            with self._borrow(con) as con, span(statement_name(sql), "sql") as record:
+                cur = con.cursor()
+                cur.execute(sql)
+                inserted, updated = cur.fetchone()
+                record["rows"] = inserted + updated
+                con.commit()
+                cur.close()
+                print('Upserted values in "{}".'.format(self.table))
+        except Exception as e:
+            print("Error:", e)
+            raise
+        self.__run_query(sql_drop, msg='Dropped staging table "{}".'.format(temp_table), con=con)
+
+        return inserted, updated
+
+    def upsert_values(self, data, id_col, types_dict, columns=None, update_schema=True, copy_format='binary',
+                      staging='temp'):
+        """
+        Inserts rows of data whose id_col is not in the table yet and
+        updates the others, eg. to apply a daily download of permits
+        without reloading the table. Adds a primary key on id_col first if
+        the table has no unique key on it. When id_col is repeated in data
+        the last row wins.
+
+        Other parameters are the same as update_values. Returns a
+        dictionary with the number of rows inserted and updated, the
+        columns written and whether the write failed.
+
+        Example
+        -------
+        permits = Table(name="permits_raw", id_col="pcis_permit_no")
+        permits.upsert_values(delta, id_col="pcis_permit_no", types_dict=types_dict)
+        {'inserted': 120, 'updated': 3400, 'columns': [...]}
+        """
+
+        # Automatically updates table with new columns in dataframe
+        if update_schema and data.columns.tolist() != columns:
+                self.add_columns_from_data(data)
+                self.update_types(types_dict=types_dict, columns=columns)
+
+        self.add_primary_key(self.table, id_col)
+
+        # ON CONFLICT cannot update the same row twice in one statement
+        data = data.drop_duplicates(subset=id_col, keep='last')
+        columns = [name for name in self.get_names().tolist() if name in data.columns] if not columns \
+                  else [id_col] + [name for name in columns if name != id_col]
+
+        tmp_table = "tmp_{}_{}".format(self.table, uuid.uuid4().hex[:8])
+
+        # All steps share one session, TEMP tables are private to it
+        with self.__connection() as con:
+            column_params = {"id_col":id_col, "columns":columns, "tmp_table":tmp_table, "con":con}
+
+            try:
+                inserted, updated = self.__create_temp_table(types_dict=types_dict, staging=staging, **column_params) \
+                                        ._copy_from_dataframe(data=data, copy_format=copy_format, **column_params) \
+                                        ._upsert_from_temp(**column_params)
+            except Exception:
+                self.__drop_staging(tmp_table, con=con)
+                return {"inserted": 0, "updated": 0, "columns": [], "failed": True}
+
+        return {"inserted": inserted, "updated": updated, "columns": [column for column in columns if column != id_col],
+                "failed": False}
+
+    #### Parquet snapshots ####
+    # Column-oriented copies of the table on local disk (see
+    # src/toolkits/parquet.py, requires pyarrow)
+
+    def to_parquet(self, path, sql=None, partition_cols=None, chunksize=100000, overwrite=False):
+        """
+        Exports the table, or the result of sql, to a directory of Parquet
+        files. Rows stream from a server-side cursor and are converted to
+        Arrow column by column, chunksize rows at a time. Returns a
+        dictionary with the rows and files written.
+
+        Params
+        ------
+        path : str
+            Directory to write
+
+        sql : str
+            Query to export, defaults to the whole table
+
+        partition_cols : list or dict
+            Columns to partition by, eg. ["council_district"], or
+            {name: SQL expression} for derived partitions, eg.
+            {"issue_year": "date_part('year', issue_date)::int"}. Derived
+            partition columns are not loaded back by from_parquet.
+
+        overwrite : bool
+            Replaces files in partitions that are written again
+
+        Example
+        -------
+        permits_raw.to_parquet("data/interim/permits",
+                               partition_cols={"issue_year": "date_part('year', issue_date)::int"})
+        """
+
+        sql = (sql or "SELECT * FROM {}".format(self.table)).strip().rstrip(';')
+
+        if isinstance(partition_cols, dict):
+            expressions = ', '.join('{} AS {}'.format(expression, name) for name, expression in partition_cols.items())
+            sql = "SELECT q.*, {} FROM ({}) q".format(expressions, sql)
+
+        cursor_name = "parquet_{}_{}".format(self.table, uuid.uuid4().hex[:8])
+        exported, files = {"rows": 0}, []
+
+        with self.__connection() as con, span("to_parquet", "export") as record:
+            cur = con.cursor(name=cursor_name)
+            cur.itersize = chunksize
+
+            try:
+                cur.execute(sql)
+                result = parquet.record_batches(cur, chunksize=chunksize)
+
+                if result is not None:
+                    schema, batches = result
+
+                    def counted(batches):
+                        for batch in batches:
+                            exported["rows"] += batch.num_rows
+                            yield batch
+
+                    files = parquet.write_dataset(counted(batches), schema, path, partition_cols=partition_cols,
+                                                  overwrite=overwrite)
+            finally:
+                cur.close()
+                record["rows"] = exported["rows"]
+
+        print('Exported {} rows of "{}" to {} Parquet files in "{}".'.format(exported["rows"], self.table,
+                                                                             len(files), path))
+
+        return {"rows": exported["rows"], "files": files}
+
+    def from_parquet(self, path, filter=None, chunksize=100000):
+        """
+        Appends the rows of a Parquet directory written by to_parquet to
+        the table with a binary COPY, one batch of chunksize rows in memory
+        at a time. Only columns that exist in the table are loaded. Returns
+        the number of rows loaded.
+
+        Params
+        ------
+        filter : pyarrow.dataset.Expression
+            Rows to load, eg. pyarrow.dataset.field("council_district") == 5
+        """
+
+        names = self.get_names().tolist()
+        columns = [name for name in parquet.dataset(path).schema.names if name in set(names)]
+        sql_types = dict(zip(self.schema['column_name'], self.schema['sql_type']))
+
+        loaded = {"rows": 0}
+
+        def frames():
+            for data in parquet.iter_parquet(path, columns=columns, filter=filter, chunksize=chunksize):
+                loaded["rows"] += len(data)
+                yield data
+
+        if all(supports(sql_types[name]) for name in columns):
+            stream = CopyStream(iter_binary_frames(frames(), sql_types))
+            options = "FORMAT BINARY"
+        else:
+            stream = CopyStream(chunk for i, data in enumerate(frames())
+                                for chunk in iter_csv(data, header_row=i == 0))
+            options = "FORMAT CSV, HEADER TRUE"
+
+        sql = "COPY {} ({}) FROM STDIN WITH ({});".format(self.table, ', '.join(columns), options)
+
+        try:
+            with self.__connection() as con, span(self.table, "copy") as record:
+                cur = con.cursor()
+                cur.copy_expert(sql, stream, size=1 << 16)
+                con.commit()
+                cur.close()
+                record["rows"], record["bytes"], record["python_seconds"] = loaded["rows"], stream.bytes, stream.seconds
+                print('Loaded {} rows from "{}" into "{}".'.format(loaded["rows"], path, self.table))
+        except Exception as e:
+            print("Error:", e)
+            return 0
+
+        return loaded["rows"]
 
     # Updates column types in PostgreSQL database
-    def update_types(self, types_dict, columns=None):
+    def changed_types(self, types_dict, columns=None):
+        """
+        Returns {column: type} for the columns in types_dict whose current
+        type differs, compared against the cached schema. Columns not in the
+        table are left out.
+        """
+
+        types_dict, columns = self.__subset_types_dict(types_dict, columns)
+        current = dict(zip(self.schema['column_name'], self.schema['pg_type']))
+        resolved = self._resolve_types(set(types_dict.values()))
+
+        return {column: col_type for column, col_type in types_dict.items()
+                if column in current and current[column] != resolved[col_type]}
+
+    def update_types(self, types_dict, columns=None, swap=False):
         """
         Updates types using types_dict, eg., 
 
         { "column name": "VARCHAR(100)", ... }
 
+        Only columns whose type differs are altered, so calling it again is
+        free. ALTER ... TYPE rewrites the table under an exclusive lock; with
+        swap=True large migrations copy the rows into a new table instead
+        while readers keep using the old one (see _swap_types).
+
+        Returns a dictionary with the columns migrated, the columns that
+        failed to migrate (the table is left as it was), the method and the
+        seconds taken.
         """
         
-        # Subset types based on columns input
-        types_dict, columns = self.__subset_types_dict(types_dict, columns)
-        
-        # Define SQL update queries
-        sql_alter_table = "ALTER TABLE public.{}\n\t".format(self.table)
+        types_dict = self.changed_types(types_dict, columns)
+        method = "swap" if swap else "alter"
 
-        # Update types
-        sql_update_types = []
-        
-        for column, col_type in types_dict.items():
-            if "DATE" in col_type.upper():
-                sql_string = "ALTER {column} TYPE {col_type} USING {column}::" + "{col_type},\n\t"
-            elif "INT" in col_type.upper() or "NUM" in col_type.upper():
-                sql_string = "ALTER {column} TYPE {col_type} USING {column}::text::numeric::{col_type},\n\t"
-            elif "NUM" in col_type.upper():
-                sql_string = "ALTER {column} TYPE {col_type} USING {column}::text::numeric::{col_type},\n\t"
-            else:
-                sql_string = "ALTER {column} TYPE {col_type},\n\t"
+        if not types_dict:
+            return {"columns": [], "failed": [], "method": None, "seconds": 0.0}
+
+        start = time.perf_counter()
+
+        if swap:
+            migrated = self._swap_types(types_dict)
+        else:
+            # Define SQL update queries
+            sql_alter_table = "ALTER TABLE public.{}\n\t".format(self.table)
 
-            sql_alter_column = sql_string.format(column=column, col_type=col_type)
-            sql_update_types.append(sql_alter_column)
+            sql_update_types = [_alter_type(column, col_type) for column, col_type in types_dict.items()]
 
-        # Join strings to create full sql query
-        sql_update_types = sql_alter_table + ''.join(sql_update_types)
+            sql = sql_alter_table + ',\n\t'.join(sql_update_types) + ";"
 
-        # Replace very last character with ";"
-        sql = sql_update_types[:-3] + ";"
+            migrated = self.__run_query(sql, msg='Updated types of {} columns in "{}".'.format(len(types_dict),
+                                                                                            self.table)) is not None
 
-        self.__run_query(sql, msg='Updated types in "{}".'.format(self.table))
+        seconds = time.perf_counter() - start
+
+        if not migrated:
+            print('Error: could not migrate {} column types of "{}" by {}.'.format(len(types_dict), self.table,
+                                                                                  method))
+            return {"columns": [], "failed": list(types_dict), "method": method, "seconds": seconds}
+
+        self._invalidate_schema(self.table)
+        print('Migrated {} column types of "{}" by {} in {:.2f} s.'.format(len(types_dict), self.table, method,
+                                                                          seconds))
             
-        return 
+        return {"columns": list(types_dict), "failed": [], "method": method, "seconds": seconds}
+
+    def _swap_types(self, types_dict):
+        """
+        Migrates types by copying the table into a new one with the new types
+        and swapping it in, in one transaction. The copy holds a SHARE lock
+        (reads continue, writes wait); only the final drop and rename take
+        an exclusive lock. Indexes and unique constraints are rebuilt after
+        the copy under their original names. Fails, leaving the table as it
+        was, if other objects such as views depend on it.
+
+        Returns True if the table was swapped, False on error.
+        """
+
+        new_table = "{}_{}".format(self.table, uuid.uuid4().hex[:8])
+        names = self.get_names().tolist()
+
+        try:
+            with self.__connection() as con:
+                cur = con.cursor()
+                cur.execute("LOCK TABLE {} IN SHARE MODE;".format(self.table))
+
+                # Constraints and indexes to rebuild once the rows are in
+                cur.execute("""
+                SELECT conname, pg_get_constraintdef(oid), conindid FROM pg_constraint
+                WHERE conrelid = '{table}'::regclass AND contype IN ('p', 'u');
+                """.format(table=self.table))
+                constraints = cur.fetchall()
+                cur.execute("""
+                SELECT pg_get_indexdef(indexrelid) FROM pg_index
+                WHERE indrelid = '{table}'::regclass AND indexrelid <> ALL(%s::oid[]);
+                """.format(table=self.table), ([oid for _, _, oid in constraints],))
+                indexes = [row[0] for row in cur.fetchall()]
+
+                columns = ', '.join(_cast(name, types_dict[name]) if name in types_dict else name for name in names)
+                alter = ', '.join(_alter_type(column, col_type) for column, col_type in types_dict.items())
+
+                cur.execute("""
+                CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING STORAGE
+                                          INCLUDING COMMENTS);
+                ALTER TABLE {new_table} {alter};
+                INSERT INTO {new_table} SELECT {columns} FROM {table};
+                DROP TABLE {table};
+                ALTER TABLE {new_table} RENAME TO {table};
+                """.format(new_table=new_table, table=self.table, alter=alter, columns=columns))
+
+                for name, definition, _ in constraints:
+                    cur.execute("ALTER TABLE {} ADD CONSTRAINT {} {};".format(self.table, name, definition))
+                for definition in indexes:
+                    cur.execute(definition + ";")
+
+                cur.execute("ANALYZE {};".format(self.table))
+                con.commit()
+                cur.close()
+                print('Swapped "{}" for a copy with updated types.'.format(self.table))
+        except Exception as e:
+            print("Error:", e)
+            return False
+
+        return True
@@ -0,0 +1,195 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+sys.path[0] = str(Path(__file__).resolve().parents[2]) # Set path for custom modules
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Span categories spent waiting on PostgreSQL
+database_categories = ("sql", "fetch", "copy")
+
+# Spans are only recorded when enabled, by enable() or the PERMITS_PROFILE
+# environment variable ("1", or a path for the JSON dump)
+_state = {"enabled": os.getenv("PERMITS_PROFILE", "") not in ("", "0"), "start": time.perf_counter()}
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable():
+    """
+    Starts recording spans, discarding any recorded before.
+    """
+
+    with _lock:
+        _spans.clear()
+    _state["enabled"] = True
+    _state["start"] = time.perf_counter()
+
+
+def disable():
+    _state["enabled"] = False
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def output_path():
+    """
+    Path given by PERMITS_PROFILE for the JSON dump, if any.
+    """
+
+    value = os.getenv("PERMITS_PROFILE", "")
+    return value if value not in ("", "0", "1") else None
+
+
+def peak_memory():
+    """
+    Peak resident memory of the process so far in bytes.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def statement_name(sql):
+    """
+    Short name of a SQL statement for grouping spans, eg. "UPDATE
+    permits_raw"; per-run staging table suffixes are replaced by *.
+    """
+
+    words = " ".join(sql.split()).split(" ")
+    name = " ".join(words[:3] if words[:1] in (["CREATE"], ["DROP"], ["ALTER"]) else words[:2])
+
+    return re.sub(r'_[0-9a-f]{8}\b', '_*', name).rstrip(';')
+
+
+@contextmanager
+def span(name, category="stage", rows=None, **details):
+    """
+    Times a block and records it with its rows, bytes and the peak memory
+    of the process at its end. Yields a dictionary; set "rows" or "bytes"
+    in it when they are only known inside the block. Spans opened inside
+    a span on the same thread are its children, so time spent in the
+    database can be told apart from time spent in Python. Does nothing
+    unless profiling is enabled.
+
+    Example
+    -------
+    with span("update_values", rows=len(data)) as record:
+        ...
+        record["bytes"] = stream.bytes
+    """
+
+    record = {"name": name, "category": category, "rows": rows, "bytes": None, **details}
+
+    if not _state["enabled"]:
+        yield record
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    record["parent"] = stack[-1]["id"] if stack else None
+    record["thread"] = threading.current_thread().name
+    with _lock:
+        record["id"] = len(_spans)
+        _spans.append(record)
+
+    stack.append(record)
+    start = time.perf_counter()
+
+    try:
+        yield record
+    finally:
+        record["start"] = start - _state["start"]
+        record["seconds"] = time.perf_counter() - start
+        record["peak_memory"] = peak_memory()
+        stack.pop()
+
+
+def spans():
+    with _lock:
+        return [dict(record) for record in _spans]
+
+
+def summarize(records=None):
+    """
+    Totals spans by category and name. For each, the seconds spent in
+    database spans nested inside it are reported separately.
+    """
+
+    records = spans() if records is None else records
+    children = {}
+    for record in records:
+        children.setdefault(record["parent"], []).append(record)
+
+    # Database spans may report Python time spent inside them, eg.
+    # encoding a COPY stream
+    def database_seconds(record):
+        if record["category"] in database_categories:
+            return record.get("seconds", 0.0) - (record.get("python_seconds") or 0.0)
+        return sum(database_seconds(child) for child in children.get(record["id"], []))
+
+    totals = OrderedDict()
+    for record in records:
+        total = totals.setdefault((record["category"], record["name"]), {
+            "category": record["category"], "name": record["name"], "calls": 0, "seconds": 0.0,
+            "database_seconds": 0.0, "rows": 0, "bytes": 0, "peak_memory": 0})
+        total["calls"] += 1
+        total["seconds"] += record.get("seconds", 0.0)
+        total["database_seconds"] += database_seconds(record)
+        total["rows"] += record["rows"] or 0
+        total["bytes"] += record["bytes"] or 0
+        total["peak_memory"] = max(total["peak_memory"], record.get("peak_memory") or 0)
+
+    return list(totals.values())
+
+
+def report(top=10):
+    """
+    Prints stage spans with their database and Python time, then the
+    slowest database statements.
+    """
+
+    totals = summarize()
+    stages = [total for total in totals if total["category"] not in database_categories]
+    statements = sorted([total for total in totals if total["category"] in database_categories],
+                        key=lambda total: -total["seconds"])
+
+    print("{:<28}{:>7}{:>10}{:>10}{:>10}{:>12}{:>10}{:>10}".format(
+        "Span", "Calls", "Seconds", "DB s", "Python s", "Rows", "MB", "Peak MB"))
+    for total in stages + statements[:top]:
+        python_seconds = total["seconds"] - total["database_seconds"]
+        print("{:<28.28}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}{:>12}{:>10.1f}{:>10.0f}".format(
+            "{}:{}".format(total["category"], total["name"]), total["calls"], total["seconds"],
+            total["database_seconds"], python_seconds, total["rows"], total["bytes"] / 1e6,
+            total["peak_memory"] / 1e6))
+
+    return totals
+
+
+def dump(path):
+    """
+    Writes every span and the totals to a JSON file.
+    """
+
+    with open(path, "w") as f:
+        json.dump({"spans": spans(), "totals": summarize(), "peak_memory": peak_memory()}, f, indent=2,
+                  default=str)
+
+    print("Profile written to {}.".format(path))